@@ -0,0 +1,322 @@
+'''
+Acceleration structures for ground truth ray casting.
+
+These structures are built once per mesh and then reused for every ray. Each query finds the faces that could be
+kept by rasterization.prune_mesh, and only those faces are rotated and passed to the halfspace test in rasterization.py,
+so the depths and occupancies are the same as running the brute force functions on the full mesh.
+'''
+
+import time
+import numpy as np
+
+import rasterization
+
+
+class RayAccelerator():
+    '''
+    Base class for acceleration structures. Subclasses override traverse(), which returns the indices of every face whose
+    vertices could all lie within near_face_threshold of the (infinite) line through the ray.
+    The base class itself is the brute force structure: every face is a candidate and the rasterization functions do the pruning.
+        verts               - the mesh vertices
+        faces               - the mesh faces
+        near_face_threshold - the pruning radius used by the rasterization functions (defaults to rasterization.max_edge)
+    '''
+
+    def __init__(self, verts, faces, near_face_threshold=None):
+        super().__init__()
+        self.verts = np.array(verts, dtype=float)
+        self.faces = np.array(faces, dtype=int)
+        self.near_face_threshold = rasterization.max_edge(self.verts, self.faces) if near_face_threshold is None else near_face_threshold
+        self.build_time = 0.
+        self.last_query_stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        '''
+        Clears the cumulative traversal statistics
+        '''
+        self.stats = {"queries": 0}
+
+    def record_query(self, **query_stats):
+        '''
+        Stores the stats for the most recent query and adds them to the running totals
+        '''
+        self.last_query_stats = query_stats
+        self.stats["queries"] += 1
+        for key, val in query_stats.items():
+            self.stats[key] = self.stats.get(key, 0) + val
+
+    def summary(self):
+        '''
+        Returns a string with the build time and the average traversal stats per query
+        '''
+        n_queries = max(self.stats["queries"], 1)
+        averages = ", ".join([f"{key} {val/n_queries:.1f}" for key, val in self.stats.items() if key != "queries"])
+        return f"{self.__class__.__name__}: built in {self.build_time:.3f}s, {self.stats['queries']} queries, per query: {averages} (of {self.faces.shape[0]} faces)"
+
+    def traverse(self, ray_start, ray_end):
+        '''
+        Returns the indices of every face, the same candidate set the 'brute' backend tests
+        '''
+        candidates = np.arange(self.faces.shape[0])
+        self.record_query(candidate_faces=candidates.shape[0])
+        return candidates
+
+    def candidate_mesh(self, ray_start, ray_end):
+        '''
+        Returns the candidate faces for a ray as a small mesh, rotated so that it can be passed to the rasterization functions
+        Also returns the original indices of the candidate faces and the original indices of the candidate vertices
+        '''
+        candidates = self.traverse(ray_start, ray_end)
+        vert_indices, sub_faces = np.unique(self.faces[candidates], return_inverse=True)
+        sub_faces = sub_faces.reshape((-1,3))
+        rot_verts = rasterization.rotate_mesh(self.verts[vert_indices], ray_start, ray_end)
+        return sub_faces, rot_verts, candidates, vert_indices
+
+    def ray_occ_depth(self, ray_start, ray_end, v=None):
+        '''
+        Same as rasterization.ray_occ_depth, but the ray is given by its start and end point in the mesh frame
+        '''
+        sub_faces, rot_verts, _, vert_indices = self.candidate_mesh(ray_start, ray_end)
+        ray_start_depth = np.linalg.norm(ray_end-ray_start)
+        if v is not None and not np.any(vert_indices == v):
+            return rasterization.ray_occ_depth(self.faces, rasterization.rotate_mesh(self.verts, ray_start, ray_end), ray_start_depth=ray_start_depth, near_face_threshold=self.near_face_threshold, v=v)
+        if sub_faces.shape[0] == 0:
+            return False, np.inf
+        sub_v = np.searchsorted(vert_indices, v) if v is not None else None
+        return rasterization.ray_occ_depth(sub_faces, rot_verts, ray_start_depth=ray_start_depth, near_face_threshold=self.near_face_threshold, v=sub_v)
+
+    def ray_occ_depth_visual(self, ray_start, ray_end, v=None):
+        '''
+        Same as rasterization.ray_occ_depth_visual, but the ray is given by its start and end point in the mesh frame
+        The returned face indices refer to the full mesh
+        '''
+        sub_faces, rot_verts, candidates, vert_indices = self.candidate_mesh(ray_start, ray_end)
+        ray_start_depth = np.linalg.norm(ray_end-ray_start)
+        if v is not None and not np.any(vert_indices == v):
+            return rasterization.ray_occ_depth_visual(self.faces, rasterization.rotate_mesh(self.verts, ray_start, ray_end), ray_start_depth=ray_start_depth, near_face_threshold=self.near_face_threshold, v=v)
+        if sub_faces.shape[0] == 0:
+            return False, np.inf, np.array([])
+        sub_v = np.searchsorted(vert_indices, v) if v is not None else None
+        occ, depth, intersected_faces = rasterization.ray_occ_depth_visual(sub_faces, rot_verts, ray_start_depth=ray_start_depth, near_face_threshold=self.near_face_threshold, v=sub_v)
+        return occ, depth, candidates[intersected_faces.astype(int)]
+
+    def ray_all_depths(self, ray_start, ray_end, return_faces=False):
+        '''
+        Same as rasterization.ray_all_depths, but the ray is given by its start and end point in the mesh frame
+        The returned face indices refer to the full mesh
+        '''
+        sub_faces, rot_verts, candidates, _ = self.candidate_mesh(ray_start, ray_end)
+        if sub_faces.shape[0] == 0:
+            return ([], np.array([], dtype=int)) if return_faces else []
+        result = rasterization.ray_all_depths(sub_faces, rot_verts, near_face_threshold=self.near_face_threshold, ray_start_depth=np.linalg.norm(ray_end-ray_start), return_faces=return_faces)
+        if return_faces:
+            intersections, intersected_faces = result
+            return intersections, candidates[intersected_faces]
+        return result
+
+
+def line_box_overlap(box_min, box_max, origin, direction):
+    '''
+    Returns a boolean array indicating which of the axis aligned boxes are crossed by the infinite line p = origin + t*direction
+    '''
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t1 = (box_min - origin) / direction
+        t2 = (box_max - origin) / direction
+    t_near = np.minimum(t1, t2)
+    t_far = np.maximum(t1, t2)
+    # a line parallel to a slab only crosses the box if it starts within the slab
+    parallel = direction == 0.
+    inside_slab = np.logical_and(box_min <= origin, origin <= box_max)
+    t_near = np.where(parallel, np.where(inside_slab, -np.inf, np.inf), t_near)
+    t_far = np.where(parallel, np.where(inside_slab, np.inf, -np.inf), t_far)
+    return np.max(t_near, axis=-1) <= np.min(t_far, axis=-1)
+
+
+class MeshBVH(RayAccelerator):
+    '''
+    A bounding volume hierarchy over the mesh faces. Nodes are split at the median face centroid along their longest axis.
+    Each node's box is padded by near_face_threshold, so a node is only skipped when none of its faces could survive prune_mesh.
+        leaf_size - the maximum number of faces stored in a leaf
+    '''
+
+    def __init__(self, verts, faces, near_face_threshold=None, leaf_size=8):
+        super().__init__(verts, faces, near_face_threshold=near_face_threshold)
+        self.leaf_size = leaf_size
+        start = time.time()
+        self.build()
+        self.build_time = time.time() - start
+
+    def build(self):
+        '''
+        Builds the hierarchy. Nodes are stored in flat arrays, and the faces of each leaf are a contiguous range of self.face_order
+        '''
+        face_verts = self.verts[self.faces]
+        face_min = np.min(face_verts, axis=1)
+        face_max = np.max(face_verts, axis=1)
+        centroids = np.mean(face_verts, axis=1)
+
+        face_order = np.arange(self.faces.shape[0])
+        node_min = [None]
+        node_max = [None]
+        children = [[-1,-1]]
+        # the faces of node i are face_order[face_ranges[i][0]:face_ranges[i][1]]
+        face_ranges = [[0, self.faces.shape[0]]]
+        stack = [0]
+        while len(stack) > 0:
+            node = stack.pop()
+            first, last = face_ranges[node]
+            node_faces = face_order[first:last]
+            node_min[node] = np.min(face_min[node_faces], axis=0) - self.near_face_threshold
+            node_max[node] = np.max(face_max[node_faces], axis=0) + self.near_face_threshold
+            if last - first <= self.leaf_size:
+                continue
+            node_centroids = centroids[node_faces]
+            axis = np.argmax(np.max(node_centroids, axis=0) - np.min(node_centroids, axis=0))
+            mid = (last - first) // 2
+            split = np.argpartition(node_centroids[:,axis], mid)
+            face_order[first:last] = node_faces[split]
+            for i, child_range in enumerate([[first, first+mid], [first+mid, last]]):
+                children[node][i] = len(face_ranges)
+                stack.append(len(face_ranges))
+                node_min.append(None)
+                node_max.append(None)
+                children.append([-1,-1])
+                face_ranges.append(child_range)
+
+        self.node_min = np.array(node_min)
+        self.node_max = np.array(node_max)
+        self.children = np.array(children, dtype=int)
+        self.face_ranges = np.array(face_ranges, dtype=int)
+        self.face_order = face_order
+        self.n_nodes = self.node_min.shape[0]
+
+    def traverse(self, ray_start, ray_end):
+        '''
+        Returns the indices of the faces in every leaf whose box is crossed by the line through the ray
+        The traversal is done one tree level at a time so that all nodes in a level are tested together
+        '''
+        direction = ray_end - ray_start
+        frontier = np.array([0])
+        leaves = []
+        nodes_visited = 0
+        while frontier.shape[0] > 0:
+            nodes_visited += frontier.shape[0]
+            frontier = frontier[line_box_overlap(self.node_min[frontier], self.node_max[frontier], ray_start, direction)]
+            is_leaf = self.children[frontier, 0] < 0
+            leaves.append(frontier[is_leaf])
+            frontier = self.children[frontier[np.logical_not(is_leaf)]].flatten()
+        leaves = np.concatenate(leaves)
+        candidates = np.concatenate([self.face_order[first:last] for first, last in self.face_ranges[leaves]]) if leaves.shape[0] > 0 else np.array([], dtype=int)
+        self.record_query(nodes_visited=nodes_visited, leaves_visited=leaves.shape[0], candidate_faces=candidates.shape[0])
+        return candidates
+
+
+class UniformGrid(RayAccelerator):
+    '''
+    A uniform grid over the bounding sphere. Each face is stored in every cell overlapped by its box (padded by near_face_threshold),
+    and a query walks only the cells crossed by the line through the ray (3D-DDA). This works best on evenly tessellated meshes.
+        radius     - the radius of the bounding sphere that the grid should cover (the grid grows if the padded mesh extends further)
+        resolution - the number of cells along each axis. If None, it is chosen so that each cell is about as wide as near_face_threshold
+    '''
+
+    def __init__(self, verts, faces, near_face_threshold=None, radius=1.25, resolution=None, max_resolution=128):
+        super().__init__(verts, faces, near_face_threshold=near_face_threshold)
+        face_verts = self.verts[self.faces]
+        self.face_min = np.min(face_verts, axis=1) - self.near_face_threshold
+        self.face_max = np.max(face_verts, axis=1) + self.near_face_threshold
+        self.grid_min = np.minimum(np.min(self.face_min, axis=0), -radius)
+        self.grid_max = np.maximum(np.max(self.face_max, axis=0), radius)
+        if resolution is None:
+            resolution = int(np.clip(np.ceil(np.max(self.grid_max - self.grid_min) / self.near_face_threshold), 1, max_resolution))
+        self.resolution = resolution
+        self.cell_size = (self.grid_max - self.grid_min) / resolution
+        start = time.time()
+        self.build()
+        self.build_time = time.time() - start
+
+    def cell_coordinates(self, points):
+        '''
+        Returns the integer (i,j,k) cell coordinates of the points, clamped to the grid
+        '''
+        return np.clip(np.floor((points - self.grid_min) / self.cell_size).astype(int), 0, self.resolution-1)
+
+    def build(self):
+        '''
+        Buckets the faces into cells. Cell c holds self.cell_faces[self.cell_starts[c]:self.cell_starts[c+1]]
+        '''
+        lower = self.cell_coordinates(self.face_min)
+        upper = self.cell_coordinates(self.face_max)
+        extent = upper - lower + 1
+        cells_per_face = np.prod(extent, axis=1)
+        # enumerate the (i,j,k) offsets of every cell in every face's range
+        face_ids = np.repeat(np.arange(self.faces.shape[0]), cells_per_face)
+        local = np.arange(face_ids.shape[0]) - np.repeat(np.cumsum(cells_per_face) - cells_per_face, cells_per_face)
+        ext = extent[face_ids]
+        offsets = np.stack([local // (ext[:,1]*ext[:,2]), (local // ext[:,2]) % ext[:,1], local % ext[:,2]], axis=1)
+        cells = self.flat_index(lower[face_ids] + offsets)
+
+        order = np.argsort(cells, kind="stable")
+        self.cell_faces = face_ids[order]
+        counts = np.bincount(cells, minlength=self.resolution**3)
+        self.cell_starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def flat_index(self, ijk):
+        return (ijk[:,0] * self.resolution + ijk[:,1]) * self.resolution + ijk[:,2]
+
+    def walk(self, origin, direction):
+        '''
+        Returns the flat indices of the cells crossed by the infinite line p = origin + t*direction
+        Rather than stepping one cell at a time, every cell boundary crossing is found at once and the line is sampled between crossings
+        '''
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = (self.grid_min - origin) / direction
+            t2 = (self.grid_max - origin) / direction
+        parallel = direction == 0.
+        inside_slab = np.logical_and(self.grid_min <= origin, origin <= self.grid_max)
+        if np.any(np.logical_and(parallel, np.logical_not(inside_slab))):
+            return np.array([], dtype=int)
+        t_enter = np.max(np.where(parallel, -np.inf, np.minimum(t1, t2)))
+        t_exit = np.min(np.where(parallel, np.inf, np.maximum(t1, t2)))
+        if t_enter > t_exit:
+            return np.array([], dtype=int)
+
+        crossings = [np.array([t_enter, t_exit])]
+        for axis in range(3):
+            if parallel[axis]:
+                continue
+            planes = self.grid_min[axis] + self.cell_size[axis] * np.arange(1, self.resolution)
+            t_planes = (planes - origin[axis]) / direction[axis]
+            crossings.append(t_planes[np.logical_and(t_planes > t_enter, t_planes < t_exit)])
+        crossings = np.sort(np.concatenate(crossings))
+        midpoints = (crossings[:-1] + crossings[1:]) / 2.
+        cells = self.flat_index(self.cell_coordinates(origin + midpoints[:,np.newaxis] * direction))
+        # the boundary crossings themselves are included so that lines passing exactly through a cell corner don't skip a cell
+        cells = np.concatenate([cells, self.flat_index(self.cell_coordinates(origin + crossings[:,np.newaxis] * direction))])
+        return np.unique(cells)
+
+    def traverse(self, ray_start, ray_end):
+        '''
+        Returns the indices of the faces stored in the cells crossed by the line through the ray
+        '''
+        cells = self.walk(ray_start, ray_end - ray_start)
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells+1] - starts
+        face_slots = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(np.sum(counts))
+        candidates = np.unique(self.cell_faces[face_slots])
+        self.record_query(cells_visited=cells.shape[0], candidate_faces=candidates.shape[0])
+        return candidates
+
+
+BACKENDS = ["brute", "bvh", "grid"]
+
+def make_accelerator(backend, verts, faces, near_face_threshold=None, radius=1.25):
+    '''
+    Returns the acceleration structure for the given ground truth backend, or None for the brute force halfspace test
+    '''
+    assert(backend in BACKENDS)
+    if backend == "bvh":
+        return MeshBVH(verts, faces, near_face_threshold=near_face_threshold)
+    if backend == "grid":
+        return UniformGrid(verts, faces, near_face_threshold=near_face_threshold, radius=radius)
+    return None
@@ -8,10 +8,63 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Button
 import torch
 import os
+import json
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
 
 import odf_utils
 import rasterization
+import acceleration
+from mesh_geometry import MeshGeometry
 
+# The learned models are queried in chunks of at most this many rays, so memory use doesn't grow with the image resolution
+RAYS_PER_CHUNK = 32768
+# Bump this when the ground truth rendering changes so that images cached by DepthMapCache are recomputed
+DEPTH_CACHE_VERSION = 1
+# The brute force mesh renderer culls faces for square tiles of this many pixels on a side before intersecting them with the tile's rays
+TILE_SIZE = 16
+
+def as_ray_arrays(rays):
+    '''
+    Returns the (origins, directions, valid) arrays used by the Camera render functions.
+    rays is either already such a tuple, or a list of [start point, end point] rays with None for rays that don't exist
+    '''
+    if isinstance(rays, tuple):
+        return rays
+    valid = np.array([ray is not None for ray in rays], dtype=bool)
+    origins = np.zeros((len(rays),3))
+    directions = np.zeros((len(rays),3))
+    if np.any(valid):
+        origins[valid] = np.array([ray[0] for ray in rays if ray is not None])
+        directions[valid] = np.array([ray[1] for ray in rays if ray is not None]) - origins[valid]
+    return origins, directions, valid
+
+
+def query_model_4D(model, origins, directions, valid, rays_per_chunk=RAYS_PER_CHUNK):
+    '''
+    Queries a 4D model along the valid rays, rays_per_chunk rays at a time. The rays can come from any number of cameras
+    Returns the number of intersections and the first depth of every ray (0 and np.inf for invalid rays)
+    '''
+    model=model.eval()
+    n_intersections = np.zeros((origins.shape[0],))
+    depth = np.ones((origins.shape[0],)) * np.inf
+    ray_inds = np.flatnonzero(valid)
+    n_rays = min(rays_per_chunk, ray_inds.shape[0])
+    if n_rays > 0:
+        start_points = torch.empty((n_rays, 3), dtype=torch.float32)
+        ray_directions = torch.empty((n_rays, 3), dtype=torch.float32)
+        with torch.inference_mode():
+            for start in range(0, ray_inds.shape[0], rays_per_chunk):
+                chunk = ray_inds[start:start+rays_per_chunk]
+                n = chunk.shape[0]
+                start_points[:n].copy_(torch.from_numpy(origins[chunk]))
+                ray_directions[:n].copy_(torch.from_numpy(directions[chunk]))
+                # pass in surface point, direction
+                _, model_depths, n_ints = model.query_rays(start_points[:n], ray_directions[:n])
+                n_intersections[chunk] = n_ints.cpu().numpy()
+                depth[chunk] = torch.min(model_depths.cpu(), dim=1)[0].numpy()
+    return n_intersections, depth
 
 class Camera():
     '''
@@ -21,11 +74,20 @@ class Camera():
         focal_length      - the focal length of the camera
         sensor_size       - the dimensions of the sensor (u,v)
         sensor_resolution - The number of pixels on each edge of the sensor (u,v)
+        backend           - how rays are cast against a mesh (see acceleration.BACKENDS). 'brute' tests every ray against every face in batches
+        rays_per_chunk    - the maximum number of rays passed through a learned model at once
+        tile_size         - the side length (in pixels) of the tiles that mesh_depthmap and mesh_alldepths cull faces for with the 'brute' backend. 0 intersects every ray with the whole mesh
     '''
 
-    def __init__(self, center=[1.,1.,1.], direction=[-1.,-1.,-1.], focal_length=1.0, sensor_size=[1.,1.], sensor_resolution=[100,100], verbose=True):
+    def __init__(self, center=[1.,1.,1.], direction=[-1.,-1.,-1.], focal_length=1.0, sensor_size=[1.,1.], sensor_resolution=[100,100], verbose=True, backend="brute", rays_per_chunk=RAYS_PER_CHUNK, tile_size=TILE_SIZE):
         super().__init__()
+        assert(tile_size >= 0)
+        self.tile_size = tile_size
+        assert(rays_per_chunk > 0)
+        self.rays_per_chunk = rays_per_chunk
+        assert(backend in acceleration.BACKENDS)
         self.verbose = verbose
+        self.backend = backend
         self.center = np.array(center)
         assert(np.linalg.norm(direction) != 0.)
         self.direction = np.array(direction) / np.linalg.norm(direction)
@@ -36,10 +98,12 @@ class Camera():
     def change_resolution(self, resolution):
         self.sensor_resolution = resolution
 
-    def generate_rays(self):
+    def generate_ray_arrays(self):
         '''
-        Returns a list of rays ( [start point, end point] ), where each ray intersects one pixel. The start point of each ray is the camera center.
-        Rays are returned top to bottom, left to right.
+        Returns the rays through every pixel as arrays, top to bottom, left to right
+            origins    - (H*W,3) ray start points (the camera center)
+            directions - (H*W,3) vectors from the camera center to each pixel on the image plane (not normalized)
+            valid      - (H*W,) mask of rays that exist (always all True here, see clip_rays_to_sphere)
         '''
         if self.direction[0] == 0. and self.direction[2] == 0.:
             u_direction = np.array([1.,0.,0.])
@@ -56,121 +120,272 @@ class Camera():
         us, vs = np.meshgrid(u_steps, v_steps)
         us = us.flatten()
         vs = vs.flatten()
-        rays = [[np.array(self.center), np.array(self.center + self.focal_length * self.direction + us[i]*u_direction) + vs[i]*v_direction] for i in range(us.shape[0])]
-        return rays
+        ends = (self.center + self.focal_length * self.direction)[None,:] + us[:,None]*u_direction[None,:] + vs[:,None]*v_direction[None,:]
+        origins = np.tile(self.center.astype(float), (us.shape[0], 1))
+        return origins, ends - origins, np.ones(us.shape[0], dtype=bool)
+
+    def clip_rays_to_sphere(self, origins, directions, valid, radius):
+        '''
+        Batched version of rays_on_sphere. Moves each ray origin that lies outside the origin-centered sphere with the provided
+        radius to the ray's first intersection with the sphere. Directions are unchanged
+        Returns origins, directions, and the mask of valid rays (rays that miss the sphere are invalid)
+        '''
+        valid = valid.copy()
+        origins = origins.copy()
+        outside = np.logical_and(valid, np.linalg.norm(origins, axis=1) > radius)
+        if np.any(outside):
+            first_intersections, _ = odf_utils.get_sphere_intersections_batch(origins[outside], directions[outside], radius)
+            origins[outside] = first_intersections
+            valid[outside] = np.logical_not(np.any(np.isnan(first_intersections), axis=1))
+        origins[np.logical_not(valid)] = 0.
+        return origins, directions, valid
+
+    def generate_rays(self):
+        '''
+        Returns a list of rays ( [start point, end point] ), where each ray intersects one pixel. The start point of each ray is the camera center.
+        Rays are returned top to bottom, left to right.
+        Prefer generate_ray_arrays, which avoids building a list
+        '''
+        origins, directions, _ = self.generate_ray_arrays()
+        return [[origins[i], origins[i] + directions[i]] for i in range(origins.shape[0])]
 
     def rays_on_sphere(self, rays, radius):
         '''
         Calls generate_rays, but then reformulates each ray so that it starts on the surface of an origin-centered sphere with the provided radius. 
         Provides rays in the form of [start_point, end_point]
         Rays that don't intersect the sphere take the value None
+        Prefer clip_rays_to_sphere, which works on arrays
         '''
-        first_elt_if_not_none = lambda x: x[0] if x is not None else None
-        sphere_surface_rays = [first_elt_if_not_none(odf_utils.get_sphere_intersections(ray[0], ray[1] - ray[0], radius)) if np.linalg.norm(ray[0]) > radius else ray[0] for ray in rays]
-        sphere_surface_rays = [[x, x+rays[i][1]-rays[i][0]] if x is not None else None for i,x in enumerate(sphere_surface_rays)]
-        # intersection_mask = [1. if intersect is not None else 0. for intersect in intersections]
-        return sphere_surface_rays
+        origins, directions, valid = self.clip_rays_to_sphere(*as_ray_arrays(rays), radius)
+        return [[origins[i], origins[i] + directions[i]] if valid[i] else None for i in range(origins.shape[0])]
 
     def mesh_depthmap(self, rays, verts, faces):
         '''
         Returns an intersection map and a depthmap of a mesh from the camera's perspective
+        rays are the (origins, directions, valid) arrays from clip_rays_to_sphere (lists of [start, end] or None are also accepted)
         Rays that don't intersect the mesh are given depth np.inf
         '''
-        near_face_threshold = rasterization.max_edge(verts, faces)
-        depth = np.array([rasterization.ray_occ_depth(faces, rasterization.rotate_mesh(verts, ray[0], ray[1]), ray_start_depth=np.linalg.norm(ray[1]-ray[0]), near_face_threshold=near_face_threshold)[1] if ray is not None else np.inf for ray in (tqdm(rays) if self.verbose else rays)])
+        origins, directions, rays_in_scene_mask = as_ray_arrays(rays)
+        depth = np.ones((origins.shape[0],)) * np.inf
+        if np.any(rays_in_scene_mask):
+            starts = origins[rays_in_scene_mask]
+            ends = starts + directions[rays_in_scene_mask]
+            if self.backend == "brute" and self.tile_size > 0:
+                _, depth = self.tiled_alldepths(origins, directions, rays_in_scene_mask, verts, faces)
+            elif self.backend == "brute":
+                _, depth[rays_in_scene_mask] = rasterization.ray_occ_depth_batch(faces, verts, starts, ends-starts, verbose=self.verbose)
+            else:
+                accelerator = acceleration.make_accelerator(self.backend, verts, faces)
+                ray_inds = range(starts.shape[0])
+                depth[rays_in_scene_mask] = [accelerator.ray_occ_depth(starts[i], ends[i])[1] for i in (tqdm(ray_inds) if self.verbose else ray_inds)]
         depth = np.reshape(depth, tuple(self.sensor_resolution))
-        intersection_mask = (depth < np.inf).astype(np.float)
+        intersection_mask = (depth < np.inf).astype(float)
         return np.array(intersection_mask), np.array(depth)
 
     def mesh_alldepths(self, rays, verts, faces):
         '''
         Returns a map of the number of mesh intersections as well as the depth from the camera's perspective
+        rays are the (origins, directions, valid) arrays from clip_rays_to_sphere (lists of [start, end] or None are also accepted)
         Rays that don't intersect the mesh are given depth np.inf
         '''
-        near_face_threshold = rasterization.max_edge(verts, faces)
-        all_depths = [rasterization.ray_all_depths(faces, rasterization.rotate_mesh(verts, ray[0], ray[1]), near_face_threshold=near_face_threshold, ray_start_depth=np.linalg.norm(ray[1]-ray[0]), return_faces=False) if ray is not None else [] for ray in (tqdm(rays) if self.verbose else rays)]
-        n_ints = np.reshape(np.array([len(depths) for depths in all_depths]), tuple(self.sensor_resolution))
-        first_depth = np.reshape(np.array([depths[0] if len(depths) > 0 else np.inf for depths in all_depths]), tuple(self.sensor_resolution))
+        origins, directions, rays_in_scene_mask = as_ray_arrays(rays)
+        n_ints = np.zeros((origins.shape[0],), dtype=int)
+        first_depth = np.ones((origins.shape[0],)) * np.inf
+        if np.any(rays_in_scene_mask):
+            starts = origins[rays_in_scene_mask]
+            ends = starts + directions[rays_in_scene_mask]
+            if self.backend == "brute" and self.tile_size > 0:
+                n_ints, first_depth = self.tiled_alldepths(origins, directions, rays_in_scene_mask, verts, faces)
+            elif self.backend == "brute":
+                depths, n_ints[rays_in_scene_mask] = rasterization.ray_all_depths_batch(faces, verts, starts, ends-starts, max_hits=1, verbose=self.verbose)
+                first_depth[rays_in_scene_mask] = depths[:,0]
+            else:
+                accelerator = acceleration.make_accelerator(self.backend, verts, faces)
+                ray_inds = range(starts.shape[0])
+                all_depths = [accelerator.ray_all_depths(starts[i], ends[i]) for i in (tqdm(ray_inds) if self.verbose else ray_inds)]
+                n_ints[rays_in_scene_mask] = [len(depths) for depths in all_depths]
+                first_depth[rays_in_scene_mask] = [depths[0] if len(depths) > 0 else np.inf for depths in all_depths]
+        n_ints = np.reshape(n_ints, tuple(self.sensor_resolution))
+        first_depth = np.reshape(first_depth, tuple(self.sensor_resolution))
+        return n_ints, first_depth
+
+    def tiled_alldepths(self, origins, directions, rays_in_scene_mask, verts, faces):
+        '''
+        Tile renderer used by mesh_depthmap and mesh_alldepths. The rays of each tile_size x tile_size block of pixels leave the camera center within the
+        cone spanned by the tile's corner rays, so the faces outside that cone are culled once per tile (see rasterization.cone_cull)
+        and only the remaining faces are intersected with the tile's rays. The rays must come from generate_ray_arrays
+        Returns the number of intersections and the first depth for every ray (flattened)
+        '''
+        face_data = rasterization.get_face_data(faces, verts)
+        n_ints = np.zeros((origins.shape[0],), dtype=int)
+        first_depth = np.ones((origins.shape[0],)) * np.inf
+        # generate_ray_arrays orders the pixels by v, then u
+        pixels = np.arange(origins.shape[0]).reshape((self.sensor_resolution[1], self.sensor_resolution[0]))
+        tile_starts = [(row, col) for row in range(0, pixels.shape[0], self.tile_size) for col in range(0, pixels.shape[1], self.tile_size)]
+        for row, col in (tqdm(tile_starts) if self.verbose else tile_starts):
+            tile = pixels[row:row+self.tile_size, col:col+self.tile_size]
+            ray_inds = tile.flatten()[rays_in_scene_mask[tile.flatten()]]
+            if ray_inds.shape[0] == 0:
+                continue
+            # the cone only bounds the rays if they start on or in front of the camera center (e.g. not when clipped from behind it)
+            if np.all(np.sum((origins[ray_inds] - self.center) * directions[ray_inds], axis=1) >= 0.):
+                corners = directions[[tile[0,0], tile[0,-1], tile[-1,-1], tile[-1,0]]]
+                tile_faces = np.flatnonzero(rasterization.cone_cull(verts, faces, self.center, corners))
+            else:
+                tile_faces = np.arange(faces.shape[0])
+            if tile_faces.shape[0] == 0:
+                continue
+            depths, n_ints[ray_inds] = rasterization.ray_all_depths_batch(faces[tile_faces], verts, origins[ray_inds], directions[ray_inds], max_hits=1, face_data=rasterization.subset_face_data(face_data, tile_faces))
+            first_depth[ray_inds] = depths[:,0]
         return n_ints, first_depth
 
+    def ray_chunks(self, rays_in_scene_mask):
+        '''
+        Yields the indices of the rays in the scene, rays_per_chunk at a time
+        '''
+        ray_inds = np.flatnonzero(rays_in_scene_mask)
+        for start in range(0, ray_inds.shape[0], self.rays_per_chunk):
+            yield ray_inds[start:start+self.rays_per_chunk]
+
     def model_depthmap(self, rays, model):
         '''
         Returns an intersection map and a depthmap from a learned model from the camera's perspective
+        rays are the (origins, directions, valid) arrays from clip_rays_to_sphere (lists of [start, end] or None are also accepted)
+        The model is queried rays_per_chunk rays at a time, reusing the same encoding and input buffers for every chunk
         '''
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         model=model.eval()
-        rays_in_scene_mask = np.array([True if ray != None else False for ray in rays])
-        # rays_in_scene = torch.tensor([list(ray[0]) + list(ray[1]-ray[0]) for ray in rays if ray != None])
-        rays_in_scene = [ray for ray in rays if ray != None]
-        if len(rays_in_scene) > 0:
-            with torch.no_grad():
-                encoded_rays = torch.tensor([[x for val in list(ray[0]) + list((ray[1]-ray[0])/np.linalg.norm(ray[1]-ray[0])) for x in odf_utils.positional_encoding(val)] for ray in rays_in_scene]).to(device)
-                _, intersect, depth = model(encoded_rays)
-                intersect = intersect.cpu()
-                model_depths = depth.cpu()
-            intersection_mask = rays_in_scene_mask.astype(float)
-            intersection_mask[rays_in_scene_mask] = intersect
-            intersection_mask = intersection_mask.reshape(self.sensor_resolution)
-            depth = np.zeros((len(rays),))
-            depth[np.logical_not(rays_in_scene_mask)] = np.inf
-            depth[rays_in_scene_mask] = model_depths
-            depth = depth.reshape((self.sensor_resolution))
-        else:
-            intersection_mask = np.zeros(self.sensor_resolution)
-            depth = np.ones(self.sensor_resolution) * np.inf
+        origins, directions, rays_in_scene_mask = as_ray_arrays(rays)
+        intersection_mask = np.zeros((origins.shape[0],))
+        depth = np.ones((origins.shape[0],)) * np.inf
+        n_rays = min(self.rays_per_chunk, int(np.sum(rays_in_scene_mask)))
+        if n_rays > 0:
+            coordinates = np.empty((n_rays, 6))
+            encoding = np.empty((n_rays, 6*2*10))
+            encoded_rays = torch.empty((n_rays, 6*2*10), dtype=torch.float32, device=device)
+            with torch.inference_mode():
+                for chunk in self.ray_chunks(rays_in_scene_mask):
+                    n = chunk.shape[0]
+                    coordinates[:n,:3] = origins[chunk]
+                    coordinates[:n,3:] = directions[chunk] / np.linalg.norm(directions[chunk], axis=1)[:,None]
+                    odf_utils.positional_encoding_batch(coordinates[:n], out=encoding[:n])
+                    encoded_rays[:n].copy_(torch.from_numpy(encoding[:n]))
+                    _, intersect, model_depths = model(encoded_rays[:n])
+                    intersection_mask[chunk] = intersect.cpu().numpy()
+                    depth[chunk] = model_depths.cpu().numpy()
+        intersection_mask = intersection_mask.reshape(self.sensor_resolution)
+        depth = depth.reshape(self.sensor_resolution)
         return np.array(intersection_mask > 0.5), np.array(depth)
 
     def model_depthmap_4D(self, rays, model):
         '''
         Returns an intersection map and a depthmap from a learned model from the camera's perspective
+        rays are the (origins, directions, valid) arrays from clip_rays_to_sphere (lists of [start, end] or None are also accepted)
+        The model is queried rays_per_chunk rays at a time and the results are written straight into the output images
         '''
-        # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model=model.eval()
-        rays_in_scene_mask = np.array([True if ray != None else False for ray in rays])
-        rays_in_scene = torch.tensor([list(ray[0]) + list(ray[1]-ray[0]) for ray in rays if ray != None])
-        # print(rays_in_scene)
-        if len(rays_in_scene) > 0:
-            with torch.no_grad():
-                # pass in surface point, direction
-                _, depth, n_ints = model.query_rays(rays_in_scene[:,:3], rays_in_scene[:,3:])
-                n_ints = n_ints.cpu()
-                model_depths = depth.cpu()
-                model_depths = torch.min(model_depths, dim=1)[0]
-            n_intersections = rays_in_scene_mask.astype(float)
-            n_intersections[rays_in_scene_mask] = n_ints
-            n_intersections = n_intersections.reshape(self.sensor_resolution)
-            depth = np.zeros((len(rays),))
-            depth[np.logical_not(rays_in_scene_mask)] = np.inf
-            depth[rays_in_scene_mask] = model_depths
-            depth = depth.reshape((self.sensor_resolution))
-        else:
-            n_intersections = np.zeros(self.sensor_resolution)
-            depth = np.ones(self.sensor_resolution) * np.inf
+        n_intersections, depth = query_model_4D(model, *as_ray_arrays(rays), self.rays_per_chunk)
+        n_intersections = n_intersections.reshape(self.sensor_resolution)
+        depth = depth.reshape(self.sensor_resolution)
         return n_intersections, np.array(depth)
-        
-    def mesh_and_model_depthmap(self, model, verts, faces, radius, show_rays=False, fourd=False):
+
+    def mesh_and_model_depthmap(self, model, verts, faces, radius, show_rays=False, fourd=False, gt_cache=None):
         '''
         Convenience function that also allows us to generate rays only once for both depthmap generations
         Returns depthmaps and intersections for the mesh and the learned model
+        gt_cache is an optional DepthMapCache for verts and faces. The mesh is only rendered if the image isn't in the cache yet
         '''
-        rays = self.rays_on_sphere(self.generate_rays(), radius)
+        origins, directions, valid = self.clip_rays_to_sphere(*self.generate_ray_arrays(), radius)
+        rays = (origins, directions, valid)
         if show_rays:
             import visualization
             visualizer = visualization.RayVisualizer(verts, np.vstack([faces[:,:2], faces[:,1:], faces[:,[0,2]]]))
-            defined_rays= [ray for ray in rays if ray is not None]
-            for ray in defined_rays:
-                visualizer.add_point(ray[0], [1.,0.,0.])
-                visualizer.add_ray(ray, [0.,0.,1.])
+            for start, direction in zip(origins[valid], directions[valid]):
+                visualizer.add_point(start, [1.,0.,0.])
+                visualizer.add_ray([start, start + direction], [0.,0.,1.])
             visualizer.display()
         if not fourd:
-            mesh_int_mask, mesh_depth = self.mesh_depthmap(rays, verts, faces)
+            mesh_int_mask, mesh_depth = self.cached_mesh_render(gt_cache, radius, "depthmap", lambda: self.mesh_depthmap(rays, verts, faces))
             model_int_mask, model_depth = self.model_depthmap(rays, model)
             return np.array(mesh_int_mask), np.array(mesh_depth), np.array(model_int_mask), np.array(model_depth)
         else:
-            mesh_n_ints, mesh_depths = self.mesh_alldepths(rays, verts, faces)
+            mesh_n_ints, mesh_depths = self.cached_mesh_render(gt_cache, radius, "alldepths", lambda: self.mesh_alldepths(rays, verts, faces))
             model_n_ints, model_depth = self.model_depthmap_4D(rays, model)
             return np.array(mesh_n_ints), np.array(mesh_depths), np.array(model_n_ints), np.array(model_depth)
 
+    def cached_mesh_render(self, gt_cache, radius, kind, render):
+        '''
+        Returns the images from gt_cache if they are there, otherwise calls render() and stores its result
+        kind names the render function (see DepthMapCache.key)
+        '''
+        if gt_cache is None:
+            return render()
+        images = gt_cache.load(self, radius, kind)
+        if images is None:
+            images = render()
+            gt_cache.save(self, radius, kind, images)
+        return images
+
+
+class DepthMapCache():
+    '''
+    An on-disk cache of ground truth images, so that repeated evaluations (e.g. of every checkpoint in a training run) only query the model.
+    Each image pair is stored in its own .npz file named by a hash of everything that determines it
+        cache_dir - the directory holding the cached images
+        verts     - the mesh vertices
+        faces     - the mesh faces
+        mesh_hash - identifies the mesh. Defaults to a hash of verts and faces, so that differently normalized copies of a mesh file don't collide
+    '''
+
+    def __init__(self, cache_dir, verts=None, faces=None, mesh_hash=None):
+        super().__init__()
+        assert(mesh_hash is not None or (verts is not None and faces is not None))
+        self.cache_dir = cache_dir
+        self.mesh_hash = mesh_hash if mesh_hash is not None else MeshGeometry(verts, faces).identifier()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, cam, radius, kind):
+        '''
+        Returns the hash of the mesh, camera pose, intrinsics, resolution, and radius that identifies an image pair
+        kind is "depthmap" (intersection mask and depth from mesh_depthmap) or "alldepths" (intersection count and first depth from mesh_alldepths)
+        '''
+        description = {
+            "version": DEPTH_CACHE_VERSION,
+            "kind": kind,
+            "mesh": self.mesh_hash,
+            "center": [float(x) for x in cam.center],
+            "direction": [float(x) for x in cam.direction],
+            "focal_length": float(cam.focal_length),
+            "sensor_size": [float(x) for x in cam.sensor_size],
+            "sensor_resolution": [int(x) for x in cam.sensor_resolution],
+            "radius": float(radius),
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def path(self, cam, radius, kind):
+        return os.path.join(self.cache_dir, f"{kind}_{self.key(cam, radius, kind)}.npz")
+
+    def load(self, cam, radius, kind="alldepths"):
+        '''
+        Returns the cached (intersections, depths) images, or None if they haven't been rendered yet
+        '''
+        path = self.path(cam, radius, kind)
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        return data["intersections"], data["depths"]
+
+    def save(self, cam, radius, kind, images):
+        '''
+        Stores the (intersections, depths) images. The file is written under a temporary name and then moved into place,
+        so that concurrent or interrupted renders never leave a partial file behind
+        '''
+        intersections, depths = images
+        path = self.path(cam, radius, kind)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, intersections=np.array(intersections), depths=np.array(depths))
+        os.replace(tmp_path, path)
+
 
 class DepthMapViewer():
     '''
@@ -274,15 +489,10 @@ def save_video(rendered_views, save_path, vmin, vmax):
                                    interval=50)
     depthmap_ani.save(save_path, writer=writer)
 
-def save_video_4D(rendered_views, save_path, vmin, vmax):
+def video_4D_figure():
     '''
-    Similar to save video except that it handles showing the # of intersections and the error in the # of intersections
+    Returns the figure and the axes that the 4D videos are drawn on
     '''
-    import matplotlib
-    matplotlib.use("Agg")
-    import matplotlib.animation as animation
-
-    n_frames = len(rendered_views)
     f = plt.figure(constrained_layout=True)
     f.set_size_inches(21.3,12.)
     gs = f.add_gridspec(nrows=2,ncols=5)
@@ -294,24 +504,128 @@ def save_video_4D(rendered_views, save_path, vmin, vmax):
     ax6 = f.add_subplot(gs[1,2])
     ax7 = f.add_subplot(gs[:,3:])
     all_axes = [ax1,ax2,ax3,ax4, ax5, ax6, ax7]
+    return f, all_axes
 
-    # find the maximum number of intersections for consistent scaling
-    max_n_ints = max([max(np.max(gt_n_ints), np.max(learned_n_ints)) for gt_n_ints, _, learned_n_ints, _ in rendered_views])
+def save_video_4D(rendered_views, save_path, vmin, vmax):
+    '''
+    Similar to save video except that it handles showing the # of intersections and the error in the # of intersections
+    '''
+    save_video_4D_stream(rendered_views, save_path, vmin, vmax, scale_frames=None)
 
-    # display first view
-    gt_n_ints, gt_depth, learned_n_ints, learned_depth = rendered_views[0]
-    odf_utils.show_depth_data_4D(gt_n_ints, gt_depth, learned_n_ints, learned_depth, all_axes, vmin, vmax, max_n_ints)
+def save_video_4D_stream(frames, save_path, vmin, vmax, max_n_ints=None, scale_frames=8, writer=None):
+    '''
+    Same as save_video_4D, but frames can be any iterable (e.g. the render_frames_4D generator) and each frame is written
+    as soon as it arrives.
+        max_n_ints   - fixes the intersection count color scale. If None, it is the largest count in the first scale_frames frames,
+                       which are held back until the scale is known (scale_frames=None holds back every frame, like save_video_4D)
+        writer       - defaults to the same ffmpeg writer as the other videos
+    '''
+    import itertools
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.animation as animation
+
+    frames = iter(frames)
+    held_frames = []
+    if max_n_ints is None:
+        held_frames = list(frames if scale_frames is None else itertools.islice(frames, scale_frames))
+        # find the maximum number of intersections for consistent scaling
+        max_n_ints = max([max(np.max(gt_n_ints), np.max(learned_n_ints)) for gt_n_ints, _, learned_n_ints, _ in held_frames], default=1)
+
+    f, all_axes = video_4D_figure()
 
     # Set up formatting for movie files
-    Writer = animation.writers['ffmpeg']
-    writer = Writer(fps=10, metadata=dict(artist="Trevor Houchens"), bitrate=1800)
+    if writer is None:
+        Writer = animation.writers['ffmpeg']
+        writer = Writer(fps=10, metadata=dict(artist="Trevor Houchens"), bitrate=1800)
 
-    def update_depthmap(num, views, axes):
-        for ax in axes:
-            ax.clear()
-        gt_n_ints, gt_depth, learned_n_ints, learned_depth = rendered_views[num]
-        odf_utils.show_depth_data_4D(gt_n_ints, gt_depth, learned_n_ints, learned_depth, all_axes, vmin, vmax, max_n_ints)
+    largest_n_ints = max_n_ints
+    with writer.saving(f, save_path, f.dpi):
+        for gt_n_ints, gt_depth, learned_n_ints, learned_depth in itertools.chain(held_frames, frames):
+            largest_n_ints = max(largest_n_ints, np.max(gt_n_ints), np.max(learned_n_ints))
+            odf_utils.show_depth_data_4D(gt_n_ints, gt_depth, learned_n_ints, learned_depth, all_axes, vmin, vmax, max_n_ints)
+            writer.grab_frame()
+    plt.close(f)
+    if largest_n_ints > max_n_ints:
+        print(f"Warning: later frames have up to {largest_n_ints:.0f} intersections, so the intersection count colors are clipped at {max_n_ints:.0f}")
 
-    depthmap_ani = animation.FuncAnimation(f, update_depthmap, n_frames, fargs=(rendered_views, all_axes),
-                                   interval=50)
-    depthmap_ani.save(save_path, writer=writer)
\ No newline at end of file
+
+# The process pool workers that render the ground truth frames attach to the mesh through these shared memory blocks
+_shared_mesh = {}
+
+def _attach_shared_mesh(verts_spec, faces_spec):
+    '''
+    Pool initializer. Each spec is the (shared memory name, shape, dtype) of an array created by share_array
+    '''
+    for key, (name, shape, dtype) in [("verts", verts_spec), ("faces", faces_spec)]:
+        # The block is created (and unlinked) by the parent, whose resource tracker the pool processes share
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_mesh[key + "_shm"] = shm
+        _shared_mesh[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _render_mesh_frame_4D(args):
+    '''
+    Pool task that renders the ground truth intersection counts and depths for one camera from the shared mesh
+    '''
+    cam, radius = args
+    rays = cam.clip_rays_to_sphere(*cam.generate_ray_arrays(), radius)
+    return cam.mesh_alldepths(rays, _shared_mesh["verts"], _shared_mesh["faces"])
+
+def share_array(arr):
+    '''
+    Copies arr into a new shared memory block
+    Returns the block and the (name, shape, dtype) spec used to attach to it from another process
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype)
+
+def render_frames_4D(cameras, model, verts, faces, radius, n_workers=None, frames_per_batch=8, gt_cache=None):
+    '''
+    Yields (gt_n_ints, gt_depth, learned_n_ints, learned_depth) for each camera in order, like mesh_and_model_depthmap with fourd=True
+        n_workers        - the number of processes rendering ground truth frames from a shared copy of the mesh. Defaults to the number of cores, 0 renders them in this process
+        frames_per_batch - the rays of this many cameras are put through the model together, so that the model calls stay large
+        gt_cache         - an optional DepthMapCache for verts and faces. Only the frames missing from it are rendered, and they are added to it
+    The model runs in this process while the pool renders the ground truth frames ahead of it
+    '''
+    cached_frames = [gt_cache.load(cam, radius, "alldepths") if gt_cache is not None else None for cam in cameras]
+    uncached_cameras = [cam for cam, frame in zip(cameras, cached_frames) if frame is None]
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if len(uncached_cameras) == 0:
+        n_workers = 0
+    verts = np.ascontiguousarray(verts, dtype=float)
+    faces = np.ascontiguousarray(faces, dtype=int)
+    blocks = []
+    pool = None
+    try:
+        if n_workers > 0:
+            verts_shm, verts_spec = share_array(verts)
+            blocks.append(verts_shm)
+            faces_shm, faces_spec = share_array(faces)
+            blocks.append(faces_shm)
+            pool = multiprocessing.Pool(n_workers, initializer=_attach_shared_mesh, initargs=(verts_spec, faces_spec))
+            gt_frames = pool.imap(_render_mesh_frame_4D, [(cam, radius) for cam in uncached_cameras])
+        else:
+            gt_frames = (cam.mesh_alldepths(cam.clip_rays_to_sphere(*cam.generate_ray_arrays(), radius), verts, faces) for cam in uncached_cameras)
+
+        for batch_start in range(0, len(cameras), frames_per_batch):
+            batch = cameras[batch_start:batch_start+frames_per_batch]
+            rays = [cam.clip_rays_to_sphere(*cam.generate_ray_arrays(), radius) for cam in batch]
+            n_intersections, depth = query_model_4D(model, *[np.concatenate(arrays) for arrays in zip(*rays)], batch[0].rays_per_chunk)
+            splits = np.cumsum([ray_arrays[0].shape[0] for ray_arrays in rays])[:-1]
+            for cam, cached_frame, model_n_ints, model_depth in zip(batch, cached_frames[batch_start:batch_start+frames_per_batch], np.split(n_intersections, splits), np.split(depth, splits)):
+                if cached_frame is not None:
+                    mesh_n_ints, mesh_depths = cached_frame
+                else:
+                    mesh_n_ints, mesh_depths = next(gt_frames)
+                    if gt_cache is not None:
+                        gt_cache.save(cam, radius, "alldepths", (mesh_n_ints, mesh_depths))
+                yield np.array(mesh_n_ints), np.array(mesh_depths), model_n_ints.reshape(cam.sensor_resolution), model_depth.reshape(cam.sensor_resolution)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
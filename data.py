@@ -3,32 +3,42 @@ A data loader class for rays
 '''
 
 import os
+import json
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from tqdm import tqdm
 import rasterization
 import sampling
 import odf_utils
+import acceleration
+from mesh_geometry import MeshGeometry
 
 
 class DepthData(Dataset):
 
-    def __init__(self,faces,verts,radius,sampling_methods,sampling_frequency,size=1000000):
+    def __init__(self,faces,verts,radius,sampling_methods,sampling_frequency,size=1000000,backend="brute",geometry=None):
         '''
         Faces and verts define a mesh object that is used to generate data
         sampling_methods are methods from sampling.py that are used to choose rays during data generation
         sampling_frequency are weights determining how frequently each sampling method should be used (weights should sum to 1.0)
         size defines the number of datapoints to generate
+        backend selects how ground truth rays are cast (see acceleration.BACKENDS)
+        geometry is an optional MeshGeometry for the mesh, so that cached normals and edge data can be shared between datasets
         '''
         assert(sum(sampling_frequency)==1.0)
         self.faces = faces
         self.verts = verts
-        self.vert_normals = odf_utils.get_vertex_normals(verts, faces)
+        self.geometry = geometry if geometry is not None else MeshGeometry(verts, faces)
+        self.vert_normals = self.geometry.vertex_normals
         self.radius=radius
-        self.near_face_threshold = rasterization.max_edge(verts, faces)
+        self.near_face_threshold = self.geometry.max_edge
         self.sampling_methods = sampling_methods
         self.sampling_frequency = sampling_frequency
         self.size = size
+        self.accelerator = acceleration.make_accelerator(backend, verts, faces, near_face_threshold=self.near_face_threshold, radius=radius)
+        # edge vectors for the brute force ray/triangle test are cached on the geometry
+        self.face_data = self.geometry.face_data if self.accelerator is None else None
 
     def __len__(self):
         return self.size
@@ -38,14 +48,21 @@ class DepthData(Dataset):
         ray_start,ray_end,v = sampling_method(self.radius,verts=self.verts,vert_normals=self.vert_normals)
         direction = ray_end-ray_start
         direction /= np.linalg.norm(direction)
-        rot_verts = rasterization.rotate_mesh(self.verts, ray_start, ray_end)
-        occ, depth = rasterization.ray_occ_depth(self.faces, rot_verts, ray_start_depth=np.linalg.norm(ray_end-ray_start), near_face_threshold=self.near_face_threshold, v=v)
+        if self.accelerator is not None:
+            occ, depth = self.accelerator.ray_occ_depth(ray_start, ray_end, v=v)
+        elif v is None:
+            occ, depth = rasterization.ray_occ_depth_batch(self.faces, self.verts, ray_start, ray_end-ray_start, face_data=self.face_data, kernel="moller_trumbore")
+            occ, depth = occ[0], depth[0]
+        else:
+            # rays that end on a vertex need the special handling in ray_occ_depth
+            rot_verts = rasterization.rotate_mesh(self.verts, ray_start, ray_end)
+            occ, depth = rasterization.ray_occ_depth(self.faces, rot_verts, ray_start_depth=np.linalg.norm(ray_end-ray_start), near_face_threshold=self.near_face_threshold, v=v)
         intersect = 1.0 if depth != np.inf else 0.0
         # theta,phi = utils.vector_to_angles(ray_end-ray_start)
         return {
             # 5d coordinates - [x,y,z,theta,phi]
             # "coordinates": torch.tensor([ray_start[0], ray_start[1], ray_start[2], theta, phi], dtype=torch.float32),
-            "coordinates": torch.tensor([x for val in list(ray_start) + list(direction) for x in odf_utils.positional_encoding(val)]),
+            "coordinates": torch.tensor(odf_utils.positional_encoding_batch(np.hstack([ray_start, direction])[None,:])[0], dtype=torch.float32),
             # is the ray origin inside the mesh?
             "occ": torch.tensor(occ, dtype=torch.float32),
             # does the ray intersect the mesh?
@@ -56,34 +73,116 @@ class DepthData(Dataset):
 
 class MultiDepthDataset(Dataset):
 
-    def __init__(self,faces,verts,radius,sampling_methods,sampling_frequency,size=1000000, intersect_limit=20, pos_enc=True):
+    def __init__(self,faces,verts,radius,sampling_methods,sampling_frequency,size=1000000, intersect_limit=20, pos_enc=True, backend="brute", geometry=None, ray_block_size=4096):
         '''
         Faces and verts define a mesh object that is used to generate data
         sampling_methods are methods from sampling.py that are used to choose rays during data generation
         sampling_frequency are weights determining how frequently each sampling method should be used (weights should sum to 1.0)
         size defines the number of datapoints to generate
+        backend selects how ground truth rays are cast (see acceleration.BACKENDS)
+        geometry is an optional MeshGeometry for the mesh, so that cached normals and edge data can be shared between datasets
+        ray_block_size is the number of rays drawn at once with the batch samplers. Samples are served from this block until it runs out
+        If the dataset is indexed with a list of indices (e.g. through batch_loader) it returns a whole batch at once
         '''
         self.faces = faces
         self.verts = verts
-        self.vert_normals = odf_utils.get_vertex_normals(verts, faces)
+        self.geometry = geometry if geometry is not None else MeshGeometry(verts, faces)
+        self.vert_normals = self.geometry.vertex_normals
         self.radius=radius
-        self.near_face_threshold = rasterization.max_edge(verts, faces)
+        self.near_face_threshold = self.geometry.max_edge
         self.size = size
         self.intersect_limit = intersect_limit
         self.pos_enc = pos_enc
         self.sampling_methods = sampling_methods
         self.sampling_frequency = sampling_frequency
+        self.accelerator = acceleration.make_accelerator(backend, verts, faces, near_face_threshold=self.near_face_threshold, radius=radius)
+        # edge vectors for the brute force ray/triangle test are cached on the geometry
+        self.face_data = self.geometry.face_data if self.accelerator is None else None
+        self.ray_block_size = ray_block_size
+        self.rng = None
+        self.rng_pid = None
+        self.ray_block = None
+        self.ray_block_index = 0
 
     def __len__(self):
         return self.size
 
+    def generator(self):
+        '''
+        Returns this process's random generator. DataLoader workers get a copy of the dataset, so the generator is reseeded from
+        torch's per worker seed the first time it is used in a new process
+        '''
+        if self.rng is None or self.rng_pid != os.getpid():
+            self.rng = np.random.default_rng(torch.initial_seed())
+            self.rng_pid = os.getpid()
+            self.ray_block = None
+        return self.rng
+
+    def seed(self, seed):
+        '''
+        Reseeds the ray sampling in this process, e.g. so that pre-generated rays are reproducible
+        seed can be anything accepted by numpy.random.default_rng
+        '''
+        self.rng = np.random.default_rng(seed)
+        self.rng_pid = os.getpid()
+        self.ray_block = None
+
+    def next_rays(self, n):
+        '''
+        Returns the next n ray start and end points as (n,3) arrays, drawing new blocks of rays from the sampling mixture when needed
+        '''
+        rng = self.generator()
+        start_points, end_points = [], []
+        while n > 0:
+            if self.ray_block is None or self.ray_block_index >= self.ray_block[0].shape[0]:
+                self.ray_block = sampling.sample_mixture_batch(self.ray_block_size, self.radius, self.sampling_methods, self.sampling_frequency, rng=rng, verts=self.verts, vert_normals=self.vert_normals)
+                self.ray_block_index = 0
+            n_taken = min(n, self.ray_block[0].shape[0] - self.ray_block_index)
+            start_points.append(self.ray_block[0][self.ray_block_index:self.ray_block_index+n_taken])
+            end_points.append(self.ray_block[1][self.ray_block_index:self.ray_block_index+n_taken])
+            self.ray_block_index += n_taken
+            n -= n_taken
+        return np.concatenate(start_points), np.concatenate(end_points)
+
+    def label_rays(self, ray_start, ray_end):
+        '''
+        Casts (n,3) rays against the mesh
+        Returns the (n,intersect_limit) intersection depths (0 past the last intersection) and the number of intersections (capped at intersect_limit)
+        '''
+        if self.accelerator is not None:
+            depths = np.zeros((ray_start.shape[0], self.intersect_limit))
+            n_ints = np.zeros((ray_start.shape[0],), dtype=int)
+            for i in range(ray_start.shape[0]):
+                int_depths = np.array(self.accelerator.ray_all_depths(ray_start[i], ray_end[i]))[:self.intersect_limit]
+                depths[i,:int_depths.shape[0]] = int_depths
+                n_ints[i] = int_depths.shape[0]
+            return depths, n_ints
+        depths, n_ints = rasterization.ray_all_depths_batch(self.faces, self.verts, ray_start, ray_end-ray_start, max_hits=self.intersect_limit, face_data=self.face_data, kernel="moller_trumbore")
+        n_ints = np.minimum(n_ints, self.intersect_limit)
+        depths[np.arange(self.intersect_limit)[None,:] >= n_ints[:,None]] = 0.
+        return depths, n_ints
+
+    def get_batch(self, batch_size):
+        '''
+        Generates batch_size samples with vectorized ray casting and encoding. The returned dictionary has the same keys and shapes
+        as a batch of individual samples stacked by the default collate function
+        '''
+        ray_start, ray_end = self.next_rays(batch_size)
+        depths, n_ints = self.label_rays(ray_start, ray_end)
+        return ray_batch(ray_start, ray_end, depths, n_ints, pos_enc=self.pos_enc)
+
     def __getitem__(self, index):
-        sampling_method = self.sampling_methods[np.random.choice(np.arange(len(self.sampling_methods)), p=self.sampling_frequency)]
-        ray_start,ray_end,_ = sampling_method(self.radius,verts=self.verts,vert_normals=self.vert_normals)
+        if isinstance(index, (list, np.ndarray, torch.Tensor)):
+            return self.get_batch(len(index))
+        ray_start,ray_end = self.next_rays(1)
+        ray_start,ray_end = ray_start[0],ray_end[0]
         direction = ray_end-ray_start
         direction /= np.linalg.norm(direction)
-        rot_verts = rasterization.rotate_mesh(self.verts, ray_start, ray_end)
-        int_depths = rasterization.ray_all_depths(self.faces, rot_verts,near_face_threshold=self.near_face_threshold, ray_start_depth=np.linalg.norm(ray_end - ray_start))
+        if self.accelerator is not None:
+            int_depths = self.accelerator.ray_all_depths(ray_start, ray_end)
+        else:
+            int_depths, n_hits = rasterization.ray_all_depths_batch(self.faces, self.verts, ray_start, ray_end-ray_start, max_hits=self.intersect_limit, face_data=self.face_data, kernel="moller_trumbore")
+            int_depths = int_depths[0,:n_hits[0]]
         int_depths = torch.tensor(int_depths[:self.intersect_limit], dtype=torch.float32)
         intersect = np.zeros((self.intersect_limit,), dtype=float)
         intersect[:int_depths.shape[0]] = 1.
@@ -92,9 +191,10 @@ class MultiDepthDataset(Dataset):
         depths = np.zeros((self.intersect_limit,), dtype=float)
         depths[:int_depths.shape[0]] = int_depths
         if self.pos_enc:
-            coordinates_points = torch.tensor([x for val in list(ray_start) + list(ray_end) for x in odf_utils.positional_encoding(val)], dtype=torch.float32)
-            coordinates_direction = torch.tensor([x for val in list(ray_start) + list(direction) for x in odf_utils.positional_encoding(val)], dtype=torch.float32)
-            coordinates_pluecker = torch.tensor([x for val in list(direction) + list(np.cross(ray_start, direction)) for x in odf_utils.positional_encoding(val)], dtype=torch.float32)
+            encoded = odf_utils.positional_encoding_batch(np.vstack([np.hstack([ray_start, ray_end]), np.hstack([ray_start, direction]), np.hstack([direction, np.cross(ray_start, direction)])]))
+            coordinates_points = torch.tensor(encoded[0], dtype=torch.float32)
+            coordinates_direction = torch.tensor(encoded[1], dtype=torch.float32)
+            coordinates_pluecker = torch.tensor(encoded[2], dtype=torch.float32)
         else:
             coordinates_points = torch.tensor([list(ray_start)+list(ray_end)], dtype=torch.float32)
             coordinates_direction = torch.tensor([list(ray_start)+list(direction)], dtype=torch.float32)
@@ -114,6 +214,164 @@ class MultiDepthDataset(Dataset):
             "depths": torch.tensor(depths, dtype=torch.float32),
         }
 
+# -------     PRE-GENERATED RAY SHARDS     -------
+# A sharded ray dataset is a directory with a manifest.json and, for each shard, float32 rays (n,6) [start, end] and depths
+# (n,intersect_limit), and int32 numbers of intersections (n,) saved as .npy files
+
+RAY_SHARD_VERSION = 1
+
+def ray_shard_manifest(dataset, shard_size, seed=0):
+    '''
+    Returns the manifest describing the shards that generate_ray_shards would write for a MultiDepthDataset with the given seed
+    Preset noise values are part of the sampling method names (see sampling.PresetNoise)
+    '''
+    return {
+        "version": RAY_SHARD_VERSION,
+        "mesh_hash": dataset.geometry.identifier(),
+        "radius": float(dataset.radius),
+        "sampling_methods": [getattr(method, "__name__", repr(method)) for method in dataset.sampling_methods],
+        "sampling_frequency": [float(freq) for freq in dataset.sampling_frequency],
+        "intersect_limit": int(dataset.intersect_limit),
+        "size": int(dataset.size),
+        "shard_size": int(shard_size),
+        "seed": int(seed),
+    }
+
+def ray_shard_files(shard_dir, shard):
+    '''
+    Returns the paths of the arrays in a shard
+    '''
+    return {key: os.path.join(shard_dir, f"shard_{shard:05d}_{key}.npy") for key in ["rays", "depths", "n_ints"]}
+
+def read_ray_shard_manifest(shard_dir):
+    '''
+    Returns the manifest in shard_dir, or None if there isn't one
+    '''
+    manifest_path = os.path.join(shard_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def generate_ray_shards(dataset, shard_dir, shard_size=100000, seed=0, force=False, verbose=True):
+    '''
+    Samples and labels dataset.size rays from a MultiDepthDataset and writes them to shard_dir in shards of shard_size rays
+    Generation is skipped if shard_dir already has a manifest with the same parameters and seed and all of its shards (unless force is True)
+    Returns the manifest
+    '''
+    manifest = ray_shard_manifest(dataset, shard_size, seed=seed)
+    n_shards = int(np.ceil(dataset.size / shard_size))
+    shard_paths = [path for shard in range(n_shards) for path in ray_shard_files(shard_dir, shard).values()]
+    if not force and read_ray_shard_manifest(shard_dir) == manifest and all([os.path.exists(path) for path in shard_paths]):
+        if verbose:
+            print(f"Found matching ray shards in {shard_dir}, skipping generation")
+        return manifest
+    os.makedirs(shard_dir, exist_ok=True)
+    # the manifest is written last so that an interrupted run is never mistaken for a complete one
+    if os.path.exists(os.path.join(shard_dir, "manifest.json")):
+        os.remove(os.path.join(shard_dir, "manifest.json"))
+    dataset.seed(seed)
+    for shard in tqdm(range(n_shards), disable=not verbose, desc=f"Writing {n_shards} ray shards"):
+        n_rays = min(shard_size, dataset.size - shard*shard_size)
+        ray_start, ray_end = dataset.next_rays(n_rays)
+        depths, n_ints = dataset.label_rays(ray_start, ray_end)
+        files = ray_shard_files(shard_dir, shard)
+        np.save(files["rays"], np.hstack([ray_start, ray_end]).astype(np.float32))
+        np.save(files["depths"], depths.astype(np.float32))
+        np.save(files["n_ints"], n_ints.astype(np.int32))
+    with open(os.path.join(shard_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+class ShardedRayDataset(Dataset):
+
+    def __init__(self, shard_dir, pos_enc=True):
+        '''
+        Serves the rays written by generate_ray_shards. The shards are memory mapped, so an epoch only reads the rays from disk
+        Like MultiDepthDataset, indexing with a list of indices (e.g. through batch_loader) returns a whole batch
+        '''
+        self.shard_dir = shard_dir
+        self.pos_enc = pos_enc
+        self.manifest = read_ray_shard_manifest(shard_dir)
+        assert(self.manifest is not None and self.manifest["version"] == RAY_SHARD_VERSION)
+        self.size = self.manifest["size"]
+        self.shard_size = self.manifest["shard_size"]
+        self.intersect_limit = self.manifest["intersect_limit"]
+        # opened on first access so that each DataLoader worker maps the files itself
+        self.shards = None
+
+    def __len__(self):
+        return self.size
+
+    def open_shards(self):
+        if self.shards is None:
+            n_shards = int(np.ceil(self.size / self.shard_size))
+            self.shards = [{key: np.load(path, mmap_mode="r") for key, path in ray_shard_files(self.shard_dir, shard).items()} for shard in range(n_shards)]
+        return self.shards
+
+    def get_batch(self, indices):
+        shards = self.open_shards()
+        indices = np.asarray(indices, dtype=int)
+        rays = np.zeros((indices.shape[0], 6), dtype=np.float32)
+        depths = np.zeros((indices.shape[0], self.intersect_limit), dtype=np.float32)
+        n_ints = np.zeros((indices.shape[0],), dtype=np.int32)
+        shard_ids = indices // self.shard_size
+        for shard in np.unique(shard_ids):
+            mask = shard_ids == shard
+            # sorted reads are much faster on a memory map
+            offsets = indices[mask] - shard*self.shard_size
+            order = np.argsort(offsets)
+            rows = np.empty_like(order)
+            rows[order] = np.arange(order.shape[0])
+            rays[mask] = shards[shard]["rays"][offsets[order]][rows]
+            depths[mask] = shards[shard]["depths"][offsets[order]][rows]
+            n_ints[mask] = shards[shard]["n_ints"][offsets[order]][rows]
+        return ray_batch(rays[:,:3], rays[:,3:], depths, n_ints, pos_enc=self.pos_enc)
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray, torch.Tensor)):
+            return self.get_batch(index)
+        return {key: val[0] for key, val in self.get_batch([index]).items()}
+
+
+def ray_batch(ray_start, ray_end, depths, n_ints, pos_enc=True):
+    '''
+    Builds the batch dictionary used by train4D.py from (n,3) ray start and end points, the (n,intersect_limit) intersection depths
+    and the number of intersections along each ray
+    '''
+    ray_start = np.asarray(ray_start, dtype=float)
+    ray_end = np.asarray(ray_end, dtype=float)
+    direction = ray_end-ray_start
+    direction /= np.linalg.norm(direction, axis=1)[:,None]
+    intersect = np.arange(depths.shape[1])[None,:] < n_ints[:,None]
+    coordinates = {
+        "points": np.hstack([ray_start, ray_end]),
+        "direction": np.hstack([ray_start, direction]),
+        "pluecker": np.hstack([direction, np.cross(ray_start, direction)]),
+    }
+    if pos_enc:
+        coordinates = {key: odf_utils.positional_encoding_batch(val) for key, val in coordinates.items()}
+    else:
+        coordinates = {key: val[:,None,:] for key, val in coordinates.items()}
+    return {
+        "coordinates_points": torch.tensor(coordinates["points"], dtype=torch.float32),
+        "coordinates_direction": torch.tensor(coordinates["direction"], dtype=torch.float32),
+        "coordinates_pluecker": torch.tensor(coordinates["pluecker"], dtype=torch.float32),
+        "n_ints": torch.tensor(n_ints, dtype=torch.int64),
+        "intersect": torch.tensor(intersect, dtype=torch.float32),
+        "depths": torch.tensor(depths, dtype=torch.float32),
+    }
+
+def batch_loader(dataset, batch_size, shuffle=False, drop_last=False, **kwargs):
+    '''
+    Returns a DataLoader that passes whole lists of indices to the dataset, for datasets like MultiDepthDataset that
+    can build a batch in one call. Automatic batching is turned off so the default collate function isn't used
+    kwargs are passed on to the DataLoader (e.g. num_workers, pin_memory)
+    '''
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None, **kwargs)
+
 class DepthConsistencyDataset(Dataset):
 
     def __init__(self,faces,verts,radius,size=1000000, intersect_limit=20, pos_enc=True):
@@ -0,0 +1,45 @@
+'''
+Pre-generates the rays and ground truth labels used by train4D.py, so that training epochs only have to read them from disk
+
+Writes <out_dir>/train and <out_dir>/test, which can be passed to train4D.py with --ray_dir <out_dir>. Generation is skipped for
+a split if its manifest already matches the requested settings
+'''
+
+import os
+import argparse
+
+import sampling
+import acceleration
+from data import MultiDepthDataset, generate_ray_shards
+from mesh_geometry import MeshGeometry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes sharded ray datasets for train4D.py")
+    parser.add_argument("--mesh_file", required=True, help="Source of mesh to sample rays from")
+    parser.add_argument("--out_dir", required=True, help="Directory to write the train and test shards to")
+    parser.add_argument("--samples_per_mesh", type=int, default=1000000, help="Number of training rays to sample for each mesh (10% as many test rays are written)")
+    parser.add_argument("--shard_size", type=int, default=100000, help="Number of rays per shard")
+    parser.add_argument("--intersect_limit", type=int, default=20, help="Max number of intersections stored per ray")
+    parser.add_argument("--radius", type=float, default=1.25, help="The radius at which all rays start and end (mesh is normalized to be in unit sphere)")
+    parser.add_argument("--vert_noise", type=float, default=0.02, help="Standard deviation of noise to add to vertex sampling methods")
+    parser.add_argument("--tan_noise", type=float, default=0.02, help="Standard deviation of noise to add to tangent sampling method")
+    parser.add_argument("--uniform", type=int, default=100, help="What percentage of the data should be uniformly sampled (0 -> 0%, 100 -> 100%)")
+    parser.add_argument("--vertex", type=int, default=0, help="What percentage of the data should use vertex sampling (0 -> 0%, 100 -> 100%)")
+    parser.add_argument("--tangent", type=int, default=0, help="What percentage of the data should use vertex tangent sampling (0 -> 0%, 100 -> 100%)")
+    parser.add_argument("--backend", default="brute", choices=acceleration.BACKENDS, help="How ground truth rays are cast against the mesh")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the training rays (the test rays use seed+1)")
+    parser.add_argument("--force", action="store_true", help="Regenerate the shards even if the manifests match")
+    args = parser.parse_args()
+
+    geometry = MeshGeometry.from_file(args.mesh_file)
+    sampling_methods = [sampling.sample_uniform_4D, 
+                        sampling.sampling_preset_noise(sampling.sample_vertex_4D, args.vert_noise),
+                        sampling.sampling_preset_noise(sampling.sample_tangential_4D, args.tan_noise)]
+    sampling_frequency = [0.01 * args.uniform, 0.01 * args.vertex, 0.01*args.tangent]
+    assert(sum(sampling_frequency) == 1.0)
+
+    for split, size, seed in [("train", args.samples_per_mesh, args.seed), ("test", int(args.samples_per_mesh*0.1), args.seed+1)]:
+        dataset = MultiDepthDataset(geometry.faces, geometry.verts, args.radius, sampling_methods, sampling_frequency, size=size, intersect_limit=args.intersect_limit, backend=args.backend, geometry=geometry)
+        print(f"Generating {size} {split} rays...")
+        generate_ray_shards(dataset, os.path.join(args.out_dir, split), shard_size=args.shard_size, seed=seed, force=args.force)
@@ -0,0 +1,181 @@
+'''
+A per-mesh cache of the geometry that the data loaders, samplers, and ray casting functions derive from the raw vertices and faces
+'''
+
+import os
+import hashlib
+import zipfile
+import numpy as np
+import trimesh
+
+import odf_utils
+import rasterization
+
+# Stored in every sidecar. Bump this when a cached property changes (e.g. the keys of rasterization.get_face_data) so that old sidecars are recomputed
+MESH_GEOMETRY_VERSION = 1
+
+def file_hash(path):
+    '''
+    Returns the sha1 hex digest of a file's contents
+    '''
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def sidecar_path(mesh_file):
+    '''
+    Returns the path of the .npz file that caches the geometry of mesh_file
+    '''
+    return os.path.splitext(mesh_file)[0] + "_geometry.npz"
+
+
+class MeshGeometry():
+    '''
+    Lazily computes and memoizes quantities derived from a mesh. Each property is computed the first time it is accessed.
+    The object can be pickled (e.g. sent to DataLoader workers) or saved to an .npz sidecar so that the work isn't repeated.
+        verts     - the mesh vertices
+        faces     - the mesh faces
+        mesh_hash - identifies the source mesh file, used to check that a saved sidecar is still valid
+    '''
+
+    def __init__(self, verts, faces, mesh_hash=None):
+        super().__init__()
+        self.verts = np.array(verts, dtype=float)
+        self.faces = np.array(faces, dtype=int)
+        self.mesh_hash = mesh_hash
+        self.version = MESH_GEOMETRY_VERSION
+        self.cache = {}
+
+    def identifier(self):
+        '''
+        Returns the mesh file hash if the geometry was loaded from a file, otherwise a hash of the vertices and faces
+        '''
+        if self.mesh_hash is not None:
+            return self.mesh_hash
+        return hashlib.sha1(self.verts.tobytes() + self.faces.tobytes()).hexdigest()
+
+    @classmethod
+    def from_file(cls, mesh_file, normalize=True, use_sidecar=True):
+        '''
+        Loads a mesh (normalized to the unit sphere by default). If use_sidecar is True, cached geometry is read from the .npz
+        next to the mesh file when its hash and format version match, and the sidecar is (re)written with every property otherwise.
+        If the sidecar can't be written (e.g. a read-only dataset directory) the geometry is still returned, just not saved
+        '''
+        mesh_hash = file_hash(mesh_file)
+        npz_path = sidecar_path(mesh_file)
+        if use_sidecar and os.path.exists(npz_path):
+            try:
+                geometry = cls.load(npz_path)
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+                geometry = None
+            if geometry is not None and geometry.version == MESH_GEOMETRY_VERSION and geometry.mesh_hash == mesh_hash and geometry.cache.get("normalized", False) == normalize:
+                return geometry
+        mesh = trimesh.load(mesh_file)
+        verts = odf_utils.mesh_normalize(mesh.vertices) if normalize else mesh.vertices
+        geometry = cls(verts, mesh.faces, mesh_hash=mesh_hash)
+        geometry.cache["normalized"] = normalize
+        if use_sidecar:
+            geometry.precompute()
+            try:
+                geometry.save(npz_path)
+            except OSError as e:
+                print(f"Could not write the mesh geometry sidecar {npz_path} ({e}), continuing without it")
+        return geometry
+
+    def precompute(self):
+        '''
+        Computes every cached property
+        '''
+        self.max_edge
+        self.vertex_normals
+        self.face_data
+        self.vertex_adjacency
+
+    @property
+    def max_edge(self):
+        '''
+        The padded maximum edge length, used as the near face threshold by the rasterization functions
+        '''
+        if "max_edge" not in self.cache:
+            self.cache["max_edge"] = rasterization.max_edge(self.verts, self.faces)
+        return self.cache["max_edge"]
+
+    @property
+    def vertex_normals(self):
+        if "vertex_normals" not in self.cache:
+            self.cache["vertex_normals"] = odf_utils.get_vertex_normals(self.verts, self.faces)
+        return self.cache["vertex_normals"]
+
+    @property
+    def face_data(self):
+        '''
+        The per-face edge vectors used by the batched intersection functions (see rasterization.get_face_data)
+        '''
+        if "face_data" not in self.cache:
+            self.cache["face_data"] = rasterization.get_face_data(self.faces, self.verts)
+        return self.cache["face_data"]
+
+    @property
+    def vertex_adjacency(self):
+        '''
+        The neighbors of each vertex in compressed form. The neighbors of vertex i are indices[offsets[i]:offsets[i+1]]
+        Returns offsets, indices
+        '''
+        if "vertex_adjacency" not in self.cache:
+            lines = np.concatenate([self.faces[:,:2], self.faces[:,1:], self.faces[:,[0,2]]], axis=0)
+            edges = np.unique(np.sort(lines, axis=1), axis=0)
+            directed = np.concatenate([edges, edges[:,::-1]], axis=0)
+            directed = directed[np.lexsort((directed[:,1], directed[:,0]))]
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(directed[:,0], minlength=self.verts.shape[0]))])
+            self.cache["vertex_adjacency"] = (offsets, directed[:,1])
+        return self.cache["vertex_adjacency"]
+
+    def neighbors(self, i):
+        '''
+        Returns the indices of the vertices that share an edge with vertex i
+        '''
+        offsets, indices = self.vertex_adjacency
+        return indices[offsets[i]:offsets[i+1]]
+
+    def save(self, path):
+        '''
+        Saves the mesh and every property computed so far to an .npz file. The file is written under a temporary name and then
+        moved into place, so that concurrent runs never read a partial sidecar
+        '''
+        arrays = {"verts": self.verts, "faces": self.faces, "mesh_hash": np.array("" if self.mesh_hash is None else self.mesh_hash), "version": np.array(MESH_GEOMETRY_VERSION)}
+        for key, val in self.cache.items():
+            if key == "face_data":
+                arrays.update({f"face_data/{name}": arr for name, arr in val.items()})
+            elif key == "vertex_adjacency":
+                arrays["vertex_adjacency/offsets"], arrays["vertex_adjacency/indices"] = val
+            else:
+                arrays[key] = np.array(val)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads a MeshGeometry saved with save(). Sidecars written before versioning get version 0
+        '''
+        with np.load(path) as data:
+            mesh_hash = str(data["mesh_hash"])
+            geometry = cls(data["verts"], data["faces"], mesh_hash=mesh_hash if mesh_hash != "" else None)
+            geometry.version = int(data["version"]) if "version" in data.files else 0
+            face_data = {key.split("/")[1]: data[key] for key in data.files if key.startswith("face_data/")}
+            if len(face_data) > 0:
+                geometry.cache["face_data"] = face_data
+            if "vertex_adjacency/offsets" in data.files:
+                geometry.cache["vertex_adjacency"] = (data["vertex_adjacency/offsets"], data["vertex_adjacency/indices"])
+            for key in ["max_edge", "vertex_normals", "normalized"]:
+                if key in data.files:
+                    geometry.cache[key] = data[key] if data[key].ndim > 0 else data[key].item()
+        return geometry
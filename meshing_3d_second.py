@@ -7,6 +7,7 @@ import torch
 
 import rasterization
 import odf_utils
+from mesh_geometry import MeshGeometry
 
 #Icosahedron taken from https://people.sc.fsu.edu/~jburkardt/data/obj/icosahedron.obj
 #Icosahedron sphere connectivity https://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.90.6202&rep=rep1&type=pdf
@@ -51,10 +52,11 @@ icosahedron_faces = [
 
 class MeshODF():
 
-    def __init__(self, vertices, faces):
+    def __init__(self, vertices, faces, geometry=None):
         self.vertices = vertices
         self.faces = faces
         self.radius = radius
+        self.geometry = geometry if geometry is not None else MeshGeometry(vertices, faces)
 
     def query_rays(self, points, directions):
         '''
@@ -63,10 +65,9 @@ class MeshODF():
         '''
         points = np.array(points)
         directions = np.array(directions)
-        intersect = []
-        depths = []
         n_ints = [1] * points.shape[0]
-        near_face_threshold = rasterization.max_edge(self.vertices, self.faces)
+        start_points = []
+        end_points = []
         for i in range(points.shape[0]):
             # if np.linalg.norm(points[i]) > self.radius:
             if odf_utils.get_sphere_intersections(points[i], directions[i], self.radius) is None:
@@ -75,13 +76,16 @@ class MeshODF():
                 visualizer.add_point(points[i], [1.0,0.0,0.0])
                 visualizer.display()
             start_point, end_point = odf_utils.get_sphere_intersections(points[i], directions[i], self.radius)
-            ray_length = np.linalg.norm(end_point-start_point)
-            rot_verts = rasterization.rotate_mesh(self.vertices, start_point, end_point)
-            _, depth = rasterization.ray_occ_depth(self.faces, rot_verts, ray_start_depth=ray_length, near_face_threshold=near_face_threshold)
-            depth -= np.linalg.norm(points[i] - start_point)
-            depth = depth if depth > 0. else np.inf
-            intersect.append(depth < np.inf)
-            depths.append([depth])
+            start_points.append(start_point)
+            end_points.append(end_point)
+        start_points = np.array(start_points).reshape((-1,3))
+        end_points = np.array(end_points).reshape((-1,3))
+        # all rays are intersected with the mesh at once
+        _, depths = rasterization.ray_occ_depth_batch(self.faces, self.vertices, start_points, end_points-start_points, face_data=self.geometry.face_data)
+        depths -= np.linalg.norm(points - start_points, axis=1)
+        depths[depths <= 0.] = np.inf
+        intersect = depths < np.inf
+        depths = depths[:,np.newaxis]
         # return torch tensors just so the output is exactly the same as the learned NN
         return torch.tensor(np.array(intersect)), torch.tensor(np.array(depths)), torch.tensor(np.array(n_ints))
 
@@ -4,6 +4,7 @@ An MLP that predicts the surface depth along rays
 
 import torch
 import torch.nn as nn
+import numpy as np
 import odf_utils
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -27,7 +28,8 @@ def pluecker(points):
     return torch.hstack([dir, m])
 
 def pos_encoding(points):
-    return torch.tensor([[x for j in range(points.shape[1]) for x in odf_utils.positional_encoding(points[i][j])] for i in range(points.shape[0])])
+    # encoded in float64 to match odf_utils.positional_encoding, returned as float32
+    return odf_utils.positional_encoding_torch(points.double()).float()
 
 # Having the model change the input parameterization at inference time allows us to use a consistent input format so we don't have to change the testing script.
 # For training the input will be provided with the preprocessing already applied so that it can be done in parallel in the dataloader
@@ -222,8 +224,8 @@ class LF4D(nn.Module):
         # print("QUERY")
         # print(points)
         # print(directions)
-        combine_tuple = lambda x: list(x[0]) + list(x[1])
         # the sphere intersections (two surface points) will be reparameterized in interior_depth if necessary (e.g. turned into surface point + direction)
-        surface_intersections = torch.tensor([combine_tuple(odf_utils.get_sphere_intersections(points[i], directions[i], self.radius)) for i in range(points.shape[0])])
+        first, second = odf_utils.get_sphere_intersections_batch(points.cpu().numpy(), directions.cpu().numpy(), self.radius)
+        surface_intersections = torch.from_numpy(np.hstack([first, second])).to(points.dtype)
         return self.interior_depth(surface_intersections, points)
 
@@ -49,6 +49,22 @@ def random_within_sphere(radius):
     magnitude = uniform.rvs() ** (1./3.)
     return initial_point * magnitude
 
+def random_on_sphere_batch(n, radius, rng=None):
+    '''
+    Returns n random points on the surface of the sphere centered at the origin with given radius as an (n,3) array
+    rng is a numpy.random.Generator (a new one is created if None)
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    points = rng.standard_normal((n, 3))
+    return points * (radius / np.linalg.norm(points, axis=1))[:,None]
+
+def random_within_sphere_batch(n, radius, rng=None):
+    '''
+    Returns n points sampled randomly from the volume of a sphere centered at the origin with given radius as an (n,3) array
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    return random_on_sphere_batch(n, radius, rng=rng) * (rng.random(n) ** (1./3.))[:,None]
+
 def mesh_adjacency_dictionaries(vertices, faces):
     '''
     Given a mesh, returns a variety of dictionaries so that neighboring structures can be accessed in O(1) time
@@ -153,19 +169,15 @@ def get_vertex_normals(verts, faces):
 
     face_normals = np.cross(e1, e2)
     face_normals_magnitude = np.linalg.norm(face_normals, axis=1)
-    for i in range(faces.shape[0]):
-        if face_normals_magnitude[i] == 0.:
-            print(faces[i])
+    for degenerate_face in faces[face_normals_magnitude == 0.]:
+        print(degenerate_face)
     # print(f"FACE NORMS IS ZERO MAG: {face_normals.shape[0] - np.nonzero(np.linalg.norm(face_normals, axis=1).shape[0])}")
     # print(face_normals_magnitude[0:5])
     face_normals = (face_normals / np.hstack([face_normals_magnitude[:,np.newaxis]]*3))
     # print(np.linalg.norm(face_normals, axis=1)[0:5])
     vert_normals = np.zeros((verts.shape[0], 3))
-    vert_face_count = np.zeros((verts.shape[0]))
-    for i in range(faces.shape[0]):
-        for j in range(faces.shape[1]):
-            vert_face_count[faces[i][j]] += 1
-            vert_normals[faces[i][j]] += face_normals[i]
+    # accumulate each face normal into its three vertices
+    np.add.at(vert_normals, faces.astype(int).flatten(), np.repeat(face_normals, faces.shape[1], axis=0))
     vert_normals = vert_normals / np.hstack([np.linalg.norm(vert_normals, axis=1)[:,np.newaxis]]*3)
     return vert_normals
 
@@ -197,6 +209,24 @@ def get_sphere_intersections(p0, v, radius):
         return None
     return p0 + x1*v, p0 + x2*v
 
+def get_sphere_intersections_batch(p0, v, radius):
+    '''
+    Vectorized version of get_sphere_intersections for (N,3) arrays of points and directions
+    Returns two (N,3) arrays with the intersection closest to p0 first. Rows that have no intersection, or whose intersections
+    lie in the negative v direction, are filled with nan
+    '''
+    a = np.sum(v*v, axis=1)
+    b = 2 * np.sum(p0*v, axis=1)
+    c = np.sum(p0*p0, axis=1) - radius**2
+    inner_term = b**2 - 4*a*c
+    partial = np.sqrt(np.maximum(inner_term, 0.))
+    x1 = (-b - partial) / (2*a)
+    x2 = (-b + partial) / (2*a)
+    invalid = np.logical_or(inner_term < 0., np.logical_and(x1 < 0., x2 < 0.))
+    x1[invalid] = np.nan
+    x2[invalid] = np.nan
+    return p0 + x1[:,None]*v, p0 + x2[:,None]*v
+
 def vector_to_angles(vector):
     '''
     Given a vector, returns the angles theta and phi from it's spherical coordinates (ISO convention)
@@ -215,6 +245,47 @@ def positional_encoding(val, L=10):
     '''
     return [x for i in range(L) for x in [math.sin(2**(i)*math.pi*val), math.cos(2**(i)*math.pi*val)]]
 
+FREQUENCY_BANDS = {}
+
+def frequency_bands(L=10):
+    '''
+    Returns the L positional encoding frequencies [2^0*pi, ..., 2^(L-1)*pi]. These are computed once per L
+    '''
+    if L not in FREQUENCY_BANDS:
+        FREQUENCY_BANDS[L] = np.array([2**(i)*math.pi for i in range(L)])
+    return FREQUENCY_BANDS[L]
+
+def positional_encoding_batch(vals, L=10, out=None):
+    '''
+    vals - an (N,D) array of values
+    L    - controls the size of the encoding
+    out  - optional preallocated (N,D*2L) output array
+    Applies positional_encoding to every value at once. Returns an (N,D*2L) float64 array with the same layout as concatenating
+    positional_encoding(val) for each value in a row
+    '''
+    vals = np.asarray(vals, dtype=float)
+    if out is None:
+        out = np.empty((vals.shape[0], vals.shape[1]*2*L))
+    # view the output as [value, frequency, sin/cos] so that the sines and cosines are written in place
+    out_view = out.reshape((vals.shape[0], vals.shape[1], L, 2))
+    np.multiply(vals[:,:,None], frequency_bands(L), out=out_view[...,0])
+    np.cos(out_view[...,0], out=out_view[...,1])
+    np.sin(out_view[...,0], out=out_view[...,0])
+    return out
+
+def positional_encoding_torch(vals, L=10, out=None):
+    '''
+    Torch version of positional_encoding_batch. vals is an (N,D) tensor, and the encoding is computed on its device and in its dtype
+    (use float64 inputs to get the same values as positional_encoding)
+    out  - optional preallocated (N,D*2L) output tensor
+    '''
+    if out is None:
+        out = vals.new_empty((vals.shape[0], vals.shape[1]*2*L))
+    out_view = out.view((vals.shape[0], vals.shape[1], L, 2))
+    angles = vals[:,:,None] * vals.new_tensor(frequency_bands(L))
+    out_view[...,0] = angles.sin()
+    out_view[...,1] = angles.cos()
+    return out
 
 def saveLossesCurve(*args, **kwargs):
     '''
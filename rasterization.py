@@ -275,3 +275,216 @@ def ray_all_depths(faces, verts, near_face_threshold=0.08, ray_start_depth=1., r
         return intersections, original_faces[intersected_faces_i]
     else:
         return intersections
+
+
+# -------     BATCHED RAY INTERSECTION     -------
+
+def get_face_data(faces, verts):
+    '''
+    Precomputes the per-face quantities used by the batched intersection functions. This only has to be done once per mesh
+    and can be reused for any number of rays.
+    Each edge is stored in Pluecker coordinates (direction, moment) so that the halfspace test from get_weights can be done
+    for a ray in any orientation without rotating the mesh.
+
+    Returns a dictionary with
+        edge_dirs     - (3,F,3) directions of the edges b-a, c-b, a-c
+        edge_moments  - (3,F,3) moments of the edges (start vertex cross direction)
+        normals       - (F,3) unnormalized face normals
+        plane_offsets - (F,) dot product of each face normal with the face's first vertex
+        v0, e1, e2    - (F,3) first vertex and the edges b-a and c-a, used by the Moller-Trumbore kernel
+        mt_u, mt_v    - (F,3) the cross products e2 x v0 and v0 x e1, used by the Moller-Trumbore kernel
+    '''
+    a = verts[faces][:,0]
+    b = verts[faces][:,1]
+    c = verts[faces][:,2]
+    edge_starts = np.stack([a, b, c])
+    edge_dirs = np.stack([b-a, c-b, a-c])
+    edge_moments = np.cross(edge_starts, edge_dirs)
+    normals = np.cross(b-a, c-a)
+    plane_offsets = np.sum(normals*a, axis=1)
+    return {
+        "edge_dirs": edge_dirs,
+        "edge_moments": edge_moments,
+        "normals": normals,
+        "plane_offsets": plane_offsets,
+        "v0": a,
+        "e1": b-a,
+        "e2": c-a,
+        "mt_u": np.cross(c-a, a),
+        "mt_v": np.cross(a, b-a),
+    }
+
+def subset_face_data(face_data, face_indices):
+    '''
+    Returns the face data (see get_face_data) of only the faces in face_indices
+    '''
+    return {key: (val[:,face_indices] if key in ["edge_dirs", "edge_moments"] else val[face_indices]) for key, val in face_data.items()}
+
+def cone_cull(verts, faces, apex, corner_directions, tolerance=1e-7):
+    '''
+    Returns a boolean mask of the faces that could intersect a ray leaving apex in a direction within the convex cone spanned by corner_directions
+        corner_directions - (K,3) directions of the cone's edges, in order around the cone (e.g. the corner rays of a block of pixels)
+    A face is culled if all of its vertices lie outside the same side plane of the cone, so no face that such a ray hits is ever removed.
+    Degenerate side planes (e.g. the cone of a single row of pixels) don't cull anything
+    '''
+    normals = np.cross(corner_directions, np.roll(corner_directions, -1, axis=0))
+    # orient the side planes so that the inside of the cone is on their positive side
+    normals *= np.where(np.matmul(normals, np.mean(corner_directions, axis=0)) < 0., -1., 1.)[:,np.newaxis]
+    lengths = np.linalg.norm(normals, axis=1)
+    normals = normals / np.where(lengths > 0., lengths, 1.)[:,np.newaxis]
+    offsets = verts - apex
+    outside = np.matmul(offsets, normals.T) < -tolerance * np.linalg.norm(offsets, axis=1)[:,np.newaxis]
+    return np.logical_not(np.any(np.all(outside[faces], axis=1), axis=1))
+
+def batch_intersections(face_data, origins, directions):
+    '''
+    Intersects a batch of N rays with every face in face_data (see get_face_data)
+    directions should be unit length so that the returned values are euclidean distances
+
+    This function returns
+        hit, an NxF boolean array indicating whether the line through each ray intersects each face
+        t, an NxF array with the signed distance from the ray origin to the intersection (only meaningful where hit is True)
+
+    A face is hit if the ray passes on the same side of all three of its edges (the same inclusive test as the halfspace weights in
+    get_weights). Faces that are parallel to the ray are never hit.
+    '''
+    ray_moments = np.cross(origins, directions)
+    # permuted inner product between the ray and each edge. The sign says which side of the edge the ray passes on
+    sides = [np.matmul(directions, face_data["edge_moments"][i].T) + np.matmul(ray_moments, face_data["edge_dirs"][i].T) for i in range(3)]
+    inside = np.logical_or(np.logical_and(np.logical_and(sides[0] >= 0., sides[1] >= 0.), sides[2] >= 0.),
+                           np.logical_and(np.logical_and(sides[0] <= 0., sides[1] <= 0.), sides[2] <= 0.))
+    n_dot_d = np.matmul(directions, face_data["normals"].T)
+    hit = np.logical_and(inside, n_dot_d != 0.)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (face_data["plane_offsets"][np.newaxis,:] - np.matmul(origins, face_data["normals"].T)) / n_dot_d
+    return hit, t
+
+def moller_trumbore_intersections(face_data, origins, directions, max_elements=1000000):
+    '''
+    Same as batch_intersections, but uses the Moller-Trumbore ray/triangle test on the precomputed edges e1, e2 of each face
+    https://www.tandfonline.com/doi/abs/10.1080/10867651.1997.10487468
+    The triple products in the test are expanded so that every term is either a per-face quantity from get_face_data or
+    a matrix product between a block of rays and a block of faces. At most max_elements ray/face pairs are processed at once.
+    '''
+    n_rays = origins.shape[0]
+    n_faces = face_data["v0"].shape[0]
+    hit = np.zeros((n_rays, n_faces), dtype=bool)
+    t = np.zeros((n_rays, n_faces))
+    ray_moments = np.cross(origins, directions)
+    face_block = max(1, max_elements // max(n_rays, 1))
+    for start in range(0, n_faces, face_block):
+        block = slice(start, min(start + face_block, n_faces))
+        # det = e1 . (d x e2)
+        det = -np.matmul(directions, face_data["normals"][block].T)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            inv_det = 1. / det
+            # u = (o - v0) . (d x e2) / det
+            u = (np.matmul(ray_moments, face_data["e2"][block].T) - np.matmul(directions, face_data["mt_u"][block].T)) * inv_det
+            # v = d . ((o - v0) x e1) / det
+            v = (-np.matmul(ray_moments, face_data["e1"][block].T) - np.matmul(directions, face_data["mt_v"][block].T)) * inv_det
+            # t = e2 . ((o - v0) x e1) / det
+            t[:,block] = (np.matmul(origins, face_data["normals"][block].T) - face_data["plane_offsets"][np.newaxis,block]) * inv_det
+        # barycentric coordinates (u,v) must lie within the triangle. Faces parallel to the ray (det = 0) are never hit
+        hit[:,block] = np.logical_and(np.logical_and(det != 0., u >= 0.), np.logical_and(v >= 0., u + v <= 1.))
+    return hit, t
+
+INTERSECTION_KERNELS = {
+    "pluecker": batch_intersections,
+    "moller_trumbore": moller_trumbore_intersections,
+}
+
+def _ray_chunks(n_rays, n_faces, max_elements, verbose=False):
+    '''
+    Yields slices over the rays so that each chunk is compared with at most max_elements ray/face pairs
+    '''
+    chunk_size = max(1, max_elements // max(n_faces, 1))
+    starts = range(0, n_rays, chunk_size)
+    for start in (tqdm(starts) if verbose else starts):
+        yield slice(start, min(start + chunk_size, n_rays))
+
+def _pad_hits(rows, values, n_rays, max_hits, fill, faces=None):
+    '''
+    Packs the values of the hits in each row into a padded (n_rays, max_hits) array, sorted by value
+    Rows and values must already be sorted by row, then value
+    '''
+    n_hits = np.bincount(rows, minlength=n_rays)
+    row_starts = np.cumsum(n_hits) - n_hits
+    positions = np.arange(rows.shape[0]) - row_starts[rows]
+    keep = positions < max_hits
+    padded = np.full((n_rays, max_hits), fill, dtype=values.dtype)
+    padded[rows[keep], positions[keep]] = values[keep]
+    if faces is not None:
+        padded_faces = np.full((n_rays, max_hits), -1, dtype=int)
+        padded_faces[rows[keep], positions[keep]] = faces[keep]
+        return padded, n_hits, padded_faces
+    return padded, n_hits
+
+def ray_all_depths_batch(faces, verts, origins, directions, max_hits=None, return_faces=False, face_data=None, max_elements=4000000, verbose=False, kernel="pluecker"):
+    '''
+    Batched version of ray_all_depths. Rather than rotating the mesh for every ray, the rays are tested against precomputed
+    face data (see get_face_data) in chunks of at most max_elements ray/face pairs.
+        origins    - (N,3) ray start points
+        directions - (N,3) ray directions (do not need to be normalized)
+        max_hits   - the width of the padded output. If None, this is the largest number of intersections in the batch
+        face_data  - can be passed so that the face precomputation is only done once per mesh
+        kernel     - the ray/triangle test to use, one of INTERSECTION_KERNELS
+
+    This function returns
+        depths, an (N,max_hits) array with the sorted positive depths to each intersection, padded with np.inf
+        n_ints, an (N,) array with the total number of positive intersections for each ray (not capped at max_hits)
+        intersected_faces, an (N,max_hits) array of face indices padded with -1 (only returned if return_faces is True)
+    '''
+    if face_data is None:
+        face_data = get_face_data(faces, verts)
+    origins = np.asarray(origins, dtype=float).reshape((-1,3))
+    directions = np.asarray(directions, dtype=float).reshape((-1,3))
+    directions = directions / np.linalg.norm(directions, axis=1)[:,np.newaxis]
+    n_rays = origins.shape[0]
+    n_faces = face_data["normals"].shape[0]
+
+    all_rows = []
+    all_depths = []
+    all_faces = []
+    for chunk in _ray_chunks(n_rays, n_faces, max_elements, verbose=verbose):
+        hit, t = INTERSECTION_KERNELS[kernel](face_data, origins[chunk], directions[chunk])
+        rows, cols = np.nonzero(np.logical_and(hit, t > 0.))
+        all_rows.append(rows + chunk.start)
+        all_depths.append(t[rows, cols])
+        all_faces.append(cols)
+    rows = np.concatenate(all_rows) if n_rays > 0 else np.zeros((0,), dtype=int)
+    depths = np.concatenate(all_depths) if n_rays > 0 else np.zeros((0,))
+    hit_faces = np.concatenate(all_faces) if n_rays > 0 else np.zeros((0,), dtype=int)
+
+    order = np.lexsort((depths, rows))
+    rows, depths, hit_faces = rows[order], depths[order], hit_faces[order]
+    if max_hits is None:
+        max_hits = int(np.max(np.bincount(rows, minlength=n_rays))) if n_rays > 0 else 0
+    return _pad_hits(rows, depths, n_rays, max_hits, np.inf, faces=hit_faces if return_faces else None)
+
+def ray_occ_depth_batch(faces, verts, origins, directions, face_data=None, max_elements=4000000, verbose=False, kernel="pluecker"):
+    '''
+    Batched version of ray_occ_depth (without the v argument).
+        origins    - (N,3) ray start points
+        directions - (N,3) ray directions (do not need to be normalized)
+        kernel     - the ray/triangle test to use, one of INTERSECTION_KERNELS
+
+    This function returns
+        occ, an (N,) boolean array indicating whether or not the start of each ray lies within the mesh
+        depth, an (N,) array with the depth to the first intersection, or np.inf if there are no intersections in the positive direction
+    '''
+    if face_data is None:
+        face_data = get_face_data(faces, verts)
+    origins = np.asarray(origins, dtype=float).reshape((-1,3))
+    directions = np.asarray(directions, dtype=float).reshape((-1,3))
+    directions = directions / np.linalg.norm(directions, axis=1)[:,np.newaxis]
+    n_rays = origins.shape[0]
+    n_faces = face_data["normals"].shape[0]
+
+    occ = np.zeros((n_rays,), dtype=bool)
+    depth = np.full((n_rays,), np.inf)
+    for chunk in _ray_chunks(n_rays, n_faces, max_elements, verbose=verbose):
+        hit, t = INTERSECTION_KERNELS[kernel](face_data, origins[chunk], directions[chunk])
+        # an odd number of intersections behind the origin means the origin is inside the mesh
+        occ[chunk] = np.sum(np.logical_and(hit, t <= 0.), axis=1) % 2 != 0
+        depth[chunk] = np.min(np.where(np.logical_and(hit, t > 0.), t, np.inf), axis=1, initial=np.inf)
+    return occ, depth
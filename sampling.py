@@ -6,6 +6,7 @@ Also - add additional training examples by adding d to start point and d to dept
 from numpy import random
 import rasterization
 import odf_utils
+from mesh_geometry import MeshGeometry
 
 import numpy as np
 import argparse
@@ -166,6 +167,165 @@ def sample_tangential_4D(radius, verts=None, noise=0.01, vert_normals=None, v=No
     return bound1, bound2, None
 
 
+# -------     BATCH SAMPLING METHODS     -------
+# Each batch method draws n rays at once from a numpy.random.Generator and returns (n,3) start and end point arrays, and
+# the (n,) array of end vertices (or None), matching the outputs of the single ray method with the same name
+
+def choose_vertices(n, verts, v=None, rng=None):
+    '''
+    Returns n vertex indices chosen uniformly at random, or v repeated n times if v is given
+    '''
+    if v is not None:
+        return np.full((n,), v, dtype=int)
+    return rng.integers(0, verts.shape[0], size=n)
+
+def sample_uniform_ray_space_batch(n, radius, rng=None, **kwargs):
+    '''
+    Batched version of sample_uniform_ray_space. n is the number of rays, rng an optional numpy Generator
+    Returns (n,3) start points within the sphere, (n,3) end points half a unit away in random directions, and None
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    start_points = odf_utils.random_within_sphere_batch(n, radius, rng=rng)
+    end_points = start_points + odf_utils.random_on_sphere_batch(n, 0.5, rng=rng)
+    return start_points, end_points, None
+
+def sample_vertex_batch(n, radius, verts=None, rng=None, **kwargs):
+    '''
+    Batched version of sample_vertex. n is the number of rays, rng an optional numpy Generator
+    Returns (n,3) start points within the sphere, the (n,3) chosen vertices as end points, and the (n,) vertex indices
+    '''
+    assert(verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    start_points = odf_utils.random_within_sphere_batch(n, radius, rng=rng)
+    v = choose_vertices(n, verts, rng=rng)
+    return start_points, verts[v], v
+
+def sample_vertex_noise_batch(n, radius, verts=None, noise=0.01, rng=None, **kwargs):
+    '''
+    Batched version of sample_vertex_noise. noise is the sigma of the gaussian added to each end point
+    Returns (n,3) start points within the sphere, (n,3) end points near random vertices, and None
+    '''
+    assert(verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    start_points = odf_utils.random_within_sphere_batch(n, radius, rng=rng)
+    v = choose_vertices(n, verts, rng=rng)
+    end_points = verts[v] + rng.normal(scale=noise, size=(n,3))
+    return start_points, end_points, None
+
+def sample_vertex_all_directions_batch(n, radius, verts=None, noise=0.01, v=None, rng=None, **kwargs):
+    '''
+    Batched version of sample_vertex_all_directions. noise is the sigma of the gaussian added to each end point, and if the
+    vertex index v is given every ray ends near that vertex instead of a random one
+    Returns (n,3) start points on the chords through the end points, (n,3) end points, and None
+    '''
+    assert(verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    v = choose_vertices(n, verts, v=v, rng=rng)
+    end_points = verts[v] + rng.normal(scale=noise, size=(n,3))
+    directions = odf_utils.random_on_sphere_batch(n, 1.0, rng=rng)
+    bound1, bound2 = odf_utils.get_sphere_intersections_batch(end_points, directions, radius)
+    position = rng.random(n)[:,None]
+    return bound1*position + (1.-position)*bound2, end_points, None
+
+def sample_vertex_tangential_batch(n, radius, verts=None, noise=0.01, vert_normals=None, v=None, rng=None, **kwargs):
+    '''
+    Batched version of sample_vertex_tangential. vert_normals are the (V,3) vertex normals used to make each ray tangent to
+    the surface, noise is the sigma of the gaussian added to each end point, and v optionally fixes the vertex
+    Returns (n,3) start points on the tangent chords through the end points, (n,3) end points, and None
+    '''
+    assert(vert_normals is not None and verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    v = choose_vertices(n, verts, v=v, rng=rng)
+    end_points = verts[v] + rng.normal(scale=noise, size=(n,3))
+    directions = np.cross(vert_normals[v], odf_utils.random_on_sphere_batch(n, 1.0, rng=rng))
+    bound1, bound2 = odf_utils.get_sphere_intersections_batch(end_points, directions, radius)
+    position = rng.random(n)[:,None]
+    return bound1*position + (1.-position)*bound2, end_points, None
+
+def sample_uniform_4D_batch(n, radius, rng=None, **kwargs):
+    '''
+    Batched version of sample_uniform_4D. n is the number of rays, rng an optional numpy Generator
+    Returns (n,3) start points and (n,3) end points, both uniform on the bounding sphere, and None
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    start_points = odf_utils.random_on_sphere_batch(n, radius, rng=rng)
+    end_points = odf_utils.random_on_sphere_batch(n, radius, rng=rng)
+    return start_points, end_points, None
+
+def sample_vertex_4D_batch(n, radius, verts=None, noise=0.01, v=None, rng=None, **kwargs):
+    '''
+    Batched version of sample_vertex_4D. noise is the sigma of the gaussian added to the point each ray passes through, and
+    if the vertex index v is given every ray passes near that vertex instead of a random one
+    Returns the (n,3) start and (n,3) end points where the rays enter and leave the bounding sphere, and None
+    '''
+    assert(verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    v = choose_vertices(n, verts, v=v, rng=rng)
+    end_points = verts[v] + rng.normal(scale=noise, size=(n,3))
+    directions = odf_utils.random_on_sphere_batch(n, 1.0, rng=rng)
+    bound1, bound2 = odf_utils.get_sphere_intersections_batch(end_points, directions, radius)
+    return bound1, bound2, None
+
+def sample_tangential_4D_batch(n, radius, verts=None, noise=0.01, vert_normals=None, v=None, rng=None, **kwargs):
+    '''
+    Batched version of sample_tangential_4D. vert_normals are the (V,3) vertex normals used to make each ray tangent to the
+    surface, noise is the sigma of the gaussian added to the point each ray passes through, and v optionally fixes the vertex
+    Returns the (n,3) start and (n,3) end points where the rays enter and leave the bounding sphere, and None
+    '''
+    assert(vert_normals is not None and verts is not None)
+    rng = np.random.default_rng() if rng is None else rng
+    v = choose_vertices(n, verts, v=v, rng=rng)
+    end_points = verts[v] + rng.normal(scale=noise, size=(n,3))
+    directions = np.cross(vert_normals[v], odf_utils.random_on_sphere_batch(n, 1.0, rng=rng))
+    bound1, bound2 = odf_utils.get_sphere_intersections_batch(end_points, directions, radius)
+    return bound1, bound2, None
+
+# maps each single ray sampling method to its batch version
+BATCH_SAMPLERS = {
+    sample_uniform_ray_space: sample_uniform_ray_space_batch,
+    sample_vertex: sample_vertex_batch,
+    sample_vertex_noise: sample_vertex_noise_batch,
+    sample_vertex_all_directions: sample_vertex_all_directions_batch,
+    sample_vertex_tangential: sample_vertex_tangential_batch,
+    sample_uniform_4D: sample_uniform_4D_batch,
+    sample_vertex_4D: sample_vertex_4D_batch,
+    sample_tangential_4D: sample_tangential_4D_batch,
+}
+
+def get_batch_sampler(sampling_method):
+    '''
+    Returns the batch version of a sampling method. Methods without one are wrapped so that they are called once per ray
+    '''
+    if hasattr(sampling_method, "batch"):
+        return sampling_method.batch
+    if sampling_method in BATCH_SAMPLERS:
+        return BATCH_SAMPLERS[sampling_method]
+    def looped(n, radius, rng=None, **kwargs):
+        rays = [sampling_method(radius, **kwargs) for _ in range(n)]
+        v = np.array([-1 if ray[2] is None else ray[2] for ray in rays], dtype=int)
+        return np.array([ray[0] for ray in rays]), np.array([ray[1] for ray in rays]), v if np.any(v >= 0) else None
+    return looped
+
+def sample_mixture_batch(n, radius, sampling_methods, sampling_frequency, rng=None, **kwargs):
+    '''
+    Samples n rays from a mixture of sampling methods. The number of rays for each method is drawn from a multinomial with
+    probabilities sampling_frequency, and the rays are shuffled together
+    Returns (n,3) start points, (n,3) end points, and the (n,) end vertices (-1 where the ray doesn't end on a vertex)
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    counts = rng.multinomial(n, np.array(sampling_frequency) / np.sum(sampling_frequency))
+    start_points, end_points, vertices = [], [], []
+    for sampling_method, count in zip(sampling_methods, counts):
+        if count == 0:
+            continue
+        starts, ends, v = get_batch_sampler(sampling_method)(count, radius, rng=rng, **kwargs)
+        start_points.append(starts)
+        end_points.append(ends)
+        vertices.append(np.full((count,), -1, dtype=int) if v is None else v)
+    order = rng.permutation(n)
+    return np.concatenate(start_points)[order], np.concatenate(end_points)[order], np.concatenate(vertices)[order]
+
+
 # -------     CONSISTENCY SAMPLING --------
 
 def consistency_sampler(radius, verts, max_intersections=1):
@@ -177,13 +337,27 @@ def consistency_sampler(radius, verts, max_intersections=1):
 
 # -------     SAMPLING HELPER     -------
 
+class PresetNoise():
+    '''
+    A sampling method with a different noise value set. Unlike a closure, this can be pickled and sent to worker processes
+    '''
+
+    def __init__(self, sampling_method, noise):
+        self.sampling_method = sampling_method
+        self.noise = noise
+        self.__name__ = f"{sampling_method.__name__}(noise={noise})"
+
+    def __call__(self, radius, verts=None, vert_normals=None, v=None, **kwargs):
+        return self.sampling_method(radius, verts=verts, noise=self.noise, vert_normals=vert_normals, v=None, **kwargs)
+
+    def batch(self, n, radius, verts=None, vert_normals=None, rng=None, **kwargs):
+        return get_batch_sampler(self.sampling_method)(n, radius, verts=verts, noise=self.noise, vert_normals=vert_normals, rng=rng, **kwargs)
+
 def sampling_preset_noise(sampling_method, noise):
     '''
     Defines a new version of one of the sampling functions with a different noise value set
     '''
-    def preset_noise(radius, verts=None, vert_normals=None, v=None, **kwargs):
-        return sampling_method(radius, verts=verts, noise=noise, vert_normals=vert_normals, v=None, **kwargs)
-    return preset_noise
+    return PresetNoise(sampling_method, noise)
 
 
 if __name__ == "__main__":
@@ -194,6 +368,7 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--depthmap", action="store_true", help="show a depth map image of the mesh")
     parser.add_argument("-c", "--coverage", action="store_true", help="show the intersected vertices of the mesh")
     parser.add_argument("--use_4d", action="store_true", help="show results for the 4D sampling strategies")
+    parser.add_argument("--backend", default="brute", choices=["brute", "bvh", "grid"], help="acceleration structure to use for the speed benchmarks ('bvh' and 'grid' also report traversal stats)")
     parser.add_argument("--mesh_file", default="F:\\ivl-data\\sample_data\\stanford_bunny.obj", help="Source of mesh file")
     args = parser.parse_args()
 
@@ -208,19 +383,18 @@ if __name__ == "__main__":
     # verts = np.array(smpl_data["smpl_mesh_v"])
     # faces = np.array(np.load(faces_path, allow_pickle=True))
 
-    mesh = trimesh.load(args.mesh_file)
-    faces = mesh.faces
-    verts = mesh.vertices
-    
-    verts = odf_utils.mesh_normalize(verts)
+    # normals and edge lengths are cached next to the mesh file
+    geometry = MeshGeometry.from_file(args.mesh_file)
+    faces = geometry.faces
+    verts = geometry.verts
     radius = 1.25
     fixed_endpoint = 700
 
 
 
     # threshold for how far away a face can be from the ray before it gets culled in rasterization
-    near_face_threshold = rasterization.max_edge(verts, faces)
-    vert_normals = odf_utils.get_vertex_normals(verts, faces)
+    near_face_threshold = geometry.max_edge
+    vert_normals = geometry.vertex_normals
 
     if not args.use_4d:
         sampling_methods = [sample_uniform_ray_space, sample_vertex_noise, sample_vertex_all_directions, sample_vertex_tangential]
@@ -254,12 +428,22 @@ if __name__ == "__main__":
         
     if args.speed:
         n_samples = 1000
+        if args.backend != "brute":
+            import acceleration
+            accelerator = acceleration.make_accelerator(args.backend, verts, faces, near_face_threshold=near_face_threshold, radius=radius)
+            print(f"Built {args.backend} in {accelerator.build_time:.3f} seconds")
         print(f"Generating {n_samples} samples per test")
         for i, sampling_method in enumerate(sampling_methods):
             print(method_names[i])
             start = datetime.datetime.now()
             for _ in range(n_samples):
                 ray_start, ray_end, v = sampling_method(radius, verts=verts, vert_normals=vert_normals, v=None)
+                if args.backend != "brute":
+                    if args.use_4d:
+                        depths = accelerator.ray_all_depths(ray_start, ray_end, return_faces=False)
+                    else:
+                        occ, depth = accelerator.ray_occ_depth(ray_start, ray_end, v=v)
+                    continue
                 rot_verts = rasterization.rotate_mesh(verts, ray_start, ray_end)
                 if args.use_4d:
                     depths = rasterization.ray_all_depths(faces, rot_verts, near_face_threshold=near_face_threshold, return_faces=False)
@@ -268,6 +452,13 @@ if __name__ == "__main__":
             end = datetime.datetime.now()
             secs = (end-start).total_seconds()
             print(f"\t{n_samples/secs :.0f} rays per second")
+            start = datetime.datetime.now()
+            get_batch_sampler(sampling_method)(n_samples, radius, verts=verts, vert_normals=vert_normals, rng=np.random.default_rng())
+            secs = (datetime.datetime.now()-start).total_seconds()
+            print(f"\t{n_samples/secs :.0f} rays per second sampled with the batch sampler (no intersection)")
+            if args.backend != "brute":
+                print(f"\t{accelerator.summary()}")
+                accelerator.reset_stats()
 
     if args.depthmap:
         import visualization
@@ -300,7 +491,7 @@ if __name__ == "__main__":
         visualizer.display()
 
         cam = Camera(center=cam_center, direction=direction, focal_length=focal_length, sensor_size=sensor_size, sensor_resolution=resolution)
-        intersection, depth = cam.mesh_depthmap(cam.rays_on_sphere(cam.generate_rays(), radius), verts, faces)
+        intersection, depth = cam.mesh_depthmap(cam.clip_rays_to_sphere(*cam.generate_ray_arrays(), radius), verts, faces)
         plt.imshow(depth)
         plt.show()
         plt.imshow(intersection)
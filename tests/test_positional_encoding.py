@@ -0,0 +1,116 @@
+'''
+Checks that the vectorized positional encodings have the same values and column layout as odf_utils.positional_encoding
+'''
+
+import os
+import sys
+import numpy as np
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
+import odf_utils
+
+SHAPES = [(1,1), (5,3), (7,6)]
+LS = [1, 4, 10]
+
+
+def reference_encoding(vals, L=10):
+    '''
+    Concatenates positional_encoding(val) for each value in a row, which is the layout every caller expects
+    '''
+    return np.array([[x for val in row for x in odf_utils.positional_encoding(val, L=L)] for row in vals])
+
+def random_values(shape, seed=0):
+    return np.random.default_rng(seed).uniform(-1.5, 1.5, size=shape)
+
+
+@pytest.mark.parametrize("L", LS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_batch_matches_reference(shape, L):
+    vals = random_values(shape)
+    expected = reference_encoding(vals, L=L)
+    encoded = odf_utils.positional_encoding_batch(vals, L=L)
+    assert encoded.shape == (shape[0], shape[1]*2*L)
+    assert encoded.dtype == np.float64
+    np.testing.assert_allclose(encoded, expected, rtol=0., atol=1e-12)
+
+    out = np.full(expected.shape, np.nan)
+    returned = odf_utils.positional_encoding_batch(vals, L=L, out=out)
+    assert returned is out
+    np.testing.assert_array_equal(out, encoded)
+
+@pytest.mark.parametrize("L", LS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_torch_matches_reference(shape, L):
+    vals = random_values(shape)
+    expected = reference_encoding(vals, L=L)
+    encoded = odf_utils.positional_encoding_torch(torch.tensor(vals, dtype=torch.float64), L=L)
+    assert encoded.dtype == torch.float64
+    np.testing.assert_allclose(encoded.numpy(), expected, rtol=0., atol=1e-12)
+
+    out = torch.full(expected.shape, np.nan, dtype=torch.float64)
+    returned = odf_utils.positional_encoding_torch(torch.tensor(vals, dtype=torch.float64), L=L, out=out)
+    assert returned is out
+    np.testing.assert_array_equal(out.numpy(), encoded.numpy())
+
+def test_column_order():
+    # columns are [value, frequency, (sin, cos)]: value j fills columns j*2L to (j+1)*2L, alternating sin and cos of increasing frequency
+    L = 3
+    vals = np.array([[0.25, -0.5]])
+    encoded = odf_utils.positional_encoding_batch(vals, L=L)
+    for j, val in enumerate(vals[0]):
+        for i in range(L):
+            assert encoded[0, j*2*L + 2*i] == pytest.approx(np.sin(2**i*np.pi*val), abs=1e-12)
+            assert encoded[0, j*2*L + 2*i + 1] == pytest.approx(np.cos(2**i*np.pi*val), abs=1e-12)
+
+def test_model_pos_encoding():
+    import model
+    points = torch.tensor(random_values((8,6)), dtype=torch.float32)
+    expected = reference_encoding(points.double().numpy()).astype(np.float32)
+    encoded = model.pos_encoding(points)
+    assert encoded.dtype == torch.float32
+    np.testing.assert_array_equal(encoded.numpy(), expected)
+
+def test_ray_batch_layout():
+    import data
+    rng = np.random.default_rng(1)
+    ray_start = rng.uniform(-1., 1., size=(4,3))
+    ray_end = rng.uniform(-1., 1., size=(4,3))
+    depths = np.full((4,2), np.inf)
+    n_ints = np.zeros((4,), dtype=int)
+    batch = data.ray_batch(ray_start, ray_end, depths, n_ints, pos_enc=True)
+    direction = (ray_end - ray_start) / np.linalg.norm(ray_end - ray_start, axis=1)[:,None]
+    expected = {
+        "coordinates_points": np.hstack([ray_start, ray_end]),
+        "coordinates_direction": np.hstack([ray_start, direction]),
+        "coordinates_pluecker": np.hstack([direction, np.cross(ray_start, direction)]),
+    }
+    for key, vals in expected.items():
+        np.testing.assert_array_equal(batch[key].numpy(), reference_encoding(vals).astype(np.float32))
+
+def test_camera_model_depthmap_layout():
+    import camera
+
+    class RecordingModel(torch.nn.Module):
+        # stands in for the learned model and keeps the encoded rays it was queried with
+        def forward(self, encoded_rays):
+            self.inputs = encoded_rays.clone()
+            return None, torch.zeros(encoded_rays.shape[0]), torch.zeros(encoded_rays.shape[0])
+
+    rng = np.random.default_rng(2)
+    origins = rng.uniform(-1., 1., size=(4,3))
+    directions = rng.uniform(-1., 1., size=(4,3))
+    valid = np.ones((4,), dtype=bool)
+    recorder = RecordingModel()
+    cam = camera.Camera(sensor_resolution=[2,2], verbose=False)
+    cam.model_depthmap((origins, directions, valid), recorder)
+    unit_directions = directions / np.linalg.norm(directions, axis=1)[:,None]
+    expected = reference_encoding(np.hstack([origins, unit_directions])).astype(np.float32)
+    np.testing.assert_array_equal(recorder.inputs.numpy(), expected)
+
+def test_v2_get_positional_enc_layout():
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../v2'))
+    import odf_v2_utils
+    vals = random_values((5,6))
+    np.testing.assert_allclose(odf_v2_utils.get_positional_enc(vals), reference_encoding(vals), rtol=0., atol=1e-12)
@@ -9,18 +9,19 @@ import argparse
 import os
 from tqdm import tqdm
 import numpy as np
-from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
 import trimesh
 import math
 # from beacon.utils import saveLossesCurve
 
-from data import DepthData, MultiDepthDataset
+from data import DepthData, MultiDepthDataset, ShardedRayDataset, batch_loader, generate_ray_shards
 from model import LF4D, AdaptedLFN, SimpleMLP
+from mesh_geometry import MeshGeometry
 import odf_utils
-from camera import Camera, DepthMapViewer, save_video, save_video_4D
+from camera import Camera, DepthMapCache, DepthMapViewer, save_video, save_video_4D, save_video_4D_stream, render_frames_4D
 import sampling
 import rasterization
+import acceleration
 import meshing_3d
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -143,6 +144,61 @@ def train_epoch(model, train_loader, optimizer, lmbda, coord_type, unordered=Fal
     print(f"Average Depth Loss: {avg_depth_loss:.4f}")
     return avg_loss, avg_int_loss, avg_depth_loss
 
+class StreamingTestMetrics():
+    '''
+    Accumulates the intersection confusion matrix and a histogram of depth errors on the device as batches come in.
+    Memory is fixed no matter how many rays are evaluated and nothing is copied to the host until summary() is called.
+        max_depth_error - errors at or above this go into the last histogram bin (the mean is still exact)
+        n_bins          - number of histogram bins, the median is accurate to within max_depth_error / n_bins
+    '''
+
+    def __init__(self, max_depth_error=4.0, n_bins=65536, device=None):
+        self.max_depth_error = max_depth_error
+        self.n_bins = n_bins
+        self.bin_width = max_depth_error / n_bins
+        # [TN, FP, FN, TP]
+        self.confusion = torch.zeros(4, dtype=torch.int64, device=device)
+        self.depth_hist = torch.zeros(n_bins, dtype=torch.int64, device=device)
+        self.depth_error_sum = torch.zeros((), dtype=torch.float64, device=device)
+
+    def update(self, int_label, int_pred, depth_errors, depth_mask):
+        '''
+        int_label, int_pred - boolean intersection labels and predictions (any matching shapes)
+        depth_errors        - absolute depth errors, only the entries where depth_mask is True are counted
+        '''
+        # index_add_ into the fixed 4 slots, torch.bincount would read the largest index back to the host to size its output
+        cells = int_label.reshape(-1).long() * 2 + int_pred.reshape(-1).long()
+        self.confusion.index_add_(0, cells, torch.ones_like(cells))
+        depth_errors = depth_errors.reshape(-1)
+        depth_mask = depth_mask.reshape(-1)
+        bins = torch.clamp((depth_errors / self.bin_width).long(), 0, self.n_bins - 1)
+        self.depth_hist.index_add_(0, bins, depth_mask.long())
+        self.depth_error_sum += torch.sum(torch.where(depth_mask, depth_errors, torch.zeros_like(depth_errors))).double()
+
+    def confusion_matrix(self):
+        '''
+        Returns the confusion matrix in the sklearn layout [[TN, FP], [FN, TP]]
+        '''
+        return self.confusion.cpu().numpy().reshape((2,2))
+
+    def depth_error_mean(self):
+        n = int(self.depth_hist.sum())
+        return float(self.depth_error_sum) / n if n > 0 else float("nan")
+
+    def depth_error_median(self):
+        '''
+        The median interpolated within the histogram bin that contains it
+        '''
+        hist = self.depth_hist.cpu().numpy()
+        n = np.sum(hist)
+        if n == 0:
+            return float("nan")
+        cumulative = np.cumsum(hist)
+        half = n / 2.
+        median_bin = np.searchsorted(cumulative, half)
+        below = cumulative[median_bin] - hist[median_bin]
+        return (median_bin + (half - below) / hist[median_bin]) * self.bin_width
+
 def test(model, test_loader, lmbda, coord_type, unordered=False):
     ce = nn.CrossEntropyLoss(reduction="mean")
     bce = nn.BCELoss(reduction="mean")
@@ -150,15 +206,7 @@ def test(model, test_loader, lmbda, coord_type, unordered=False):
     total_batches = 0.
     total_chamfer = 0.
 
-    all_depth_errors = []
-    all_int_pred = []
-    all_int_label = []
-
-    int_tn = 0.
-    int_fp = 0.
-    int_fn = 0.
-    int_tp = 0.
-
+    metrics = StreamingTestMetrics(device=device)
 
     with torch.no_grad():
         for batch in tqdm(test_loader):
@@ -174,6 +222,7 @@ def test(model, test_loader, lmbda, coord_type, unordered=False):
                 combined_int_mask = torch.logical_and(gt_any_int_mask, pred_any_int_mask)
                 depth_loss = lmbda * chamfer_loss_1d(depth[combined_int_mask], pred_depth[combined_int_mask], (intersect > 0.5)[combined_int_mask], (pred_int > 0.5)[combined_int_mask])
                 intersect_loss = push_top_n(intersect, pred_int)
+                pred_int_mask = pred_int > 0.5
             else:
                 intersect = intersect.reshape((-1,))
                 depth = depth.reshape((-1,))
@@ -190,14 +239,9 @@ def test(model, test_loader, lmbda, coord_type, unordered=False):
                 pred_int_mask = torch.cumsum(pred_int_mask, dim=1)
                 pred_int_mask = torch.logical_not(pred_int_mask)
                 pred_int_mask = pred_int_mask[:,:-1]
-                pred_int_mask = pred_int_mask.reshape((-1)).cpu().numpy()
-
-                all_int_pred.append(pred_int_mask)
 
             loss = intersect_loss + depth_loss
-            all_depth_errors.append(torch.abs(depth[intersect > 0.5] - pred_depth[intersect > 0.5]).cpu().numpy())
-            # all_int_pred.append(pred_int.cpu().numpy().flatten())
-            all_int_label.append(intersect.cpu().numpy().flatten())
+            metrics.update(intersect > 0.5, pred_int_mask, torch.abs(depth - pred_depth), intersect > 0.5)
             if unordered:
                 total_chamfer += depth_loss / lmbda
             total_loss += loss.detach()
@@ -210,7 +254,7 @@ def test(model, test_loader, lmbda, coord_type, unordered=False):
     print("[[TN    FP]\n [FN    TP]]")
 
     print("\nIntersection-")
-    int_confusion_mat = confusion_matrix(np.hstack(all_int_label), np.hstack(all_int_pred)>0.5)
+    int_confusion_mat = metrics.confusion_matrix()
     int_tn = int_confusion_mat[0][0]
     int_fp = int_confusion_mat[0][1]
     int_fn = int_confusion_mat[1][0]
@@ -227,13 +271,13 @@ def test(model, test_loader, lmbda, coord_type, unordered=False):
     print(int_confusion_mat)
 
     print("\nDepth-")
-    all_depth_errors = np.hstack(all_depth_errors)
-    print(f"Average Depth Error: {np.mean(all_depth_errors):.4f}")
-    print(f"Median Depth Error: {np.median(all_depth_errors):.4f}\n")
+    print(f"Average Depth Error: {metrics.depth_error_mean():.4f}")
+    print(f"Median Depth Error: {metrics.depth_error_median():.4f}\n")
 
-def viz_depth(model, verts, faces, radius, show_rays=False):
+def viz_depth(model, verts, faces, radius, show_rays=False, backend="brute", gt_cache=None):
     '''
     Visualize learned depth map and intersection mask compared to the ground truth
+    gt_cache is an optional camera.DepthMapCache that the ground truth images are read from and added to
     TODO: add depth map legend
     '''
     # these are the normalization bounds for coloring in the video
@@ -243,17 +287,20 @@ def viz_depth(model, verts, faces, radius, show_rays=False):
     fl = 1.0
     sensor_size = [1.0,1.0]
     resolution = [100,100]
-    zoom_out_cameras = [Camera(center=[1.25 + 0.2*x,0.0,0.0], direction=[-1.0,0.0,0.0], focal_length=fl, sensor_size=sensor_size, sensor_resolution=resolution) for x in range(4)]
-    data = [cam.mesh_and_model_depthmap(model, verts, faces, radius, show_rays=show_rays, fourd=True) for cam in zoom_out_cameras]
+    zoom_out_cameras = [Camera(center=[1.25 + 0.2*x,0.0,0.0], direction=[-1.0,0.0,0.0], focal_length=fl, sensor_size=sensor_size, sensor_resolution=resolution, backend=backend) for x in range(4)]
+    data = [cam.mesh_and_model_depthmap(model, verts, faces, radius, show_rays=show_rays, fourd=True, gt_cache=gt_cache) for cam in zoom_out_cameras]
     vmin = [min(np.min(mesh_depths[mesh_n_ints > 0.5]) if np.any(mesh_n_ints > 0.5) else np.inf, np.min(model_depths[model_n_ints > 0.5]) if np.any(model_n_ints > 0.5) else np.inf) for mesh_n_ints, mesh_depths, model_n_ints, model_depths in data]
     vmax = [max(np.max(mesh_depths[mesh_n_ints > 0.5]) if np.any(mesh_n_ints > 0.5) else -np.inf, np.max(model_depths[model_n_ints > 0.5]) if np.any(model_n_ints > 0.5) else -np.inf) for mesh_n_ints, mesh_depths, model_n_ints, model_depths in data]
     vmin = [vmin[i] if vmin[i] < np.inf else np.min(data[i][3]) for i in range(len(vmin))]
     vmax = [vmax[i] if vmax[i] > -np.inf else np.max(data[i][3]) for i in range(len(vmax))]
     DepthMapViewer(data, vmin, vmax, fourd=True)
 
-def equatorial_video(model, verts, faces, radius, n_frames, resolution, save_dir, name):
+def equatorial_video(model, verts, faces, radius, n_frames, resolution, save_dir, name, backend="brute", n_workers=None, gt_cache=None, scale_frames=8):
     '''
     Saves a rendered depth video from around the equator of the object
+    Ground truth frames are rendered by n_workers processes (see camera.render_frames_4D) and written as they finish
+    The intersection count color scale is the largest count in the first scale_frames frames (None uses every frame)
+    gt_cache is an optional camera.DepthMapCache that the ground truth frames are read from and added to
     '''
     video_dir = os.path.join(save_dir, "depth_videos")
     if not os.path.exists(video_dir):
@@ -269,10 +316,11 @@ def equatorial_video(model, verts, faces, radius, n_frames, resolution, save_dir
     angle_increment = 2*math.pi / n_frames
     z_vals = [np.cos(angle_increment*i)*radius for i in range(n_frames)]
     x_vals = [np.sin(angle_increment*i)*radius for i in range(n_frames)]
-    circle_cameras = [Camera(center=[x_vals[i],0.0,z_vals[i]], direction=[-x_vals[i],0.0,-z_vals[i]], focal_length=fl, sensor_size=sensor_size, sensor_resolution=resolution, verbose=False) for i in range(n_frames)]
-    rendered_views = [cam.mesh_and_model_depthmap(model, verts, faces, radius, fourd=True) for cam in tqdm(circle_cameras)]
+    circle_cameras = [Camera(center=[x_vals[i],0.0,z_vals[i]], direction=[-x_vals[i],0.0,-z_vals[i]], focal_length=fl, sensor_size=sensor_size, sensor_resolution=resolution, verbose=False, backend=backend) for i in range(n_frames)]
+    rendered_views = render_frames_4D(circle_cameras, model, verts, faces, radius, n_workers=n_workers, gt_cache=gt_cache)
 
-    save_video_4D(rendered_views, os.path.join(video_dir, f'4D_equatorial_{name}_rad{radius*100:.0f}.mp4'), vmin, vmax)
+    # the intersection count color scale comes from the first batch of frames, which are rendered before the video is opened
+    save_video_4D_stream(tqdm(rendered_views, total=n_frames), os.path.join(video_dir, f'4D_equatorial_{name}_rad{radius*100:.0f}.mp4'), vmin, vmax, scale_frames=scale_frames)
 
 def generate_point_cloud(model, sphere_vertices, vertices, faces, focal_point=[0., 0., 0.], show=True):
     '''
@@ -348,6 +396,9 @@ if __name__ == "__main__":
     parser.add_argument("--uniform", type=int, default=100, help="What percentage of the data should be uniformly sampled (0 -> 0%, 100 -> 100%)")
     parser.add_argument("--vertex", type=int, default=0, help="What percentage of the data should use vertex sampling (0 -> 0%, 100 -> 100%)")
     parser.add_argument("--tangent", type=int, default=0, help="What percentage of the data should use vertex tangent sampling (0 -> 0%, 100 -> 100%)")
+    parser.add_argument("--backend", default="brute", choices=acceleration.BACKENDS, help="How ground truth rays are cast against the mesh. 'bvh' and 'grid' build an acceleration structure once per mesh")
+    parser.add_argument("--ray_dir", type=str, default=None, help="Train and test on pre-generated ray shards in this directory (see generate_rays.py). Shards that don't match the current data settings are regenerated")
+    parser.add_argument("--shard_size", type=int, default=100000, help="Number of rays per shard when generating ray shards")
     # "F:\\ivl-data\\sample_data\\stanford_bunny.obj"
 
     # MODEL
@@ -378,6 +429,9 @@ if __name__ == "__main__":
     parser.add_argument("--show_rays", action="store_true", help="Visualize the camera's rays relative to the scene when rendering depthmaps")
     parser.add_argument("--n_frames", type=int, default=200, help="Number of frames to render if saving video")
     parser.add_argument("--video_resolution", type=int, default=250, help="The height and width of the rendered video (in pixels)")
+    parser.add_argument("--video_workers", type=int, default=None, help="Number of processes rendering ground truth video frames. Defaults to the number of cores, 0 renders them in the main process")
+    parser.add_argument("--gt_cache_dir", type=str, default=None, help="Where ground truth depth maps are cached between runs. Defaults to a depth_cache directory in save_dir")
+    parser.add_argument("--no_gt_cache", action="store_true", help="Always render the ground truth depth maps instead of using the cache")
 
     args = parser.parse_args()
 
@@ -393,10 +447,10 @@ if __name__ == "__main__":
     model = LF4D(input_size=(120 if args.pos_enc else 6), n_intersections=args.intersect_limit, radius=args.radius, coord_type=args.coord_type, pos_enc=args.pos_enc).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
 
-    mesh = trimesh.load(args.mesh_file)
-    faces = mesh.faces
-    verts = mesh.vertices
-    verts = odf_utils.mesh_normalize(verts)
+    # normals and edge data are cached next to the mesh file and shared by the train and test sets
+    geometry = MeshGeometry.from_file(args.mesh_file)
+    faces = geometry.faces
+    verts = geometry.verts
 
     sampling_methods = [sampling.sample_uniform_4D, 
                         sampling.sampling_preset_noise(sampling.sample_vertex_4D, args.vert_noise),
@@ -405,12 +459,19 @@ if __name__ == "__main__":
     assert(sum(sampling_frequency) == 1.0)
     test_sampling_frequency = [1., 0., 0.]
 
-    train_data = MultiDepthDataset(faces, verts, args.radius, sampling_methods, sampling_frequency, size=args.samples_per_mesh, intersect_limit=args.intersect_limit, pos_enc=args.pos_enc)
-    test_data = MultiDepthDataset(faces,verts,args.radius, sampling_methods, sampling_frequency, size=int(args.samples_per_mesh*0.1), intersect_limit=args.intersect_limit, pos_enc=args.pos_enc)
+    train_data = MultiDepthDataset(faces, verts, args.radius, sampling_methods, sampling_frequency, size=args.samples_per_mesh, intersect_limit=args.intersect_limit, pos_enc=args.pos_enc, backend=args.backend, geometry=geometry)
+    test_data = MultiDepthDataset(faces,verts,args.radius, sampling_methods, sampling_frequency, size=int(args.samples_per_mesh*0.1), intersect_limit=args.intersect_limit, pos_enc=args.pos_enc, backend=args.backend, geometry=geometry)
 
     # TODO: num_workers=args.n_workers
-    train_loader = DataLoader(train_data, batch_size=args.train_batch_size, shuffle=True, drop_last=True, pin_memory=True, num_workers=args.n_workers)
-    test_loader = DataLoader(test_data, batch_size=args.test_batch_size, shuffle=True, drop_last=True, pin_memory=True, num_workers=args.n_workers)
+    if args.ray_dir is not None:
+        generate_ray_shards(train_data, os.path.join(args.ray_dir, "train"), shard_size=args.shard_size, seed=0)
+        generate_ray_shards(test_data, os.path.join(args.ray_dir, "test"), shard_size=args.shard_size, seed=1)
+        train_data = ShardedRayDataset(os.path.join(args.ray_dir, "train"), pos_enc=args.pos_enc)
+        test_data = ShardedRayDataset(os.path.join(args.ray_dir, "test"), pos_enc=args.pos_enc)
+
+    # the datasets build each batch with one vectorized call
+    train_loader = batch_loader(train_data, args.train_batch_size, shuffle=True, drop_last=True, pin_memory=True, num_workers=args.n_workers)
+    test_loader = batch_loader(test_data, args.test_batch_size, shuffle=True, drop_last=True, pin_memory=True, num_workers=args.n_workers)
 
     if args.load:
         print("Loading saved model...")
@@ -435,10 +496,14 @@ if __name__ == "__main__":
         print("Testing model ...")
         model=model.eval()
         test(model, test_loader, args.lmbda, args.coord_type, unordered=args.unordered)
+    # ground truth images only depend on the mesh and cameras, so they are shared by every model trained on this mesh
+    gt_cache = None
+    if not args.no_gt_cache and (args.viz_depth or args.video):
+        gt_cache = DepthMapCache(args.gt_cache_dir if args.gt_cache_dir is not None else os.path.join(args.save_dir, "depth_cache"), verts, faces)
     if args.viz_depth:
         print("Visualizing depth map...")
         model=model.eval()
-        viz_depth(model, verts, faces, args.radius, args.show_rays)
+        viz_depth(model, verts, faces, args.radius, args.show_rays, backend=args.backend, gt_cache=gt_cache)
     if args.pointcloud:
         model = model.eval()
         sphere_vertices, _ = meshing_3d.icosahedron_sphere_tessalation(args.radius, subdivisions=4)
@@ -451,7 +516,7 @@ if __name__ == "__main__":
     if args.video:
         print(f"Rendering ({args.video_resolution}x{args.video_resolution}) video with {args.n_frames} frames...")
         model=model.eval()
-        equatorial_video(model, verts, faces, args.radius, args.n_frames, args.video_resolution, args.save_dir, args.name)
+        equatorial_video(model, verts, faces, args.radius, args.n_frames, args.video_resolution, args.save_dir, args.name, backend=args.backend, n_workers=args.video_workers, gt_cache=gt_cache)
     # print name again so it's at the bottom of the slurm output
     print(f"{args.name} finished")
 
@@ -4,8 +4,10 @@ import zipfile
 import glob
 import random
 import sys
+import json
 import beacon.utils as butils
 import trimesh
+import math
 from tqdm import tqdm
 
 from PyQt5.QtWidgets import QApplication
@@ -27,13 +29,147 @@ sys.path.append(os.path.join(FileDirPath, '../../'))
 import odf_utils
 import odf_v2_utils as o2utils
 from odf_dataset import ODFDatasetLiveVisualizer
-from depth_sampler import DepthMapSampler
+from depth_sampler import DepthMapSampler, getDepthIndexTable
+from prefetch import PrefetchResampler, PREFETCH_QUEUE_DEPTH
 
 DEPTH_DATASET_NAME = 'lucy'
 DEPTH_DATASET_URL = 'TDB'# 'https://neuralodf.s3.us-east-2.amazonaws.com/' + DEPTH_DATASET_NAME + '.zip'
 
+# The depth store packs every view of a split into one file: a header (magic line followed by JSON, padded to a multiple
+# of DEPTH_STORE_ALIGN) and then contiguous arrays. View i owns points and mask entries offsets[i]:offsets[i+1]
+#   points      - nPoints x 3 unprojected_normalized_pts of all views
+#   masks       - nPoints invalid_depth_mask of all views (bool)
+#   viewpoints  - nViews x 3 float64 camera centers
+#   offsets     - nViews + 1 int64
+#   pos_idx     - per view pixel indices of the valid (hit) pixels, view i owns pos_idx[pos_offsets[i]:pos_offsets[i+1]]
+#   neg_idx     - same for the invalid (miss) pixels (see depth_sampler.getDepthIndexTable)
+#   pos_offsets - nViews + 1 int64
+#   neg_offsets - nViews + 1 int64
+DEPTH_STORE_VERSION = 2
+DEPTH_STORE_MAGIC = b'DEPTHSTORE\n'
+DEPTH_STORE_ALIGN = 4096
+DEPTH_STORE_EXT = '.depthstore'
+
+def readDepthStoreHeader(FileName):
+    # Returns the header dictionary, or None if the file doesn't exist or isn't a depth store
+    if os.path.exists(FileName) is False:
+        return None
+    with open(FileName, 'rb') as File:
+        if File.read(len(DEPTH_STORE_MAGIC)) != DEPTH_STORE_MAGIC:
+            return None
+        return json.loads(File.readline().decode('utf-8'))
+
+def getDepthStoreFiles(DepthList):
+    # Identifies the source views so that a stale store gets rebuilt
+    return [[os.path.basename(FileName), os.path.getsize(FileName)] for FileName in DepthList]
+
+def packDepthViews(DepthList, StoreFileName):
+    # Converts the per-view .npy dictionaries into a depth store. Views are loaded one at a time and their points are
+    # streamed to disk, so this never holds more than one view (and the masks) in memory
+    Files = getDepthStoreFiles(DepthList)
+    # The header goes in front of the points but is only complete at the end. Reserve space for it based on the file list
+    HeaderSize = len(DEPTH_STORE_MAGIC) + len(json.dumps(Files)) + 2048
+    DataOffset = int(math.ceil(HeaderSize / DEPTH_STORE_ALIGN)) * DEPTH_STORE_ALIGN
+
+    Offsets = np.zeros(len(DepthList) + 1, dtype=np.int64)
+    Viewpoints = np.zeros((len(DepthList), 3), dtype=np.float64)
+    Masks = []
+    PointsDType = None
+    TmpFileName = StoreFileName + '.tmp'
+    with open(TmpFileName, 'wb') as File:
+        File.seek(DataOffset)
+        for Idx, FileName in enumerate(tqdm(DepthList, desc='[ INFO ]: Packing depth views')):
+            DepthData = np.load(FileName, allow_pickle=True).item()
+            Points = np.asarray(DepthData['unprojected_normalized_pts'])
+            if PointsDType is None:
+                PointsDType = Points.dtype
+            File.write(np.ascontiguousarray(Points, dtype=PointsDType).tobytes())
+            Masks.append(np.asarray(DepthData['invalid_depth_mask'], dtype=bool).reshape(-1))
+            assert len(Masks[-1]) == len(Points)
+            Viewpoints[Idx] = np.asarray(DepthData['viewpoint']).reshape(3)
+            Offsets[Idx + 1] = Offsets[Idx] + len(Points)
+            del DepthData
+
+        # The index tables are streamed one view at a time like the points, only their offsets are kept in memory
+        IndexType = np.dtype(np.int32 if len(Masks) == 0 or max(len(Mask) for Mask in Masks) < 2**31 else np.int64)
+        PosCounts = np.array([np.count_nonzero(Mask == False) for Mask in Masks], dtype=np.int64)
+        PosOffsets = np.concatenate(([0], np.cumsum(PosCounts))).astype(np.int64)
+        NegOffsets = np.concatenate(([0], np.cumsum([len(Mask) for Mask in Masks] - PosCounts))).astype(np.int64)
+
+        Sections = {}
+        Position = DataOffset
+        for Name, Array in [('points', None), ('masks', np.concatenate(Masks) if len(Masks) > 0 else np.zeros(0, dtype=bool)), ('viewpoints', Viewpoints), ('offsets', Offsets),
+                            ('pos_idx', 'pos'), ('neg_idx', 'neg'), ('pos_offsets', PosOffsets), ('neg_offsets', NegOffsets)]:
+            if Array is None:
+                Shape, DType = [int(Offsets[-1]), 3], np.dtype(PointsDType)
+            elif isinstance(Array, str):
+                Shape, DType = [int((PosOffsets if Array == 'pos' else NegOffsets)[-1])], IndexType
+                for Mask in Masks:
+                    File.write(np.flatnonzero(Mask == (Array == 'neg')).astype(IndexType).tobytes())
+            else:
+                Shape, DType = list(Array.shape), np.dtype(Array.dtype)
+                File.write(Array.tobytes())
+            Sections[Name] = {'offset': Position, 'shape': Shape, 'dtype': DType.str}
+            Position += int(np.prod(Shape)) * DType.itemsize
+
+        Header = {'version': DEPTH_STORE_VERSION, 'n_views': len(DepthList), 'n_points': int(Offsets[-1]), 'files': Files, 'sections': Sections}
+        HeaderBytes = DEPTH_STORE_MAGIC + json.dumps(Header).encode('utf-8') + b'\n'
+        assert len(HeaderBytes) <= DataOffset
+        File.seek(0)
+        File.write(HeaderBytes)
+    # Only a completely written store ever has the final name
+    os.replace(TmpFileName, StoreFileName)
+
+class DepthViewStore():
+    # Read only view of a depth store. Indexing returns a view dictionary (the same keys DepthMapSampler reads from the
+    # .npy files) whose arrays are zero-copy slices of the memory map, so only the pages that are sampled get read
+    def __init__(self, StoreFileName):
+        self.StoreFileName = StoreFileName
+        self.Header = readDepthStoreHeader(StoreFileName)
+        if self.Header is None:
+            raise RuntimeError('[ ERR ]: Not a depth store: ' + StoreFileName)
+        self.Arrays = None
+
+    def open(self):
+        self.Arrays = {}
+        for Name, Section in self.Header['sections'].items():
+            Shape = tuple(Section['shape'])
+            if np.prod(Shape) == 0:
+                self.Arrays[Name] = np.zeros(Shape, dtype=np.dtype(Section['dtype']))
+            else:
+                self.Arrays[Name] = np.memmap(self.StoreFileName, dtype=np.dtype(Section['dtype']), mode='r', offset=Section['offset'], shape=Shape)
+        # Small enough to keep in memory
+        self.Offsets = np.array(self.Arrays['offsets'])
+        self.Viewpoints = np.array(self.Arrays['viewpoints'])
+        self.PosOffsets = np.array(self.Arrays['pos_offsets'])
+        self.NegOffsets = np.array(self.Arrays['neg_offsets'])
+
+    def __len__(self):
+        return self.Header['n_views']
+
+    def __getitem__(self, idx):
+        if self.Arrays is None:
+            self.open()
+        Start, End = self.Offsets[idx], self.Offsets[idx + 1]
+        return {'unprojected_normalized_pts': self.Arrays['points'][Start:End],
+                'viewpoint': self.Viewpoints[idx],
+                'invalid_depth_mask': self.Arrays['masks'][Start:End]}
+
+    def getIndexTable(self, idx):
+        # The (positive, negative) pixel indices of a view as slices of the memory map
+        if self.Arrays is None:
+            self.open()
+        return (self.Arrays['pos_idx'][self.PosOffsets[idx]:self.PosOffsets[idx + 1]],
+                self.Arrays['neg_idx'][self.NegOffsets[idx]:self.NegOffsets[idx + 1]])
+
+    def __getstate__(self):
+        # Memory maps are reopened in the receiving process instead of being pickled
+        State = self.__dict__.copy()
+        State['Arrays'] = None
+        return State
+
 class DepthODFDatasetLoader(torch.utils.data.Dataset):
-    def __init__(self, root, train=True, download=True, limit=None, target_samples=1e3, usePositionalEncoding=True, coord_type='direction', ad=False):
+    def __init__(self, root, train=True, download=True, limit=None, target_samples=1e3, usePositionalEncoding=True, coord_type='direction', ad=False, prefetch_workers=0, prefetch_depth=PREFETCH_QUEUE_DEPTH, use_store=True):
         self.FileName = DEPTH_DATASET_NAME + '.zip'
         self.DataURL = DEPTH_DATASET_URL
         self.nTargetSamples = target_samples # Per image
@@ -41,10 +177,16 @@ class DepthODFDatasetLoader(torch.utils.data.Dataset):
         self.Sampler = None
         self.CoordType = coord_type # Options: 'points', 'direction', 'pluecker'
         self.ad = ad #autodecoder
+        self.Resampler = None
+        self.IndexTables = None # Positive/negative pixel indices per view for in-memory views (the depth store holds its own)
+        self.UseStore = use_store # Read views lazily from a packed depth store instead of loading every .npy file
         print('[ INFO ]: Loading {} dataset. Positional Encoding: {}, Coordinate Type: {}, Autodecoder: {}'.format(self.__class__.__name__, self.PositionalEnc, self.CoordType, self.ad))
 
         self.init(root, train, download, limit)
         self.loadData()
+        if prefetch_workers > 0:
+            # Rays are resampled ahead of time in worker processes, __getitem__ only dequeues them
+            self.Resampler = PrefetchResampler(self.sampleView, len(self), nWorkers=prefetch_workers, QueueDepth=prefetch_depth)
 
     def init(self, root, train=True, download=True, limit=None):
         self.DataDir = root
@@ -87,29 +229,58 @@ class DepthODFDatasetLoader(torch.utils.data.Dataset):
         if len(self.DepthList) == 0 or self.DepthList is None:
             raise RuntimeError('[ ERR ]: No depth image files found during data loading.')
 
+        if self.UseStore:
+            # The store covers every view in the directory so that changing the limit doesn't require repacking
+            self.StoreFileName = FilesPath + DEPTH_STORE_EXT
+            Header = readDepthStoreHeader(self.StoreFileName)
+            if Header is None:
+                print('[ INFO ]: No depth store found. Will pack the depth views.')
+                packDepthViews(self.DepthList, self.StoreFileName)
+            elif Header['version'] != DEPTH_STORE_VERSION or Header['files'] != getDepthStoreFiles(self.DepthList):
+                print('[ INFO ]: Depth store does not match the depth views. Will repack.')
+                packDepthViews(self.DepthList, self.StoreFileName)
+
         if self.DataLimit is None:
             self.DataLimit = len(self.DepthList)
         DatasetLength = self.DataLimit if self.DataLimit < len(self.DepthList) else len(self.DepthList)
         self.DepthList = self.DepthList[:DatasetLength]
 
-        self.LoadedDepths = []
-        for FileName in self.DepthList:
-            DepthData = np.load(FileName, allow_pickle=True).item()
-            self.LoadedDepths.append(DepthData)
+        if self.UseStore:
+            self.LoadedDepths = DepthViewStore(self.StoreFileName)
+        else:
+            self.LoadedDepths = []
+            for FileName in self.DepthList:
+                DepthData = np.load(FileName, allow_pickle=True).item()
+                self.LoadedDepths.append(DepthData)
+            # Built up front so that DataLoader and prefetch workers inherit them instead of recomputing them every time a
+            # short-lived worker process samples a view. The depth store has them precomputed and memory mapped instead
+            self.IndexTables = [getDepthIndexTable(DepthData) for DepthData in self.LoadedDepths]
 
     def __len__(self):
         return (len(self.DepthList))
 
-    def __getitem__(self, idx, PosEnc=None):
+    def sampleView(self, idx):
         DepthData = self.LoadedDepths[idx]
+        IndexTable = self.LoadedDepths.getIndexTable(idx) if self.UseStore else self.IndexTables[idx]
+        self.Sampler = DepthMapSampler(DepthData, TargetRays=self.nTargetSamples, UsePosEnc=self.PositionalEnc, IndexTable=IndexTable)
+        return self.Sampler.Coordinates, self.Sampler.Intersects, self.Sampler.Depths
+
+    def stopPrefetch(self):
+        if self.Resampler is not None:
+            self.Resampler.close()
+            self.Resampler = None
 
-        self.Sampler = DepthMapSampler(DepthData, TargetRays=self.nTargetSamples, UsePosEnc=self.PositionalEnc)
+    def __getitem__(self, idx, PosEnc=None):
+        if self.Resampler is not None:
+            Coordinates, Intersects, Depths = self.Resampler.get(idx)
+        else:
+            Coordinates, Intersects, Depths = self.sampleView(idx)
 
         #Include latent vector if we are using an AutoDecoder
         if not self.ad:
-            return self.Sampler.Coordinates, (self.Sampler.Intersects, self.Sampler.Depths)
+            return Coordinates, (Intersects, Depths)
         else:
-            return (self.Sampler.Coordinates, torch.tensor([idx]*self.Sampler.Coordinates.size()[0])), (self.Sampler.Intersects, self.Sampler.Depths)
+            return (Coordinates, torch.tensor([idx]*Coordinates.size()[0])), (Intersects, Depths)
 
 Parser = argparse.ArgumentParser()
 Parser.add_argument('-d', '--data-dir', help='Specify the location of the directory to download and store dataset.', required=True)
@@ -119,6 +290,8 @@ Parser.add_argument('--coord-type', help='Type of coordinates to use, valid opti
 Parser.add_argument('--no-posenc', help='Choose not to use positional encoding.', action='store_true', required=False)
 Parser.set_defaults(no_posenc=False)
 Parser.add_argument('-v', '--viz-limit', help='Limit visualizations to these many rays.', required=False, type=int, default=1000)
+Parser.add_argument('--pack', help='Only pack the train and val depth views into depth stores and exit.', action='store_true', required=False)
+Parser.set_defaults(pack=False)
 
 
 if __name__ == '__main__':
@@ -126,6 +299,12 @@ if __name__ == '__main__':
     butils.seedRandom(Args.seed)
     usePoseEnc = not Args.no_posenc
 
+    if Args.pack:
+        for isTrain in [True, False]:
+            Data = DepthODFDatasetLoader(root=Args.data_dir, train=isTrain, download=True, target_samples=Args.nsamples, usePositionalEncoding=usePoseEnc, coord_type=Args.coord_type)
+            print('[ INFO ]: Depth store {} has {} views.'.format(Data.StoreFileName, len(Data.LoadedDepths)))
+        exit()
+
     Data = DepthODFDatasetLoader(root=Args.data_dir, train=True, download=True, target_samples=Args.nsamples, usePositionalEncoding=usePoseEnc, coord_type=Args.coord_type)
 
     ODFVizList = []
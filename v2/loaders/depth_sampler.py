@@ -29,11 +29,23 @@ DEPTH_SAMPLER_POS_RATIO = 0.5
 # viewpoint : ray start points lying on sphere on radius 1.25
 # depth_map : rendered depth map
 # rest elements are camera intrinsics and extrinsics.
+def getDepthIndexTable(NPData):
+    # Indices of the pixels whose rays hit (positive) and miss (negative) the object. These only depend on the view, so
+    # compute them once and pass them to every DepthMapSampler for that view
+    InvalidMask = np.asarray(NPData['invalid_depth_mask']).reshape(-1)
+    IndexType = np.int32 if len(InvalidMask) < 2**31 else np.int64
+    PosIdx = np.flatnonzero(InvalidMask == False).astype(IndexType)
+    NegIdx = np.flatnonzero(InvalidMask == True).astype(IndexType)
+    return PosIdx, NegIdx
+
 class DepthMapSampler():
-    def __init__(self, NPData, TargetRays, UsePosEnc=False):
+    def __init__(self, NPData, TargetRays, UsePosEnc=False, IndexTable=None, Rng=None):
         self.NPData = NPData
         self.nTargetRays = TargetRays
         self.UsePosEnc = UsePosEnc
+        self.IndexTable = IndexTable if IndexTable is not None else getDepthIndexTable(NPData)
+        # Derive the generator from the global seed so that butils.seedRandom and per-worker seeding still apply
+        self.Rng = Rng if Rng is not None else np.random.default_rng(np.random.randint(2**31))
         # print('[ INFO ]: Found {} vertices with normals. Will try to sample {} rays in total.'.format(len(self.Vertices), self.nTargetRays))
 
         self.Coordinates = None
@@ -42,42 +54,31 @@ class DepthMapSampler():
 
         self.sample(self.nTargetRays)
 
+    def sampleRays(self, AllIdx, nTargetRays):
+        # Draws up to nTargetRays pixels without replacement. Only the sampled rays are ever materialized
+        nRays = min(int(nTargetRays), len(AllIdx))
+        SampledIdx = np.sort(AllIdx[self.Rng.choice(len(AllIdx), size=nRays, replace=False)]) # Sorted for memory map locality
+        StartPoint = np.asarray(self.NPData['viewpoint'], dtype=np.float64).reshape(1, 3) # There is only 1 start point, the camera center
+        SampledDir = self.NPData['unprojected_normalized_pts'][SampledIdx] - StartPoint
+        SampledDepths = np.linalg.norm(SampledDir, axis=1)
+        SampledDir /= SampledDepths[:, np.newaxis]
+        SampledStartPts = np.broadcast_to(StartPoint, SampledDir.shape)
+        return np.hstack((SampledStartPts, SampledDir)), SampledDepths
+
     def sample(self, TargetRays, RatioPositive=DEPTH_SAMPLER_POS_RATIO):
-        AllEndPoints = self.NPData['unprojected_normalized_pts']
-        StartPoint = self.NPData['viewpoint'] # There is only 1 start point, the camera center
-        AllStartPoints = np.tile(StartPoint, (AllEndPoints.shape[0], 1))
-        AllIntersects = self.NPData['invalid_depth_mask']
+        AllPosIdx, AllNegIdx = self.IndexTable
 
         nPosTargetRays = math.floor(TargetRays*RatioPositive)
         nNegTargetRays = (TargetRays-nPosTargetRays)
 
-        AllPosIdx = np.where(AllIntersects == False)[0]
-        AllNegIdx = np.where(AllIntersects == True)[0]
-        PosShuffleIdx = np.random.permutation(len(AllPosIdx))
-        NegShuffleIdx = np.random.permutation(len(AllNegIdx))
-
-        SampledPosEndPts = AllEndPoints[AllPosIdx[PosShuffleIdx[:nPosTargetRays]]]
-        SampledPosStartPts = AllStartPoints[AllPosIdx[PosShuffleIdx[:nPosTargetRays]]]
-        SampledPosDir = SampledPosEndPts - SampledPosStartPts
-        SampledPosDirNorm = np.linalg.norm(SampledPosDir, axis=1)
-        SampledPosDir /= SampledPosDirNorm[:, np.newaxis]
-        SampledPosDepths = np.linalg.norm(SampledPosEndPts - SampledPosStartPts, axis=1)
-        SampledPosIntersects = np.ones((nPosTargetRays, 1))
-
-        SampledNegEndPts = AllEndPoints[AllNegIdx[NegShuffleIdx[:nNegTargetRays]]]
-        SampledNegStartPts = AllStartPoints[AllNegIdx[NegShuffleIdx[:nNegTargetRays]]]
-        SampledNegDir = SampledNegEndPts - SampledNegStartPts
-        SampledNegDirNorm = np.linalg.norm(SampledNegDir, axis=1)
-        SampledNegDir /= SampledNegDirNorm[:, np.newaxis]
-        SampledNegDepths = np.zeros(nNegTargetRays)
-        SampledNegIntersects = np.zeros((nNegTargetRays, 1))
-
-        Coordinates = np.vstack((np.hstack((SampledPosStartPts, SampledPosDir)), np.hstack((SampledNegStartPts, SampledNegDir))))
-        Intersects = np.vstack((SampledPosIntersects, SampledNegIntersects))
-        Depths = np.expand_dims(np.concatenate((SampledPosDepths, SampledNegDepths)), axis=1)
-
-        ShuffleIdx = np.random.permutation(len(Coordinates))
+        PosCoordinates, SampledPosDepths = self.sampleRays(AllPosIdx, nPosTargetRays)
+        NegCoordinates, _ = self.sampleRays(AllNegIdx, nNegTargetRays)
+
+        Coordinates = np.vstack((PosCoordinates, NegCoordinates))
+        Intersects = np.vstack((np.ones((len(PosCoordinates), 1)), np.zeros((len(NegCoordinates), 1))))
+        Depths = np.expand_dims(np.concatenate((SampledPosDepths, np.zeros(len(NegCoordinates)))), axis=1)
 
+        ShuffleIdx = self.Rng.permutation(len(Coordinates))
         self.Coordinates = torch.from_numpy(Coordinates[ShuffleIdx]).to(torch.float32)
         self.Intersects = torch.from_numpy(Intersects[ShuffleIdx]).to(torch.float32)
         self.Depths = torch.from_numpy(Depths[ShuffleIdx]).to(torch.float32)
@@ -7,6 +7,8 @@ import beacon.utils as butils
 import trimesh
 import pickle
 import math
+import json
+import hashlib
 from tqdm import tqdm
 import multiprocessing as mp
 
@@ -32,6 +34,7 @@ sys.path.append(os.path.join(FileDirPath, '../losses'))
 sys.path.append(os.path.join(FileDirPath, '../../'))
 
 from data import MultiDepthDataset
+from mesh_geometry import MeshGeometry
 from sampling import sample_uniform_4D, sampling_preset_noise, sample_vertex_4D, sample_tangential_4D
 import odf_utils
 from single_losses import SingleDepthBCELoss, SINGLE_MASK_THRESH
@@ -46,11 +49,81 @@ DEFAULT_VERT_RATIO = 0
 DEFAULT_TAN_RATIO = 0
 DEFAULT_RADIUS = 1.25
 DEFAULT_MAX_INTERSECT = 1
+# Rays per cache construction task. Each task is seeded from its object and chunk index, so the cache doesn't depend on the number of workers
+ODF_CACHE_CHUNK_SIZE = 10000
+ODF_CACHE_SEED = 0
+
+# The ODF cache is a single file: a fixed size header (magic line followed by JSON) and then one float32 row per ray.
+# Only the ray end points are stored, the direction and pluecker coordinates are derived from them when loading
+ODF_CACHE_VERSION = 1
+ODF_CACHE_MAGIC = b'ODFCACHE\n'
+ODF_CACHE_HEADER_SIZE = 4096
+ODF_CACHE_COLUMNS = ['start_x', 'start_y', 'start_z', 'end_x', 'end_y', 'end_z', 'intersect', 'depth']
+
+def readODFCacheHeader(FileName):
+    # Returns the header dictionary, or None if the file doesn't exist or isn't an ODF cache
+    if os.path.exists(FileName) is False:
+        return None
+    with open(FileName, 'rb') as File:
+        HeaderBytes = File.read(ODF_CACHE_HEADER_SIZE)
+    if HeaderBytes.startswith(ODF_CACHE_MAGIC) is False:
+        return None
+    return json.loads(HeaderBytes[len(ODF_CACHE_MAGIC):].decode('utf-8').strip())
+
+def writeODFCacheHeader(FileName, Header):
+    HeaderBytes = ODF_CACHE_MAGIC + json.dumps(Header).encode('utf-8')
+    assert len(HeaderBytes) <= ODF_CACHE_HEADER_SIZE
+    with open(FileName, 'r+b') as File:
+        File.write(HeaderBytes.ljust(ODF_CACHE_HEADER_SIZE, b' '))
+
+def deriveCoordinates(Points, CoordType):
+    # Points: Nx6 ray start and end points. Returns the Nx6 coordinates of the given type (points | direction | pluecker)
+    Points = np.asarray(Points, dtype=np.float64)
+    if CoordType == 'points':
+        return Points
+    Direction = Points[:, 3:] - Points[:, :3]
+    Direction /= np.linalg.norm(Direction, axis=1)[:, np.newaxis]
+    if CoordType == 'direction':
+        return np.hstack((Points[:, :3], Direction))
+    if CoordType == 'pluecker':
+        return np.hstack((Direction, np.cross(Points[:, :3], Direction)))
+    raise RuntimeError('[ ERR ]: Unknown coordinate type: ' + CoordType)
+
+# The mesh of the most recent chunk. Only one is kept since the chunks of an object are queued together, so memory doesn't
+# grow with the number of objects (in the pool workers or, without a pool, in the main process)
+CacheWorkerMesh = {}
+
+def fillODFCacheChunk(Args):
+    # Samples one chunk of rays for one object and writes them straight into the cache memory map
+    CacheFileName, CacheLength, OBJIdx, OBJFileName, ChunkIdx, nSamplesPerOBJ, SamplingMethods, SamplingFrequency = Args
+    if CacheWorkerMesh.get('FileName') != OBJFileName:
+        CacheWorkerMesh.clear() # Drop the previous object before loading the next one
+        Geometry = MeshGeometry.from_file(OBJFileName, use_sidecar=False)
+        CacheWorkerMesh['FileName'] = OBJFileName
+        CacheWorkerMesh['MeshODF'] = MultiDepthDataset(Geometry.faces, Geometry.verts, DEFAULT_RADIUS, SamplingMethods, SamplingFrequency, size=nSamplesPerOBJ, intersect_limit=DEFAULT_MAX_INTERSECT, pos_enc=False, geometry=Geometry)
+    MeshODF = CacheWorkerMesh['MeshODF']
+    MeshODF.seed([ODF_CACHE_SEED, OBJIdx, ChunkIdx])
+
+    RayStart = ChunkIdx * ODF_CACHE_CHUNK_SIZE
+    nRays = min(ODF_CACHE_CHUNK_SIZE, nSamplesPerOBJ - RayStart)
+    StartPoints, EndPoints = MeshODF.next_rays(nRays)
+    Depths, nInts = MeshODF.label_rays(StartPoints, EndPoints)
+
+    Offset = OBJIdx * nSamplesPerOBJ + RayStart
+    Cache = np.memmap(CacheFileName, dtype=np.float32, mode='r+', offset=ODF_CACHE_HEADER_SIZE, shape=(CacheLength, len(ODF_CACHE_COLUMNS)))
+    Cache[Offset:Offset + nRays, :3] = StartPoints
+    Cache[Offset:Offset + nRays, 3:6] = EndPoints
+    Cache[Offset:Offset + nRays, 6] = nInts > 0
+    Cache[Offset:Offset + nRays, 7] = Depths[:, 0]
+    Cache.flush()
+    del Cache
+    return nRays
 
 
 class ODFDatasetLoader(torch.utils.data.Dataset):
-    def __init__(self, root, train=True, download=True, limit=None, mode='mesh', n_samples=1e3, sampling_methods=None, sampling_frequency=None, usePositionalEncoding=True, coord_type='direction'):
+    def __init__(self, root, train=True, download=True, limit=None, mode='mesh', n_samples=1e3, sampling_methods=None, sampling_frequency=None, usePositionalEncoding=True, coord_type='direction', n_workers=None):
         self.FileName = MESH_DATASET_NAME + '.zip'
+        self.nWorkers = n_workers # Processes used to create the ODF cache (default: all cores)
         self.DataURL = MESH_DATASET_URL
         self.Mode = mode
         self.nSamplesPerOBJ = n_samples
@@ -82,13 +155,8 @@ class ODFDatasetLoader(torch.utils.data.Dataset):
         self.CurrentODFCacheFile = None
         self.CurrentODFCacheSamples = None
 
-        # Cache: Numpy memory map
-        self.Cache = {}
-        self.Cache['coordinates_points'] = None
-        self.Cache['coordinates_direction'] = None
-        self.Cache['coordinates_pluecker'] = None
-        self.Cache['intersect'] = None
-        self.Cache['depths'] = None
+        # Cache: Numpy memory map with one row of ODF_CACHE_COLUMNS per ray
+        self.Cache = None
 
 
     def loadData(self):
@@ -120,11 +188,14 @@ class ODFDatasetLoader(torch.utils.data.Dataset):
         if len(self.OBJList) == 0 or self.OBJList is None:
             raise RuntimeError('[ ERR ]: No files found during data loading.')
 
-        self.ODFCacheList = glob.glob(self.BaseDirPath +  '/*' + self.getCachePostFixes() + '.odf')
-        self.ODFCacheList.sort()
-        if len(self.ODFCacheList) == 0 or self.ODFCacheList is None:
+        self.CurrentODFCacheFile = os.path.join(self.BaseDirPath, 'odf_cache' + self.getCachePostFixes() + '.odf')
+        Header = readODFCacheHeader(self.CurrentODFCacheFile)
+        if Header is None:
             print('[ INFO ]: No ODF cache found. Will compute and write out cache.')
             self.createODFCache()
+        elif Header != self.getCacheHeader(Complete=True):
+            print('[ INFO ]: ODF cache does not match the dataset settings or is incomplete. Will recompute cache.')
+            self.createODFCache()
         else:
             print('[ INFO ]: Loading ODF cache.')
             self.loadODFCache('r')
@@ -139,48 +210,57 @@ class ODFDatasetLoader(torch.utils.data.Dataset):
 
         return PostFixes
 
-    # @staticmethod
-    # def MultiProcess(self, RayIdx, OBJIdx, CurrentMeshODF, Cache):
-    #     Dict = CurrentMeshODF[RayIdx]
-    #     for key in Cache.keys():
-    #         Cache[key][OBJIdx * self.nSamplesPerOBJ + RayIdx, :] = Dict[key].numpy().squeeze()
+    def getCacheHeader(self, Complete=False):
+        # Everything the cache contents depend on. A cache is only loaded if its header matches exactly
+        OBJListHash = hashlib.sha1('\n'.join([os.path.basename(OBJFileName) for OBJFileName in self.OBJList]).encode('utf-8')).hexdigest()
+        return {
+            'version': ODF_CACHE_VERSION,
+            'dtype': 'float32',
+            'columns': ODF_CACHE_COLUMNS,
+            'n_samples': int(len(self)),
+            'n_samples_per_obj': int(self.nSamplesPerOBJ),
+            'obj_list_hash': OBJListHash,
+            'sampling_methods': [getattr(Method, '__name__', repr(Method)) for Method in self.SamplingMethods],
+            'sampling_frequency': [float(Frequency) for Frequency in self.SamplingFrequency],
+            'radius': DEFAULT_RADIUS,
+            'max_intersect': DEFAULT_MAX_INTERSECT,
+            'seed': ODF_CACHE_SEED,
+            'chunk_size': ODF_CACHE_CHUNK_SIZE,
+            'complete': Complete,
+        }
 
     def createODFCache(self):
         # Create ODF samples and write to cache.
-        # Also write parameters info into each cache to enable loading
-        self.loadODFCache(loadMode='w+')
-        nCores = mp.cpu_count()
-        print('nCores', nCores)
-        for OBJIdx, OBJFileName in enumerate(self.OBJList):
-            Mesh = trimesh.load(OBJFileName)
-            Faces = Mesh.faces
-            Verts = Mesh.vertices
-            Verts = odf_utils.mesh_normalize(Verts)
-
-            # Get without positional encoding and do that later
-            self.CurrentMeshODF = MultiDepthDataset(Faces, Verts, DEFAULT_RADIUS, self.SamplingMethods, self.SamplingFrequency, size=self.nSamplesPerOBJ, intersect_limit=DEFAULT_MAX_INTERSECT, pos_enc=False)
-            assert len(self.CurrentMeshODF) == self.nSamplesPerOBJ
-
-            # with mp.Pool(processes=nCores) as p:
-            #     p.starmap(self.MultiProcess, zip([RayIdx for RayIdx in range(self.nSamplesPerOBJ)], repeat(OBJIdx), repeat(self.CurrentMeshODF)))
-            #     # p.map(partial(self.Process, OBJIdx=OBJIdx), [RayIdx for RayIdx in range(self.nSamplesPerOBJ)])
-
-            for RayIdx in tqdm(range(self.nSamplesPerOBJ)): # todo: speed this up
-                DefaultDict = self.CurrentMeshODF[RayIdx]
-                for key in self.Cache.keys():
-                    self.Cache[key][OBJIdx*self.nSamplesPerOBJ + RayIdx, :] = DefaultDict[key].numpy().squeeze()
-
-        for key in self.Cache.keys():
-            self.Cache[key].flush()
+        # The header is written first with complete=False so that an interrupted run is recomputed next time
+        with open(self.CurrentODFCacheFile, 'wb') as File:
+            File.truncate(ODF_CACHE_HEADER_SIZE + int(len(self)) * len(ODF_CACHE_COLUMNS) * np.dtype(np.float32).itemsize)
+        writeODFCacheHeader(self.CurrentODFCacheFile, self.getCacheHeader(Complete=False))
+
+        # Each task fills a disjoint slice of the cache for one object
+        nChunks = int(math.ceil(self.nSamplesPerOBJ / ODF_CACHE_CHUNK_SIZE))
+        Tasks = [(self.CurrentODFCacheFile, int(len(self)), OBJIdx, OBJFileName, ChunkIdx, int(self.nSamplesPerOBJ), self.SamplingMethods, self.SamplingFrequency)
+                 for OBJIdx, OBJFileName in enumerate(self.OBJList) for ChunkIdx in range(nChunks)]
+        nWorkers = min(self.nWorkers if self.nWorkers is not None else mp.cpu_count(), len(Tasks))
+        print('[ INFO ]: Creating ODF cache with {} workers.'.format(nWorkers))
+        with tqdm(total=len(self)) as ProgressBar:
+            if nWorkers <= 1:
+                for Task in Tasks:
+                    ProgressBar.update(fillODFCacheChunk(Task))
+                CacheWorkerMesh.clear()
+            else:
+                with mp.Pool(processes=nWorkers) as p:
+                    for nRays in p.imap_unordered(fillODFCacheChunk, Tasks):
+                        ProgressBar.update(nRays)
+
+        writeODFCacheHeader(self.CurrentODFCacheFile, self.getCacheHeader(Complete=True))
+        self.loadODFCache('r')
         print('[ INFO ]: Dumped {} ODF samples per {} objects to cache.'.format(self.nSamplesPerOBJ, len(self.OBJList)))
 
     def loadODFCache(self, loadMode='r'):
-        for key in self.Cache.keys():
-            FileName = os.path.join(self.BaseDirPath, key + self.getCachePostFixes() + '.odf')
-            if key == 'intersect' or key == 'depths':
-                self.Cache[key] = np.memmap(FileName, dtype=np.float64, mode=loadMode, shape=(len(self), 1))
-            else:
-                self.Cache[key] = np.memmap(FileName, dtype=np.float64, mode=loadMode, shape=(len(self), 6))
+        Header = readODFCacheHeader(self.CurrentODFCacheFile)
+        if Header is None or Header['version'] != ODF_CACHE_VERSION or Header['n_samples'] != len(self):
+            raise RuntimeError('[ ERR ]: Invalid ODF cache: ' + self.CurrentODFCacheFile)
+        self.Cache = np.memmap(self.CurrentODFCacheFile, dtype=np.float32, mode=loadMode, offset=ODF_CACHE_HEADER_SIZE, shape=(Header['n_samples'], len(Header['columns'])))
 
 
     def __len__(self):
@@ -188,17 +268,46 @@ class ODFDatasetLoader(torch.utils.data.Dataset):
 
 
     def __getitem__(self, idx, PosEnc=None):
-        Coordinates = torch.from_numpy(self.Cache['coordinates_' + self.CoordType][idx].copy()).to(torch.float32)
-        if PosEnc is None:
-            if self.PositionalEnc:
-                Coordinates = torch.tensor([x for val in list(Coordinates) for x in odf_utils.positional_encoding(val.item())], dtype=torch.float32)
+        # idx can also be a slice or an array of indices, in which case a whole batch is read and encoded at once
+        # (use with ContiguousBlockSampler and batch_size=None)
+        isBatch = isinstance(idx, (slice, list, np.ndarray, torch.Tensor))
+        if isinstance(idx, slice):
+            Rows = np.array(self.Cache[idx])
+        elif isBatch:
+            Rows = np.array(self.Cache[np.asarray(idx, dtype=np.int64)])
         else:
-            if PosEnc:
-                Coordinates = torch.tensor([x for val in list(Coordinates) for x in odf_utils.positional_encoding(val.item())], dtype=torch.float32)
-        Intersects = torch.from_numpy(self.Cache['intersect'][idx].copy()).to(torch.float32)
-        Depths = torch.from_numpy(self.Cache['depths'][idx].copy()).to(torch.float32)
+            Rows = np.array(self.Cache[idx])[np.newaxis, :]
+        Coordinates = deriveCoordinates(Rows[:, :6], self.CoordType)
+        if PosEnc is None:
+            PosEnc = self.PositionalEnc
+        if PosEnc:
+            Coordinates = odf_utils.positional_encoding_batch(Coordinates)
+        Coordinates = torch.from_numpy(Coordinates).to(torch.float32)
+        Intersects = torch.from_numpy(Rows[:, 6:7]).to(torch.float32)
+        Depths = torch.from_numpy(Rows[:, 7:8]).to(torch.float32)
+
+        if isBatch:
+            return Coordinates, (Intersects, Depths)
+        return Coordinates[0], (Intersects[0], Depths[0])
+
+class ContiguousBlockSampler(torch.utils.data.Sampler):
+    # Yields slices of BlockSize consecutive samples, in random block order if Shuffle is set
+    # With batch_size=None, each slice becomes one batch that ODFDatasetLoader reads sequentially from its cache
+    def __init__(self, DataSource, BlockSize, Shuffle=True, DropLast=False):
+        self.nSamples = len(DataSource)
+        self.BlockSize = BlockSize
+        self.Shuffle = Shuffle
+        self.DropLast = DropLast
+
+    def __len__(self):
+        if self.DropLast:
+            return self.nSamples // self.BlockSize
+        return int(math.ceil(self.nSamples / self.BlockSize))
 
-        return Coordinates, (Intersects, Depths)
+    def __iter__(self):
+        BlockOrder = torch.randperm(len(self)).tolist() if self.Shuffle else range(len(self))
+        for BlockIdx in BlockOrder:
+            yield slice(BlockIdx * self.BlockSize, min((BlockIdx + 1) * self.BlockSize, self.nSamples))
 
 class ODFDatasetVisualizer(EaselModule):
     def __init__(self, Data=None, Offset=[0, 0, 0], DataLimit=10000):
@@ -490,6 +599,7 @@ Parser.add_argument('--coord-type', help='Type of coordinates to use, valid opti
 Parser.add_argument('--no-posenc', help='Choose not to use positional encoding.', action='store_true', required=False)
 Parser.set_defaults(no_posenc=False)
 Parser.add_argument('-v', '--viz-limit', help='Limit visualizations to these many rays.', required=False, type=int, default=1000)
+Parser.add_argument('--n-workers', help='Number of processes used to create the ODF cache (default: all cores).', required=False, type=int, default=None)
 
 
 if __name__ == '__main__':
@@ -497,7 +607,7 @@ if __name__ == '__main__':
     butils.seedRandom(Args.seed)
     usePoseEnc = not Args.no_posenc
 
-    Data = ODFDatasetLoader(root=Args.data_dir, train=True, download=True, mode=Args.mode, n_samples=Args.nsamples, usePositionalEncoding=usePoseEnc, coord_type=Args.coord_type)
+    Data = ODFDatasetLoader(root=Args.data_dir, train=True, download=True, mode=Args.mode, n_samples=Args.nsamples, usePositionalEncoding=usePoseEnc, coord_type=Args.coord_type, n_workers=Args.n_workers)
     # print(Data[650])
     # Data[65038]
     # Data.visualizeRandom()
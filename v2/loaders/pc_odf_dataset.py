@@ -12,6 +12,7 @@ from PyQt5.QtWidgets import QApplication
 import PyQt5.QtCore as QtCore
 from PyQt5.QtGui import QKeyEvent, QMouseEvent, QWheelEvent
 import numpy as np
+from scipy.spatial import cKDTree
 
 from tk3dv.pyEasel import *
 from EaselModule import EaselModule
@@ -28,6 +29,7 @@ import odf_utils
 import odf_v2_utils as o2utils
 from odf_dataset import ODFDatasetLiveVisualizer
 from pc_sampler import PointCloudSampler
+from prefetch import PrefetchResampler, PREFETCH_QUEUE_DEPTH
 
 # PC_DATASET_NAME = 'bunny_dataset'
 #PC_DATASET_NAME = 'bunny_100_dataset'
@@ -36,7 +38,7 @@ PC_DATASET_NAME = 'bunny_cow'
 PC_DATASET_URL = 'https://neuralodf.s3.us-east-2.amazonaws.com/' + PC_DATASET_NAME + '.zip'
 
 class PCODFDatasetLoader(torch.utils.data.Dataset):
-    def __init__(self, root, train=True, download=True, limit=None, target_samples=1e3, usePositionalEncoding=True, coord_type='direction', ad=False):
+    def __init__(self, root, train=True, download=True, limit=None, target_samples=1e3, usePositionalEncoding=True, coord_type='direction', ad=False, sampler_threads=0, prefetch_workers=0, prefetch_depth=PREFETCH_QUEUE_DEPTH):
         self.FileName = PC_DATASET_NAME + '.zip'
         self.DataURL = PC_DATASET_URL
         self.nTargetSamples = target_samples # Per shape
@@ -44,10 +46,15 @@ class PCODFDatasetLoader(torch.utils.data.Dataset):
         self.Sampler = None
         self.CoordType = coord_type # Options: 'points', 'direction', 'pluecker'
         self.ad = ad #autodecoder
+        self.SamplerThreads = sampler_threads
+        self.Resampler = None
         print('[ INFO ]: Loading {} dataset. Positional Encoding: {}, Coordinate Type: {}'.format(self.__class__.__name__, self.PositionalEnc, self.CoordType))
 
         self.init(root, train, download, limit)
         self.loadData()
+        if prefetch_workers > 0:
+            # Rays are resampled ahead of time in worker processes, __getitem__ only dequeues them
+            self.Resampler = PrefetchResampler(self.sampleShape, len(self), nWorkers=prefetch_workers, QueueDepth=prefetch_depth)
 
     def init(self, root, train=True, download=True, limit=None):
         self.DataDir = root
@@ -107,10 +114,13 @@ class PCODFDatasetLoader(torch.utils.data.Dataset):
             Mesh.vertex_normals = VertNormals
 
             self.LoadedOBJs.append(Mesh)
+        # The point clouds don't change between resamples so build their spatial indices once
+        self.LoadedTrees = [cKDTree(np.asarray(Mesh.vertices)) for Mesh in self.LoadedOBJs]
+
     def __len__(self):
         return (len(self.OBJList))
 
-    def __getitem__(self, idx, PosEnc=None):
+    def sampleShape(self, idx):
         # Mesh = trimesh.load(self.OBJList[idx])
         # Verts = Mesh.vertices
         # Verts = odf_utils.mesh_normalize(Verts)
@@ -120,14 +130,26 @@ class PCODFDatasetLoader(torch.utils.data.Dataset):
         Mesh = self.LoadedOBJs[idx]
 
         # if self.Sampler is None: # todo: TEMP for testing with same samples
-        self.Sampler = PointCloudSampler(Mesh.vertices, Mesh.vertex_normals, TargetRays=self.nTargetSamples, UsePosEnc=self.PositionalEnc)
+        self.Sampler = PointCloudSampler(Mesh.vertices, Mesh.vertex_normals, TargetRays=self.nTargetSamples, UsePosEnc=self.PositionalEnc, VertexTree=self.LoadedTrees[idx], nThreads=self.SamplerThreads)
+        return self.Sampler.Coordinates, self.Sampler.Intersects, self.Sampler.Depths
+
+    def stopPrefetch(self):
+        if self.Resampler is not None:
+            self.Resampler.close()
+            self.Resampler = None
+
+    def __getitem__(self, idx, PosEnc=None):
+        if self.Resampler is not None:
+            Coordinates, Intersects, Depths = self.Resampler.get(idx)
+        else:
+            Coordinates, Intersects, Depths = self.sampleShape(idx)
 
         #Include latent vector if we are using an AutoDecoder
         # TODO: assign index based on file name so that the dataset can still be shuffled
         if not self.ad:
-            return self.Sampler.Coordinates, (self.Sampler.Intersects, self.Sampler.Depths)
+            return Coordinates, (Intersects, Depths)
         else:
-            return (self.Sampler.Coordinates, torch.tensor([idx]*self.Sampler.Coordinates.size()[0])), (self.Sampler.Intersects, self.Sampler.Depths)
+            return (Coordinates, torch.tensor([idx]*Coordinates.size()[0])), (Intersects, Depths)
 
 Parser = argparse.ArgumentParser()
 Parser.add_argument('-d', '--data-dir', help='Specify the location of the directory to download and store dataset.', required=True)
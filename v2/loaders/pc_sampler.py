@@ -6,9 +6,12 @@ import math
 from tqdm import tqdm
 import multiprocessing as mp
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 from PyQt5.QtWidgets import QApplication
 import numpy as np
+from scipy.spatial import cKDTree
 
 from tk3dv.pyEasel import *
 from Easel import Easel
@@ -27,14 +30,19 @@ PC_SUBDIVIDE_THRESH = PC_SAMPLER_THRESH * 2
 PC_SAMPLER_NEG_MINOFFSET = PC_NEG_SAMPLER_THRESH * 2
 PC_SAMPLER_NEG_MAXOFFSET = PC_SAMPLER_RADIUS
 PC_SAMPLER_POS_RATIO = 0.5
+PC_SAMPLER_MEMORY_BUDGET = 256 * 1024 * 1024 # Bytes of pruning workspace per vertex block
 
 class PointCloudSampler():
-    def __init__(self, Vertices, VertexNormals, TargetRays, UsePosEnc=False):
-        self.Vertices = Vertices
-        self.VertexNormals = VertexNormals
+    def __init__(self, Vertices, VertexNormals, TargetRays, UsePosEnc=False, VertexTree=None, MemoryBudget=PC_SAMPLER_MEMORY_BUDGET, nThreads=0):
+        self.Vertices = np.asarray(Vertices)
+        self.VertexNormals = np.asarray(VertexNormals)
         self.nTargetRays = TargetRays
         self.UsePosEnc = UsePosEnc
+        self.MemoryBudget = MemoryBudget
+        self.nThreads = nThreads # Threads used to sample vertex blocks, 0 or 1 samples them sequentially
         assert self.Vertices.shape[0] == self.VertexNormals.shape[0]
+        # Spatial index used to prune rays that pass close to other points. Pass one in to reuse it across samplers
+        self.VertexTree = VertexTree if VertexTree is not None else cKDTree(self.Vertices)
         # print('[ INFO ]: Found {} vertices with normals. Will try to sample {} rays in total.'.format(len(self.Vertices), self.nTargetRays))
 
         self.Coordinates = None
@@ -100,39 +108,59 @@ class PointCloudSampler():
         self.Intersects = torch.from_numpy(Intersects[ShuffleIdx]).to(torch.float32).unsqueeze(1)
         self.Depths = torch.from_numpy(Depths[ShuffleIdx]).to(torch.float32).unsqueeze(1)
 
+    def getVertexBlocks(self, RaysPerVertex):
+        # Split the vertices into blocks whose pruning workspace (one query center every thresh along each ray) fits in the memory budget
+        nCentersPerRay = math.ceil(2 * PC_SAMPLER_RADIUS / min(PC_SAMPLER_THRESH, PC_NEG_SAMPLER_THRESH))
+        BytesPerRay = 64 * nCentersPerRay
+        BlockSize = max(1, int(self.MemoryBudget // (BytesPerRay * max(1, RaysPerVertex))))
+        nVertices = len(self.Vertices)
+        return [(Start, min(Start + BlockSize, nVertices)) for Start in range(0, nVertices, BlockSize)]
+
+    def sampleBlocks(self, SampleBlock, RaysPerVertex, Target):
+        Blocks = self.getVertexBlocks(RaysPerVertex)
+        Results = []
+        nSampled = 0
+        if self.nThreads > 1 and len(Blocks) > 1:
+            # cKDTree queries and most numpy kernels release the GIL. Only nThreads blocks are in flight at a time and results
+            # are consumed in block order, so this stops at the same block as the sequential path (wasting at most nThreads-1 blocks)
+            with ThreadPoolExecutor(max_workers=self.nThreads) as Executor:
+                Pending = deque()
+                NextBlock = 0
+                while NextBlock < len(Blocks) or len(Pending) > 0:
+                    while NextBlock < len(Blocks) and len(Pending) < self.nThreads:
+                        Pending.append(Executor.submit(SampleBlock, Blocks[NextBlock][0], Blocks[NextBlock][1], RaysPerVertex))
+                        NextBlock += 1
+                    Results.append(Pending.popleft().result())
+                    nSampled += len(Results[-1][0])
+                    if nSampled >= Target: # Remaining blocks would be cut off anyway
+                        for Future in Pending:
+                            Future.cancel()
+                        break
+        else:
+            for Start, End in Blocks:
+                Results.append(SampleBlock(Start, End, RaysPerVertex))
+                nSampled += len(Results[-1][0])
+                if nSampled >= Target: # Remaining blocks would be cut off anyway
+                    break
+
+        Coordinates = np.concatenate([R[0] for R in Results], axis=0)
+        Intersects = np.concatenate([R[1] for R in Results], axis=0)
+        Depths = np.concatenate([R[2] for R in Results], axis=0)
+        return Coordinates[:Target], Intersects[:Target], Depths[:Target]
+
     def sample_negative(self, RaysPerVertex, Target):
-        # Numpy version - seems faster
-        Tic = butils.getCurrentEpochTime()
         # Randomly offset vertices
         RandomDistances = np.random.uniform(PC_SAMPLER_NEG_MINOFFSET, PC_SAMPLER_NEG_MAXOFFSET, len(self.Vertices))
-        Offsets = RandomDistances[:, np.newaxis] * self.VertexNormals
-        OffsetVertices = self.Vertices + Offsets
-        Tic = butils.getCurrentEpochTime()
-        # nVertices = len(self.Vertices)
-        # SampledDirections = np.zeros((RaysPerVertex * nVertices, 3))
-        # VertexRepeats = np.zeros((RaysPerVertex * nVertices, 3))
-        # ValidDirCtr = 0
-        # for VCtr in (range(nVertices)):
-        #     ValidDirs = o2utils.sample_directions_prune_numpy(RaysPerVertex, vertex=OffsetVertices[VCtr], points=self.Vertices, thresh=PC_NEG_SAMPLER_THRESH)
-        #     SampledDirections[ValidDirCtr:ValidDirCtr + len(ValidDirs)] = ValidDirs
-        #     VertexRepeats[ValidDirCtr:ValidDirCtr + len(ValidDirs)] = OffsetVertices[np.newaxis, VCtr]
-        #     ValidDirCtr += len(ValidDirs)
-        SampledDirections, VertexRepeats = o2utils.sample_directions_batch_prune(RaysPerVertex, vertices=OffsetVertices, points=self.Vertices, thresh=PC_NEG_SAMPLER_THRESH)
-        ValidDirCtr = len(SampledDirections)
-        Toc = butils.getCurrentEpochTime()
-        # print('Prune time:', (Toc-Tic)*1e-3)
-        # exit()
-
-        SampledDirections = SampledDirections[:ValidDirCtr]
-        VertexRepeats = VertexRepeats[:ValidDirCtr]
-        # print('[ INFO ]: Only able to sample {} valid negative rays out of {} requested.'.format(ValidDirCtr, Target))
+        self.OffsetVertices = self.Vertices + RandomDistances[:, np.newaxis] * self.VertexNormals
+        self.NCoordinates, self.NIntersects, self.NDepths = self.sampleBlocks(self.sample_negative_block, RaysPerVertex, Target)
+
+    def sample_negative_block(self, Start, End, RaysPerVertex):
+        OffsetVertices = self.OffsetVertices[Start:End]
+        SampledDirections, VertexRepeats = o2utils.sample_directions_batch_prune_kdtree(RaysPerVertex, vertices=OffsetVertices, tree=self.VertexTree, thresh=PC_NEG_SAMPLER_THRESH)
 
         # For each normal direction, find the point on a sphere of radius PC_RADIUS
-        Tic = butils.getCurrentEpochTime()
         SpherePoints, Distances = o2utils.find_sphere_points(OriginPoints=VertexRepeats, Directions=SampledDirections,
                                                              SphereCenter=np.zeros(3), Radius=PC_SAMPLER_RADIUS)
-        Toc = butils.getCurrentEpochTime()
-        # print('Sphere points time:', (Toc - Tic) * 1e-3)
 
         Coordinates = np.asarray(np.hstack((SpherePoints, - SampledDirections)))
         Intersects = np.asarray(np.zeros_like(Distances))
@@ -140,36 +168,13 @@ class PointCloudSampler():
 
         SpherePointsNorm = np.linalg.norm(SpherePoints, axis=1)
         ValidPointsIdx = np.abs(SpherePointsNorm - PC_SAMPLER_RADIUS) < 0.01 # Epsilon
-        # print('Invalid idx:', len(Coordinates) - np.sum(ValidPointsIdx))
-        Coordinates = Coordinates[ValidPointsIdx]
-        Intersects = Intersects[ValidPointsIdx]
-        Depths = Depths[ValidPointsIdx]
-        # print('[ INFO ]: Only able to sample {} valid rays out of {} requested.'.format(len(Coordinates), Target))
-
-        Toc = butils.getCurrentEpochTime()
-        # print('[ INFO ]: Numpy processed in {}ms.'.format((Toc - Tic) * 1e-3))
-
-        self.NCoordinates = Coordinates[:Target]
-        self.NIntersects = Intersects[:Target]
-        self.NDepths = Depths[:Target]
+        return Coordinates[ValidPointsIdx], Intersects[ValidPointsIdx], Depths[ValidPointsIdx]
 
     def sample_positive(self, RaysPerVertex, Target):
-        # Numpy version - seems faster
-        Tic = butils.getCurrentEpochTime()
-        nVertices = len(self.Vertices)
-        SampledDirections = np.zeros((RaysPerVertex*nVertices, 3))
-        VertexRepeats = np.zeros_like(SampledDirections)
-        ValidDirCtr = 0
-        for VCtr in (range(nVertices)):
-            # SampledDirections[VCtr*RaysPerVertex:(VCtr+1)*RaysPerVertex] = self.sample_directions_numpy(RaysPerVertex, normal=self.VertexNormals[VCtr])
-            ValidDirs = o2utils.sample_directions_prune_normal_numpy(RaysPerVertex, vertex=self.Vertices[VCtr], normal=self.VertexNormals[VCtr], points=self.Vertices, thresh=PC_SAMPLER_THRESH)
-            SampledDirections[ValidDirCtr:ValidDirCtr+len(ValidDirs)] = ValidDirs
-            VertexRepeats[ValidDirCtr:ValidDirCtr+len(ValidDirs)] = self.Vertices[VCtr]
-            ValidDirCtr += len(ValidDirs)
-
-        SampledDirections = SampledDirections[:ValidDirCtr]
-        VertexRepeats = VertexRepeats[:ValidDirCtr]
-        # print('[ INFO ]: Only able to sample {} valid rays out of {} requested.'.format(ValidDirCtr, Target))
+        self.PCoordinates, self.PIntersects, self.PDepths = self.sampleBlocks(self.sample_positive_block, RaysPerVertex, Target)
+
+    def sample_positive_block(self, Start, End, RaysPerVertex):
+        SampledDirections, VertexRepeats = o2utils.sample_directions_prune_normal_kdtree(RaysPerVertex, vertices=self.Vertices[Start:End], normals=self.VertexNormals[Start:End], tree=self.VertexTree, thresh=PC_SAMPLER_THRESH)
 
         # For each normal direction, find the point on a sphere of radius PC_RADIUS
         SpherePoints, Distances = o2utils.find_sphere_points(OriginPoints=VertexRepeats, Directions=SampledDirections,
@@ -180,17 +185,7 @@ class PointCloudSampler():
 
         SpherePointsNorm = np.linalg.norm(SpherePoints, axis=1)
         ValidPointsIdx = np.abs(SpherePointsNorm - PC_SAMPLER_RADIUS) < 0.1 # Epsilon
-        Coordinates = Coordinates[ValidPointsIdx]
-        Intersects = Intersects[ValidPointsIdx]
-        Depths = Depths[ValidPointsIdx]
-        # print('[ INFO ]: Only able to sample {} valid rays out of {} requested.'.format(len(Coordinates), Target))
-
-        Toc = butils.getCurrentEpochTime()
-        # print('[ INFO ]: Numpy processed in {}ms.'.format((Toc-Tic)*1e-3))
-
-        self.PCoordinates = Coordinates[:Target]
-        self.PIntersects = Intersects[:Target]
-        self.PDepths = Depths[:Target]
+        return Coordinates[ValidPointsIdx], Intersects[ValidPointsIdx], Depths[ValidPointsIdx]
 
     def __getitem__(self, item):
         return self.Coordinate[item], (self.Intersects[item], self.Depths[item])
@@ -0,0 +1,91 @@
+import queue
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+PREFETCH_QUEUE_DEPTH = 2 # Ray sets kept ready per shape
+PREFETCH_POLL_INTERVAL = 0.01 # Seconds a worker waits when all of its queues are full
+PREFETCH_GET_TIMEOUT = 1.0 # Seconds between liveness checks while waiting for a ray set
+
+def prefetchWorker(SampleFcn, Indices, Queues, StopEvent, Seed):
+    # Samplers draw from the global numpy/torch generators, so give every worker its own stream
+    np.random.seed(Seed)
+    torch.manual_seed(Seed)
+    while not StopEvent.is_set():
+        Produced = False
+        # Round robin over the shapes this worker owns, topping up any queue that has room.
+        # Never block on a single full queue since the consumer may be waiting on a different shape.
+        for Idx in Indices:
+            if StopEvent.is_set():
+                break
+            if Queues[Idx].full():
+                continue
+            Sample = SampleFcn(Idx)
+            try:
+                Queues[Idx].put_nowait(Sample)
+                Produced = True
+            except queue.Full:
+                pass
+        if not Produced:
+            # Poll rather than StopEvent.wait(), a worker killed while waiting on the event would deadlock set()
+            time.sleep(PREFETCH_POLL_INTERVAL)
+
+class PrefetchResampler():
+    # Producer/consumer resampling service. Worker processes keep a bounded queue of fresh ray sets ready for every
+    # item and the main process dequeues them, so sampling overlaps with the optimizer step. Anything that needs
+    # gradients (e.g. latent embeddings) stays in the main process since workers only ever produce ray tensors.
+    # SampleFcn(Idx) must return a tuple of tensors and be picklable when the spawn start method is used.
+    def __init__(self, SampleFcn, nItems, nWorkers=1, QueueDepth=PREFETCH_QUEUE_DEPTH, Seed=None):
+        assert nWorkers > 0
+        self.nItems = nItems
+        self.nWorkers = min(nWorkers, nItems)
+        if Seed is None: # Follow the seed of the main process
+            Seed = np.random.randint(2**31 - self.nWorkers)
+        Context = mp.get_context()
+        self.StopEvent = Context.Event()
+        self.Queues = [Context.Queue(maxsize=QueueDepth) for _ in range(nItems)]
+        self.Workers = []
+        for WorkerID in range(self.nWorkers):
+            Indices = list(range(WorkerID, nItems, self.nWorkers))
+            Worker = Context.Process(target=prefetchWorker, args=(SampleFcn, Indices, self.Queues, self.StopEvent, Seed + WorkerID), daemon=True)
+            Worker.start()
+            self.Workers.append(Worker)
+        print('[ INFO ]: Started {} prefetch workers for {} items with queue depth {}.'.format(self.nWorkers, nItems, QueueDepth))
+
+    def get(self, Idx):
+        while True:
+            try:
+                return self.Queues[Idx].get(timeout=PREFETCH_GET_TIMEOUT)
+            except queue.Empty:
+                if not all(Worker.is_alive() for Worker in self.Workers):
+                    self.close()
+                    raise RuntimeError('[ ERR ]: A prefetch worker exited unexpectedly.')
+
+    def close(self):
+        if self.StopEvent.is_set():
+            return
+        self.StopEvent.set()
+        # Drain the queues so that workers blocked on flushing their feeder threads can exit
+        for Q in self.Queues:
+            try:
+                while True:
+                    Q.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                pass
+        for Worker in self.Workers:
+            Worker.join(timeout=5)
+            if Worker.is_alive():
+                Worker.terminate()
+
+    def __getstate__(self):
+        raise RuntimeError('[ ERR ]: PrefetchResampler cannot be sent to other processes. Use num_workers=0 in the DataLoader when prefetching.')
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __len__(self):
+        return self.nItems
@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
-import math
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
+import odf_v2_utils as o2utils
 
 SINGLE_MASK_THRESH = 0.7
 SINGLE_L2_LAMBDA = 5.0
@@ -8,6 +11,45 @@ SINGLE_L1_LAMBDA = 5.0
 # REG_LAMBDA = 1e-4
 REG_LAMBDA = 1e-1
 
+# The losses below take the custom collate lists, pack them into single tensors and reduce each shape's rays with
+# index_add_ over the segment ids. Nothing is read back to the host, so a training step never waits on the device here.
+
+def pack_collate(collate_list):
+    # [(a_0, b_0), (a_1, b_1), ...] -> packed a, packed b and the offsets of each shape
+    packed = [o2utils.pack_batch(list(tensors)) for tensors in zip(*collate_list)]
+    return [p[0] for p in packed], packed[0][1]
+
+def segment_mean(values, segments, n_segments, mask=None):
+    '''
+    values   - packed tensor, first dimension is the ray
+    segments - shape index of every ray (see odf_v2_utils.segment_ids)
+    mask     - optional boolean tensor like values, only these entries are averaged
+    Returns the per-shape means and the number of entries that went into each. Shapes with no entries get a mean of 0
+    '''
+    if mask is not None:
+        values = torch.where(mask, values, torch.zeros_like(values))
+        counts = mask.reshape(mask.shape[0], -1).sum(dim=1).to(values.dtype)
+    else:
+        counts = torch.full((values.shape[0],), values[0].numel() if values.shape[0] > 0 else 0, dtype=values.dtype, device=values.device)
+    sums = torch.zeros(n_segments, dtype=values.dtype, device=values.device).index_add_(0, segments, values.reshape(values.shape[0], -1).sum(dim=1))
+    counts = torch.zeros(n_segments, dtype=values.dtype, device=values.device).index_add_(0, segments, counts)
+    # Clamp before dividing so that empty shapes don't send NaN gradients through the unselected branch of torch.where
+    means = torch.where(counts > 0, sums / counts.clamp(min=1), torch.zeros_like(sums))
+    return means, counts
+
+def finite_or_zero(loss):
+    # Replaces NaN/inf losses with 0 without a host round trip
+    return torch.where(torch.isfinite(loss), loss, torch.zeros_like(loss))
+
+def masked_depth_losses(pred_mask_conf, gt_mask, pred_depth, gt_depth, thresh, segments, n_segments, depth_fcn):
+    # Per-shape BCE on the mask and depth_fcn(labels - predictions) averaged over the rays predicted to intersect
+    pred_mask_conf_sig = torch.sigmoid(pred_mask_conf)
+    mask_losses, _ = segment_mean(nn.functional.binary_cross_entropy(pred_mask_conf_sig.to(torch.float), gt_mask.to(torch.float), reduction='none'), segments, n_segments)
+    valid_rays_idx = pred_mask_conf_sig > thresh  # Use predicted mask
+    # valid_rays_idx = gt_mask.to(torch.bool)  # Use ground truth mask
+    depth_losses, _ = segment_mean(depth_fcn(gt_depth - pred_depth), segments, n_segments, mask=valid_rays_idx)
+    return mask_losses, finite_or_zero(depth_losses)
+
 class SingleDepthBCELoss(nn.Module):
     Thresh = SINGLE_MASK_THRESH
     Lambda = SINGLE_L2_LAMBDA
@@ -22,38 +64,18 @@ class SingleDepthBCELoss(nn.Module):
         return self.computeLoss(output, target)
 
     def computeLoss(self, output, target):
-        # print(f"output type: {type(output)}")
-        # print(output)
         assert isinstance(output, list) # For custom collate
         B = len(target) # Number of batches with custom collate
-        Loss = 0
-        for b in range(B):
-            # Single batch version
-            GTMask, GTDepth = target[b]
-            PredMaskConf, PredDepth = output[b]
+        (PredMaskConf, PredDepth), Offsets = pack_collate(output)
+        (GTMask, GTDepth), _ = pack_collate(target)
+        Segments = o2utils.segment_ids(Offsets, device=PredMaskConf.device)
 
-            PredMaskConfSig = self.Sigmoid(PredMaskConf)
-            PredMaskMaxConfVal = PredMaskConfSig
-            ValidRaysIdx = PredMaskMaxConfVal > self.Thresh  # Use predicted mask
-            # ValidRaysIdx = GTMask.to(torch.bool)  # Use ground truth mask
-
-            MaskLoss = self.MaskLoss(PredMaskMaxConfVal.to(torch.float), GTMask.to(torch.float))
-            L2Loss = self.L2(GTDepth[ValidRaysIdx], PredDepth[ValidRaysIdx])
-            Loss += self.Lambda * L2Loss + MaskLoss
-        Loss /= B
-
-        return Loss
+        MaskLosses, L2Losses = masked_depth_losses(PredMaskConf, GTMask, PredDepth, GTDepth, self.Thresh, Segments, B, torch.square)
+        return torch.mean(self.Lambda * L2Losses + MaskLosses)
 
     def L2(self, labels, predictions):
-        # print(labels.size())
-        # print(predictions.size())
         Loss = torch.mean(torch.square(labels - predictions))
-        if math.isnan(Loss) or math.isinf(Loss):
-            return torch.tensor(0)
-
-        # print(torch.min(labels), torch.max(labels))
-        # print(torch.min(predictions), torch.max(predictions))
-        return Loss
+        return finite_or_zero(Loss)
 
 class ADCombinedLoss(nn.Module):
     '''
@@ -74,45 +96,30 @@ class ADCombinedLoss(nn.Module):
 
     def computeLoss(self, output, target):
         Output = output[0]
-        LatentNorms = output[1]
-        assert isinstance(LatentNorms, list) # For custom collate
+        LatentVectors = output[1]
+        assert isinstance(LatentVectors, list) # For custom collate
         assert isinstance(Output, list) # For custom collate
         B = len(target) # Number of batches with custom collate
-        Loss = 0
-        for b in range(B):
-            # Single batch version
-            GTMask, GTDepth = target[b]
-            PredMaskConf, PredDepth = Output[b]
-            
-
-            PredMaskConfSig = self.Sigmoid(PredMaskConf)
-            PredMaskMaxConfVal = PredMaskConfSig
-            ValidRaysIdx = PredMaskMaxConfVal > self.Thresh  # Use predicted mask
-            # ValidRaysIdx = GTMask.to(torch.bool)  # Use ground truth mask
-
-            MaskLoss = self.MaskLoss(PredMaskMaxConfVal.to(torch.float), GTMask.to(torch.float))
-            if not self.use_l2:
-                DepthLoss = self.L1(GTDepth[ValidRaysIdx], PredDepth[ValidRaysIdx])
-            else:
-                DepthLoss = self.L2(GTDepth[ValidRaysIdx], PredDepth[ValidRaysIdx])
-            PredictionLoss = self.Lambda * DepthLoss + MaskLoss
-            LatentLoss = REG_LAMBDA * LatentNorms[b]
-            Loss += PredictionLoss + LatentLoss
-        Loss /= B
-
-        return Loss
+        (PredMaskConf, PredDepth), Offsets = pack_collate(Output)
+        (GTMask, GTDepth), _ = pack_collate(target)
+        Segments = o2utils.segment_ids(Offsets, device=PredMaskConf.device)
+
+        # This loss has always used the signed difference for its L1 term
+        MaskLosses, DepthLosses = masked_depth_losses(PredMaskConf, GTMask, PredDepth, GTDepth, self.Thresh, Segments, B, torch.square if self.use_l2 else (lambda d: d))
+        PredictionLosses = self.Lambda * DepthLosses + MaskLosses
+        PackedLatents, LatentOffsets = o2utils.pack_batch(LatentVectors)
+        # The model returns one latent per ray, so the ray segments can usually be reused
+        LatentSegments = Segments if LatentOffsets == Offsets else o2utils.segment_ids(LatentOffsets, device=PackedLatents.device)
+        LatentLosses, _ = segment_mean(torch.norm(PackedLatents, dim=-1), LatentSegments, B)
+        return torch.mean(PredictionLosses + self.RegLambda * LatentLosses)
 
     def L1(self, labels, predictions):
         Loss = torch.mean(labels - predictions)
-        if math.isnan(Loss) or math.isinf(Loss):
-            return torch.tensor(0)
-        return Loss
+        return finite_or_zero(Loss)
 
     def L2(self, labels, predictions):
         Loss = torch.mean(torch.square(labels - predictions))
-        if math.isnan(Loss) or math.isinf(Loss):
-            return torch.tensor(0)
-        return Loss
+        return finite_or_zero(Loss)
 
 class ADPredLoss(nn.Module):
     '''
@@ -134,42 +141,20 @@ class ADPredLoss(nn.Module):
         Output = output[0]
         assert isinstance(Output, list) # For custom collate
         B = len(target) # Number of batches with custom collate
-        Loss = 0
-        for b in range(B):
-            # Single batch version
-            GTMask, GTDepth = target[b]
-            PredMaskConf, PredDepth = Output[b]
-
-            PredMaskConfSig = self.Sigmoid(PredMaskConf)
-            PredMaskMaxConfVal = PredMaskConfSig
-            ValidRaysIdx = PredMaskMaxConfVal > self.Thresh  # Use predicted mask
-            # ValidRaysIdx = GTMask.to(torch.bool)  # Use ground truth mask
-
-            MaskLoss = self.MaskLoss(PredMaskMaxConfVal.to(torch.float), GTMask.to(torch.float))
-            print(f"Total intersecting: {torch.sum(ValidRaysIdx)}")
-            if not self.use_l2:
-                DepthLoss = self.L1(GTDepth[ValidRaysIdx], PredDepth[ValidRaysIdx])
-            else:
-                DepthLoss = self.L2(GTDepth[ValidRaysIdx], PredDepth[ValidRaysIdx])
-            print(f"Depth Loss: {DepthLoss}")
-            print(f"Mask Loss: {MaskLoss}")
-            PredictionLoss = self.Lambda * DepthLoss + MaskLoss
-            Loss += PredictionLoss
-        Loss /= B
-
-        return Loss
+        (PredMaskConf, PredDepth), Offsets = pack_collate(Output)
+        (GTMask, GTDepth), _ = pack_collate(target)
+        Segments = o2utils.segment_ids(Offsets, device=PredMaskConf.device)
+
+        MaskLosses, DepthLosses = masked_depth_losses(PredMaskConf, GTMask, PredDepth, GTDepth, self.Thresh, Segments, B, torch.square if self.use_l2 else torch.abs)
+        return torch.mean(self.Lambda * DepthLosses + MaskLosses)
 
     def L1(self, labels, predictions):
         Loss = torch.mean(torch.abs(labels - predictions))
-        if math.isnan(Loss) or math.isinf(Loss):
-            return torch.tensor(0)
-        return Loss
+        return finite_or_zero(Loss)
 
     def L2(self, labels, predictions):
         Loss = torch.mean(torch.square(labels - predictions))
-        if math.isnan(Loss) or math.isinf(Loss):
-            return torch.tensor(0)
-        return Loss
+        return finite_or_zero(Loss)
 
 class ADRegLoss(nn.Module):
     '''
@@ -188,14 +173,9 @@ class ADRegLoss(nn.Module):
     def computeLoss(self, output, target):
         LatentVectors = output[1]
         assert isinstance(LatentVectors, list) # For custom collate
-        B = len(output) # Number of batches with custom collate
-        Loss = 0
-        for b in range(B):
-            # Single batch version
-            # TODO: Factor in the epoch
-            # TODO: How does the stdev of the latent space factor in?
-            LatentLoss = self.RegLambda * torch.mean(torch.norm(LatentVectors[b], dim=-1))
-            Loss += LatentLoss
-        Loss /= B
-        print(f"Reg Loss: {Loss}")
-        return Loss
\ No newline at end of file
+        B = len(LatentVectors) # Number of batches with custom collate
+        # TODO: Factor in the epoch
+        # TODO: How does the stdev of the latent space factor in?
+        PackedLatents, Offsets = o2utils.pack_batch(LatentVectors)
+        LatentLosses, _ = segment_mean(torch.norm(PackedLatents, dim=-1), o2utils.segment_ids(Offsets, device=PackedLatents.device), B)
+        return torch.mean(self.RegLambda * LatentLosses)
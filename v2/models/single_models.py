@@ -3,13 +3,44 @@ import torch.nn as nn
 import beacon.supernet as supernet
 import sys
 
+import odf_v2_utils as o2utils
+
+def forward_rays(net, x):
+    # Runs the body and heads of an LF4DSingle(AutoDecoder) on one tensor of rays (for the autodecoder, rays concatenated
+    # with their latent vectors) and returns the (intersections, depths) logits
+    BInput = x
+    for i in range(len(net.network)):
+        if i + 1 in net.pos_enc_layers:
+            x = net.network[i](torch.cat([BInput, x], dim=1))
+        else:
+            x = net.network[i](x)
+        x = net.relu(x)
+
+    # intersection head
+    intersections = net.intersection_head[0](x)
+    intersections = net.relu(intersections)
+    intersections = net.intersection_head[1](intersections)
+    if len(intersections.size()) == 3:
+        intersections = torch.squeeze(intersections, dim=1)
+
+    # depth head
+    depths = net.depth_head[0](x)
+    depths = net.relu(depths)
+    # enforce strictly increasing depth values
+    depths = net.depth_head[1](depths)
+    depths = net.relu(depths)
+    depths = torch.cumsum(depths, dim=1)
+    if len(depths.size()) == 3:
+        depths = torch.squeeze(depths, dim=1)
+    return intersections, depths
+
 class LF4DSingle(supernet.SuperNet):
     # class LF4D(nn.Module):
     '''
     A DDF with structure adapted from this LFN paper https://arxiv.org/pdf/2106.02634.pdf
     '''
 
-    def __init__(self, input_size=6, n_layers=6, hidden_size=256, radius=1.25, coord_type='direction', pos_enc=True, Args=None):
+    def __init__(self, input_size=6, n_layers=6, hidden_size=256, radius=1.25, coord_type='direction', pos_enc=True, packed=True, Args=None):
         super().__init__(Args=Args)
 
         # store args
@@ -17,6 +48,7 @@ class LF4DSingle(supernet.SuperNet):
         self.preprocessing = coord_type
         self.pos_enc = pos_enc
         self.radius = radius
+        self.packed = packed # Run all shapes of the collate list through the network at once
         assert (n_layers > 1)
 
         # set which layers (aside from the first) should have the positional encoding passed in
@@ -61,42 +93,15 @@ class LF4DSingle(supernet.SuperNet):
         assert isinstance(input, list)
         B = len(Input)
 
-        BIntersects = [None] * B
-        BDepths = [None] * B
+        if self.packed:
+            # One large forward over the rays of every shape, split back into the custom collate format
+            PackedInput, Offsets = o2utils.pack_batch(Input)
+            intersections, depths = forward_rays(self, PackedInput)
+            return list(zip(o2utils.unpack_batch(intersections, Offsets), o2utils.unpack_batch(depths, Offsets)))
+
         CollateList = [None] * B
         for b in range(B):
-            x = Input[b]
-            BInput = Input[b]
-            for i in range(len(self.network)):
-                if i + 1 in self.pos_enc_layers:
-                    x = self.network[i](torch.cat([BInput, x], dim=1))
-                else:
-                    x = self.network[i](x)
-                x = self.relu(x)
-                # x = self.layernorm(x)
-
-            # intersection head
-            intersections = self.intersection_head[0](x)
-            intersections = self.relu(intersections)
-            # intersections = self.layernorm(intersections)
-            intersections = self.intersection_head[1](intersections)
-            # intersections = torch.sigmoid(intersections)
-            if len(intersections.size()) == 3:
-                intersections = torch.squeeze(intersections, dim=1)
-
-            # depth head
-            depths = self.depth_head[0](x)
-            depths = self.relu(depths)
-            # depths = self.layernorm(depths)
-            # enforce strictly increasing depth values
-            depths = self.depth_head[1](depths)
-            depths = self.relu(depths) # todo: Avoid relu at the last layer?
-            depths = torch.cumsum(depths, dim=1)
-            if len(depths.size()) == 3:
-                depths = torch.squeeze(depths, dim=1)
-            BIntersects[b] = intersections
-            BDepths[b] = depths
-            CollateList[b] = (intersections, depths)
+            CollateList[b] = forward_rays(self, Input[b])
 
         return CollateList
         # return BIntersects, BDepths
@@ -108,7 +113,7 @@ class LF4DSingleAutoDecoder(supernet.SuperNet):
     This is the autodecoder version
     '''
 
-    def __init__(self, input_size=6, n_layers=6, hidden_size=256, radius=1.25, coord_type='direction', pos_enc=True, latent_size=256, Args=None):
+    def __init__(self, input_size=6, n_layers=6, hidden_size=256, radius=1.25, coord_type='direction', pos_enc=True, latent_size=256, packed=True, Args=None):
         super().__init__(Args=Args)
 
         # store args
@@ -116,6 +121,7 @@ class LF4DSingleAutoDecoder(supernet.SuperNet):
         self.preprocessing = coord_type
         self.pos_enc = pos_enc
         self.radius = radius
+        self.packed = packed # Run all shapes of the collate list through the network at once
         self.LatentSize = latent_size
         self.InputSize = input_size + self.LatentSize
         assert (n_layers > 1)
@@ -167,44 +173,20 @@ class LF4DSingleAutoDecoder(supernet.SuperNet):
         assert isinstance(input, list)
         B = len(Input)
 
-        BIntersects = [None] * B
-        BDepths = [None] * B
+        if self.packed:
+            # One embedding lookup and one large forward over the rays of every shape, split back into the custom collate format
+            PackedCoords, Offsets = o2utils.pack_batch([coords for coords, _ in Input])
+            PackedIndices, _ = o2utils.pack_batch([indices for _, indices in Input])
+            PackedLatents = otherParameters["Latent Vectors"](PackedIndices)
+            intersections, depths = forward_rays(self, torch.cat([PackedCoords, PackedLatents], dim=1))
+            CollateList = list(zip(o2utils.unpack_batch(intersections, Offsets), o2utils.unpack_batch(depths, Offsets)))
+            return CollateList, o2utils.unpack_batch(PackedLatents, Offsets)
+
         CollateList = [None] * B
         LatentVectors = [None] * B
         for b in range(B):
             coords, indices = Input[b]
-            x = torch.cat([coords, otherParameters["Latent Vectors"](indices)], dim=1)
             LatentVectors[b] = otherParameters["Latent Vectors"](indices)
-            BInput = Input[b]
-            for i in range(len(self.network)):
-                if i + 1 in self.pos_enc_layers:
-                    x = self.network[i](torch.cat([BInput, x], dim=1))
-                else:
-                    x = self.network[i](x)
-                x = self.relu(x)
-                # x = self.layernorm(x)
-
-            # intersection head
-            intersections = self.intersection_head[0](x)
-            intersections = self.relu(intersections)
-            # intersections = self.layernorm(intersections)
-            intersections = self.intersection_head[1](intersections)
-            # intersections = torch.sigmoid(intersections)
-            if len(intersections.size()) == 3:
-                intersections = torch.squeeze(intersections, dim=1)
-
-            # depth head
-            depths = self.depth_head[0](x)
-            depths = self.relu(depths)
-            # depths = self.layernorm(depths)
-            # enforce strictly increasing depth values
-            depths = self.depth_head[1](depths)
-            depths = self.relu(depths) # todo: Avoid relu at the last layer?
-            depths = torch.cumsum(depths, dim=1)
-            if len(depths.size()) == 3:
-                depths = torch.squeeze(depths, dim=1)
-            BIntersects[b] = intersections
-            BDepths[b] = depths
-            CollateList[b] = (intersections, depths)
+            CollateList[b] = forward_rays(self, torch.cat([coords, LatentVectors[b]], dim=1))
         return CollateList, LatentVectors
         # return BIntersects, BDepths
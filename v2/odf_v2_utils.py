@@ -1,7 +1,13 @@
 import numpy as np
 import math
 import os
+import sys
 import torch
+from scipy.spatial import cKDTree
+from scipy.ndimage import binary_dilation
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
+import odf_utils
 
 def save_latent_vectors(save_directory, experiment_name, latent_vec, epoch):
     latent_codes_dir = os.path.join(save_directory, f"{experiment_name}___latent_vecs")
@@ -120,6 +126,125 @@ def sample_directions_batch_prune(nDirs, vertices, points, thresh):
 
     return SampledDirections, VertexRepeats
 
+def prune_lines_kdtree(Tree, Origins, Dirs, thresh, Normals=None, ChunkSize=20000):
+    '''
+    Spatial index version of the pruning test in sample_directions_prune_numpy / sample_directions_prune_normal_numpy
+    Tree    - cKDTree of the points
+    Origins - Nx3 ray origins, Dirs - Nx3 unit directions. The test uses the infinite line through each origin
+    Normals - if given, only points in the same half space as sample_directions_prune_normal_numpy (normal . p + |origin| < 0) are considered
+    Returns a boolean array that is True for lines with no considered point closer than thresh
+    The line is covered by query centers spaced thresh apart. A point within thresh of the line is within Radius of a center, so
+    nearest neighbor queries decide most lines and only the ambiguous centers need a full ball query. Centers in empty space are
+    skipped using a coarse occupancy grid of the points
+    '''
+    Points = Tree.data
+    Spacing = thresh
+    Radius = np.sqrt(thresh ** 2 + (Spacing / 2) ** 2)
+    Center = 0.5 * (np.min(Points, axis=0) + np.max(Points, axis=0))
+    BoundRadius = np.max(np.linalg.norm(Points - Center, axis=1)) + thresh
+
+    # Occupancy grid with cells at least Radius wide, dilated by one cell so that every center within Radius of a point is marked
+    GridMin = np.min(Points, axis=0)
+    CellSize = max(Radius, np.max(np.max(Points, axis=0) - GridMin) / 256)
+    GridRes = np.floor((np.max(Points, axis=0) - GridMin) / CellSize).astype(np.int64) + 3
+    GridMin = GridMin - CellSize
+    Occupied = np.zeros(GridRes, dtype=bool)
+    Cells = np.floor((Points - GridMin) / CellSize).astype(np.int64)
+    Occupied[Cells[:, 0], Cells[:, 1], Cells[:, 2]] = True
+    Occupied = binary_dilation(Occupied, structure=np.ones((3, 3, 3), dtype=bool))
+
+    Valid = np.ones(len(Origins), dtype=bool)
+    for Start in range(0, len(Origins), ChunkSize):
+        O = Origins[Start:Start + ChunkSize]
+        D = Dirs[Start:Start + ChunkSize]
+        N = None if Normals is None else Normals[Start:Start + ChunkSize]
+        # Only the part of the line inside the padded bounding sphere of the points can come within thresh of a point
+        OC = O - Center
+        B = np.sum(OC * D, axis=1)
+        Delta = B ** 2 - (np.sum(OC * OC, axis=1) - BoundRadius ** 2)
+        TMin = -B - np.sqrt(np.maximum(Delta, 0))
+        TMax = -B + np.sqrt(np.maximum(Delta, 0))
+        if N is not None:
+            # Considered points satisfy normal . p < -|origin|, so only line positions with normal . x < -|origin| + thresh matter
+            NDotD = np.sum(N * D, axis=1)
+            Offset = thresh - np.linalg.norm(O, axis=1) - np.sum(N * O, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                Limit = Offset / NDotD
+            TMax = np.where(NDotD > 0, np.minimum(TMax, Limit), TMax)
+            TMin = np.where(NDotD < 0, np.maximum(TMin, Limit), TMin)
+            TMax = np.where(np.logical_and(NDotD == 0, Offset <= 0), -np.inf, TMax)
+        nCenters = np.where(np.logical_and(Delta > 0, TMax > TMin), np.ceil((TMax - TMin) / Spacing), 0).astype(np.int64)
+        if np.sum(nCenters) == 0:
+            continue
+
+        # One query center per Spacing of line length
+        LineIdx = np.repeat(np.arange(len(O)), nCenters)
+        Step = np.arange(len(LineIdx)) - np.repeat(np.cumsum(nCenters) - nCenters, nCenters)
+        T = TMin[LineIdx] + (Step + 0.5) * Spacing
+        Centers = O[LineIdx] + T[:, np.newaxis] * D[LineIdx]
+
+        Cells = np.floor((Centers - GridMin) / CellSize).astype(np.int64)
+        NearPoints = np.all(np.logical_and(Cells >= 0, Cells < GridRes), axis=1)
+        NearPoints[NearPoints] = Occupied[Cells[NearPoints, 0], Cells[NearPoints, 1], Cells[NearPoints, 2]]
+        Centers = Centers[NearPoints]
+        LineIdx = LineIdx[NearPoints]
+
+        def considered(PointIdx, Lines):
+            if N is None:
+                return np.ones(len(PointIdx), dtype=bool)
+            return np.sum(N[Lines] * Points[PointIdx], axis=1) + np.linalg.norm(O[Lines], axis=1) < 0
+
+        Distances, Nearest = Tree.query(Centers, k=1, distance_upper_bound=Radius, workers=-1)
+        Found = np.isfinite(Distances)
+        Failed = np.zeros(len(O), dtype=bool)
+        # The distance to the line is at most the distance to the center
+        Certain = np.zeros(len(Centers), dtype=bool)
+        Certain[Found] = np.logical_and(Distances[Found] < thresh, considered(Nearest[Found], LineIdx[Found]))
+        Failed[LineIdx[Certain]] = True
+
+        # Ambiguous centers: some point is within Radius, but the nearest one doesn't settle the test
+        Ambiguous = np.logical_and(Found, np.logical_not(Certain))
+        Ambiguous[Ambiguous] = np.logical_not(Failed[LineIdx[Ambiguous]])
+        if np.any(Ambiguous):
+            Candidates = Tree.query_ball_point(Centers[Ambiguous], Radius, workers=-1)
+            nCandidates = np.array([len(C) for C in Candidates])
+            PointIdx = np.concatenate([np.asarray(C, dtype=np.int64) for C in Candidates])
+            Lines = np.repeat(LineIdx[Ambiguous], nCandidates)
+            P2LDistances = np.linalg.norm(np.cross(O[Lines] - Points[PointIdx], D[Lines]), axis=1)
+            Close = np.logical_and(P2LDistances < thresh, considered(PointIdx, Lines))
+            Failed[Lines[Close]] = True
+        Valid[Start:Start + ChunkSize] = np.logical_not(Failed)
+
+    return Valid
+
+def sample_directions_prune_normal_kdtree(nDirs, vertices, normals, tree, thresh):
+    '''
+    Batched version of sample_directions_prune_normal_numpy for every vertex at once, using a cKDTree of the points (see prune_lines_kdtree)
+    Returns the valid directions and the vertex each of them starts from
+    '''
+    Dirs = np.random.randn(nDirs * len(vertices), 3)
+    Dirs /= np.linalg.norm(Dirs, axis=1)[:, np.newaxis]
+    VertexIdx = np.repeat(np.arange(len(vertices)), nDirs)
+
+    # Select only if direction is in the same half space as normal
+    ValidIdx = np.sum(Dirs * normals[VertexIdx], axis=1) > 0.0
+    Dirs = Dirs[ValidIdx]
+    VertexIdx = VertexIdx[ValidIdx]
+
+    ValidIdx = prune_lines_kdtree(tree, vertices[VertexIdx], Dirs, thresh, Normals=normals[VertexIdx])
+    return Dirs[ValidIdx], vertices[VertexIdx[ValidIdx]]
+
+def sample_directions_batch_prune_kdtree(nDirs, vertices, tree, thresh):
+    '''
+    Same as sample_directions_batch_prune, but the pruning uses a cKDTree of the points (see prune_lines_kdtree)
+    '''
+    Dirs = np.random.randn(nDirs * len(vertices), 3)
+    Dirs /= np.linalg.norm(Dirs, axis=1)[:, np.newaxis]
+    VertexRepeats = np.repeat(vertices, nDirs, axis=0)
+
+    ValidIdx = prune_lines_kdtree(tree, VertexRepeats, Dirs, thresh)
+    return Dirs[ValidIdx], VertexRepeats[ValidIdx]
+
 def prune_rays(Start, End, Vertices, thresh):
         ValidIdx = np.ones(len(Start), dtype=bool) * True
         RaysPerVertex = int(len(Start) / len(Vertices))
@@ -180,22 +305,35 @@ def get_positional_enc(in_array, L = 10):
     L   - controls the size of the encoding (size = 2*L  - see paper for details)
     Implements the positional encoding described in section 5.1 of NeRF
     https://arxiv.org/pdf/2003.08934.pdf
+    Wraps odf_utils.positional_encoding_batch
+    '''
+    return odf_utils.positional_encoding_batch(in_array, L=L)
+
+
+def pack_batch(tensors):
+    '''
+    tensors - list of per-shape tensors (e.g. the custom collate list) with matching trailing dimensions
+    Concatenates them along the first dimension so that they can be processed with a single call
+    Returns the packed tensor and the B+1 offsets (python ints) of each shape in it
     '''
-    N = in_array.shape[0]
-    nCoords = in_array.shape[1]
-    out_array = np.zeros((N, nCoords*2*L))
-    for Idx in range(nCoords):
-        Val = in_array[:, Idx]
-        PosEnc = [x for i in range(L) for x in [np.sin(2 ** (i) * math.pi * Val), np.cos(2 ** (i) * math.pi * Val)]]
-        out_array[:, Idx*2*L:(Idx+1)*2*L] = np.array(PosEnc).T
-
-    # # Test
-    # Row = 73
-    # Col = 3
-    # Val = in_array[Row, Col]
-    # TestOrig = [x for i in range(L) for x in [math.sin(2 ** (i) * math.pi * Val), math.cos(2 ** (i) * math.pi * Val)]]
-    # print(TestOrig)
-    # print(out_array[Row, Col*2*L:(Col+1)*2*L])
-
-    return out_array
+    offsets = [0]
+    for t in tensors:
+        offsets.append(offsets[-1] + t.shape[0])
+    return torch.cat(tensors, dim=0), offsets
 
+def unpack_batch(packed, offsets):
+    '''
+    Splits a tensor packed with pack_batch back into the list of per-shape tensors (views, no copies)
+    '''
+    return list(torch.split(packed, [offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1)], dim=0))
+
+def segment_ids(offsets, device=None):
+    '''
+    Returns the shape index of every row of a packed tensor, for segment reductions with index_add_/scatter
+    Built from the python offsets so it doesn't synchronize with the device: the sizes are staged in pinned memory and
+    copied asynchronously (a pageable host to device copy would block until the stream is idle)
+    '''
+    sizes = torch.tensor([offsets[i + 1] - offsets[i] for i in range(len(offsets) - 1)], dtype=torch.long)
+    if device is not None and torch.device(device).type == 'cuda':
+        sizes = sizes.pin_memory().to(device, non_blocking=True)
+    return torch.repeat_interleave(torch.arange(len(offsets) - 1, device=device), sizes, output_size=offsets[-1])
@@ -28,6 +28,7 @@ Parser.set_defaults(force_test_on_train=False)
 Parser.add_argument('-s', '--seed', help='Random seed.', required=False, type=int, default=42)
 Parser.add_argument('--no-posenc', help='Choose not to use positional encoding.', action='store_true', required=False)
 Parser.set_defaults(no_posenc=False)
+Parser.add_argument('--prefetch-workers', help='Number of worker processes that resample rays ahead of time. 0 samples in the DataLoader.', required=False, type=int, default=0)
 
 import faulthandler; faulthandler.enable()
 
@@ -39,16 +40,18 @@ if __name__ == '__main__':
 
     butils.seedRandom(Args.seed)
     nCores = 1#mp.cpu_count()
+    if Args.prefetch_workers > 0:
+        nCores = 0 # The datasets only dequeue prefetched rays
 
     usePosEnc = not Args.no_posenc
     if Args.arch == 'standard':
         NeuralODF = LF4DSingle(input_size=(120 if usePosEnc else 6), radius=DEPTH_SAMPLER_RADIUS, coord_type=Args.coord_type, pos_enc=usePosEnc)
 
     TrainDevice = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-    TrainData = DDL(root=NeuralODF.Config.Args.input_dir, train=True, download=True, target_samples=Args.rays_per_shape, usePositionalEncoding=usePosEnc)
+    TrainData = DDL(root=NeuralODF.Config.Args.input_dir, train=True, download=True, target_samples=Args.rays_per_shape, usePositionalEncoding=usePosEnc, prefetch_workers=Args.prefetch_workers)
     if Args.force_test_on_train:
         print('[ WARN ]: VALIDATING ON TRAINING DATA.')
-    ValData = DDL(root=NeuralODF.Config.Args.input_dir, train=Args.force_test_on_train, download=True, target_samples=Args.val_rays_per_shape, usePositionalEncoding=usePosEnc)
+    ValData = DDL(root=NeuralODF.Config.Args.input_dir, train=Args.force_test_on_train, download=True, target_samples=Args.val_rays_per_shape, usePositionalEncoding=usePosEnc, prefetch_workers=Args.prefetch_workers)
     print('[ INFO ]: Training data has {} shapes and {} rays per sample.'.format(len(TrainData), Args.rays_per_shape))
     print('[ INFO ]: Validation data has {} shapes and {} rays per sample.'.format(len(ValData), Args.val_rays_per_shape))
 
@@ -59,4 +62,6 @@ if __name__ == '__main__':
         print('[ WARN ]: Not validating during training. This should be used for debugging purposes only.')
         ValDataLoader = None
 
-    NeuralODF.fit(TrainDataLoader, Objective=SingleDepthBCELoss(), TrainDevice=TrainDevice, ValDataLoader=ValDataLoader)
\ No newline at end of file
+    NeuralODF.fit(TrainDataLoader, Objective=SingleDepthBCELoss(), TrainDevice=TrainDevice, ValDataLoader=ValDataLoader)
+    TrainData.stopPrefetch()
+    ValData.stopPrefetch()
\ No newline at end of file
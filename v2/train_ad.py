@@ -34,6 +34,7 @@ Parser.add_argument('--latent-stdev', type=float, default=0.001**2, help="The st
 Parser.add_argument('--lr-decoder', type=float, default=0.0001, help="The baseline learning rate for the decoder weights")
 Parser.add_argument('--lr-latvecs', type=float, default=0.001, help="The learning rate for the latent vectors")
 Parser.add_argument('--use_l2', action="store_true", help="Use L2 loss instead of L1 loss")
+Parser.add_argument('--prefetch-workers', help='Number of worker processes that resample rays ahead of time. 0 samples in the main process.', required=False, type=int, default=0)
 
 
 if __name__ == '__main__':
@@ -50,10 +51,10 @@ if __name__ == '__main__':
 
     TrainDevice = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     # TrainDevice = "cpu"
-    TrainData = PCDL(root=NeuralODF.Config.Args.input_dir, train=True, download=True, target_samples=Args.rays_per_shape, usePositionalEncoding=usePosEnc, ad=True)
+    TrainData = PCDL(root=NeuralODF.Config.Args.input_dir, train=True, download=True, target_samples=Args.rays_per_shape, usePositionalEncoding=usePosEnc, ad=True, prefetch_workers=Args.prefetch_workers)
     if Args.force_test_on_train:
         print('[ WARN ]: VALIDATING ON TRAINING DATA.')
-    ValData = PCDL(root=NeuralODF.Config.Args.input_dir, train=Args.force_test_on_train, download=True, target_samples=Args.val_rays_per_shape, usePositionalEncoding=usePosEnc, ad=True)
+    ValData = PCDL(root=NeuralODF.Config.Args.input_dir, train=Args.force_test_on_train, download=True, target_samples=Args.val_rays_per_shape, usePositionalEncoding=usePosEnc, ad=True, prefetch_workers=Args.prefetch_workers)
     print('[ INFO ]: Training data has {} shapes and {} rays per sample.'.format(len(TrainData), Args.rays_per_shape))
     print('[ INFO ]: Validation data has {} shapes and {} rays per sample.'.format(len(ValData), Args.val_rays_per_shape))
 
@@ -67,6 +68,7 @@ if __name__ == '__main__':
     )
 
     #TODO: Figure out how to propagate embedding gradients with multiple workers
+    # Until then sampling can still overlap with training through --prefetch-workers, which keeps the embeddings in this process
     TrainDataLoader = torch.utils.data.DataLoader(TrainData, batch_size=NeuralODF.Config.Args.batch_size, shuffle=False, num_workers=nCores, collate_fn=PCDL.collate_fn)
     if Args.no_val == False:
         ValDataLoader = torch.utils.data.DataLoader(ValData, batch_size=NeuralODF.Config.Args.batch_size, shuffle=False, num_workers=nCores, collate_fn=PCDL.collate_fn)
@@ -94,4 +96,6 @@ if __name__ == '__main__':
     # loss = ADCombinedLoss()
 
     NeuralODF.fit(TrainDataLoader, Objective=loss, TrainDevice=TrainDevice, ValDataLoader=ValDataLoader, OtherParameterNames=["Latent Vectors"], OtherParameters=[lat_vecs])
+    TrainData.stopPrefetch()
+    ValData.stopPrefetch()
     odf_v2_utils.save_latent_vectors(NeuralODF.Config.Args.output_dir, NeuralODF.Config.Args.expt_name, lat_vecs, NeuralODF.Config.Args.epochs)